@@ -30,6 +30,7 @@ TESTS_TO_RUN = [
     'email_tests.TestEmailLoginForm',
     'email_tests.TestEmailRegister',
     'email_tests.TestEmailForgotPasswordProcess',
+    'email_tests.TestEmailQueryBudgets',
 ]
 
 DATABASES = {
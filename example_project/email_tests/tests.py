@@ -1,6 +1,7 @@
-from example_project.tests import TestRegister, FIXTURE_USER_DATA, TestForgotPasswordProcess, TestLoginFormBase
+from example_project.tests import TestRegister, FIXTURE_USER_DATA, TestForgotPasswordProcess, TestLoginFormBase, TestQueryBudgets
 from sky_visitor.forms import EmailLoginForm, EmailRegisterForm
 from django.contrib.auth.models import User as AuthUser
+import os
 from django.test import TestCase
 from sky_visitor.utils import SubclassedUser
 
@@ -62,3 +63,7 @@ class TestEmailLoginForm(TestLoginFormBase):
         self.assertLoggedIn(user, backend='sky_visitor.backends.EmailBackend')
         # Should redirect
         self.assertRedirected(response, '/')
+
+
+class TestEmailQueryBudgets(TestQueryBudgets):
+    query_budget_file = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
@@ -30,6 +30,8 @@ TESTS_TO_RUN = [
     'example_project.TestRegister',
     'example_project.TestAuthUserLoginForm',
     'example_project.TestForgotPasswordProcess',
+    'example_project.TestThrottling',
+    'example_project.TestQueryBudgets',
 ]
 
 
@@ -0,0 +1,11 @@
+from django.conf.urls import patterns, url
+from example_project.urls import urlpatterns
+from sky_visitor.urls import TOKEN_REGEX
+from sky_visitor.views import InvitationCompleteView, ProfileEditView
+
+# The project's URLs plus the sky_visitor views it doesn't route
+urlpatterns = urlpatterns + patterns('',
+    url(r'^user/invitation/%s/$' % TOKEN_REGEX, InvitationCompleteView.as_view(), name='invitation_complete'),
+    url(r'^user/profile/$', ProfileEditView.as_view(template_name='sky_visitor/profile_edit.html'),
+        name='profile_edit'),
+)
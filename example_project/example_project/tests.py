@@ -1,11 +1,15 @@
+import os
 from django.contrib.auth.tokens import default_token_generator
 from django.core import mail
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test.testcases import TestCase
+from django.test.utils import override_settings
 from django.utils.http import int_to_base36
 from django.utils.unittest.case import skipUnless
 from sky_visitor import utils
 from sky_visitor.forms import EmailRegisterForm, LoginForm, SetPasswordForm
+from sky_visitor.query_budget import QueryBudgetMixin, query_budget
 from django.contrib.auth.models import User as AuthUser
 from sky_visitor.tests import auth_user_only_test
 from sky_visitor.utils import SubclassedUser
@@ -104,6 +108,46 @@ class TestAuthUserLoginForm(TestLoginFormBase):
         self.assertLoggedIn(user, backend='django.contrib.auth.backends.ModelBackend')
 
 
+@override_settings(SKY_VISITOR_THROTTLE_ENABLED=True, SKY_VISITOR_THROTTLE_RULES={
+    'login': [('ip', 10, 300), ('ip_account', 2, 300)],
+    'forgot_password': [('account', 1, 3600)],
+})
+class TestThrottling(BaseTestCase):
+    view_url = '/user/login/'
+
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_login_should_be_throttled_after_failures(self):
+        data = dict(FIXTURE_USER_DATA, password='wrong')
+        for i in range(2):
+            self.assertEqual(self.client.post(self.view_url, data).status_code, 200)
+        # Rejected before the user is looked up, even with the right password
+        with self.assertNumQueries(0):
+            response = self.client.post(self.view_url, FIXTURE_USER_DATA)
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(response.context_data['form'].non_field_errors())
+        # Other accounts from the same IP are still allowed
+        self.assertEqual(self.client.post(self.view_url, dict(data, username='someoneelse')).status_code, 200)
+
+    def test_successful_login_should_reset_account_counters(self):
+        self.client.post(self.view_url, dict(FIXTURE_USER_DATA, password='wrong'))
+        self.assertRedirected(self.client.post(self.view_url, FIXTURE_USER_DATA), '/')
+        self.client.logout()
+        self.client.post(self.view_url, dict(FIXTURE_USER_DATA, password='wrong'))
+        self.assertRedirected(self.client.post(self.view_url, FIXTURE_USER_DATA), '/')
+
+    def test_forgot_password_should_be_throttled(self):
+        data = {'email': FIXTURE_USER_DATA['email']}
+        self.client.post('/user/forgot_password/', data)
+        response = self.client.post('/user/forgot_password/', data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(mail.outbox), 1)
+
+
 class TestForgotPasswordProcess(BaseTestCase):
 
     # TODO TEST: Token older than X weeks (will require removing hard coded reset URL)
@@ -172,3 +216,74 @@ class TestForgotPasswordProcess(BaseTestCase):
         # Token modified
         response = self.client.get('http://testserver/user/forgot_password/1-35t-d4e092280eb134000671/', follow=True)
         self.assertRedirects(response, '/user/login/')
+
+
+class TestQueryBudgets(QueryBudgetMixin, BaseTestCase):
+    """
+    Holds each view to the queries in query_budgets.json (one file per settings module, since the user model changes
+    the SQL). See QueryBudgetMixin for updating the budgets.
+    """
+    urls = 'example_project.test_urls'
+    query_budget_file = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+
+    def setUp(self):
+        # Tokens used by other tests are remembered as invalid
+        cache.clear()
+
+    def get_token_url(self, view_name, user):
+        return reverse(view_name, kwargs={'uidb36': int_to_base36(user.id), 'token': default_token_generator.make_token(user)})
+
+    @query_budget('register')
+    def test_register(self):
+        data = {
+            'username': 'budgetuser',
+            'email': 'budgetuser@example.com',
+            'password1': 'asdfasdf',
+            'password2': 'asdfasdf',
+        }
+        response = self.client.post('/user/register/', data)
+        self.assertEqual(response.status_code, 302)
+
+    @query_budget('login')
+    def test_login(self):
+        response = self.client.post('/user/login/', FIXTURE_USER_DATA)
+        self.assertEqual(response.status_code, 302)
+
+    @query_budget('forgot_password')
+    def test_forgot_password(self):
+        response = self.client.post('/user/forgot_password/', {'email': FIXTURE_USER_DATA['email']})
+        self.assertEqual(response.status_code, 302)
+
+    def test_forgot_password_change(self):
+        url = self.get_token_url('forgot_password_change', self.default_user)
+        with self.assertQueryBudget('forgot_password_change'):
+            self.assertEqual(self.client.get(url).status_code, 200)
+            response = self.client.post(url, {'new_password1': 'asdfasdf', 'new_password2': 'asdfasdf'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_invitation_complete(self):
+        user = SubclassedUser.objects.create_user('inviteduser', 'inviteduser@example.com')
+        user.is_active = False
+        user.save()
+        url = self.get_token_url('invitation_complete', user)
+        data = {
+            'first_name': 'Invited',
+            'last_name': 'User',
+            'email': 'inviteduser@example.com',
+            'set_password-new_password1': 'asdfasdf',
+            'set_password-new_password2': 'asdfasdf',
+        }
+        with self.assertQueryBudget('invitation_complete'):
+            self.assertEqual(self.client.get(url).status_code, 200)
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(SubclassedUser.objects.get(pk=user.pk).is_active)
+
+    def test_profile_edit(self):
+        self.client.post('/user/login/', FIXTURE_USER_DATA)
+        data = {'first_name': 'Test', 'last_name': 'User', 'email': FIXTURE_USER_DATA['email']}
+        with self.assertQueryBudget('profile_edit'):
+            self.assertEqual(self.client.get('/user/profile/').status_code, 200)
+            response = self.client.post('/user/profile/', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(SubclassedUser.objects.get(pk=self.default_user.pk).first_name, 'Test')
@@ -30,6 +30,7 @@ TESTS_TO_RUN = [
     'username_tests.TestUsernameLoginForm',
     'username_tests.TestUsernameRegister',
     'username_tests.TestUsernameForgotPasswordProcess',
+    'username_tests.TestUsernameQueryBudgets',
 ]
 
 DATABASES = {
@@ -1,5 +1,6 @@
-from example_project.tests import TestRegister, FIXTURE_USER_DATA, TestForgotPasswordProcess, TestLoginFormBase
+from example_project.tests import TestRegister, FIXTURE_USER_DATA, TestForgotPasswordProcess, TestLoginFormBase, TestQueryBudgets
 from sky_visitor.forms import LoginForm, RegisterForm
+import os
 from django.test import TestCase
 from sky_visitor.utils import SubclassedUser
 from django.contrib.auth.models import User as AuthUser
@@ -64,3 +65,5 @@ class TestUsernameRegister(TestRegister):
         self.assertIn('password2', form.errors)
 
 
+class TestUsernameQueryBudgets(TestQueryBudgets):
+    query_budget_file = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
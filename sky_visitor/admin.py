@@ -47,4 +47,5 @@ class EmailUserAdmin(auth_admin.UserAdmin):
     add_form = UserCreateAdminForm
 #    change_password_form = AdminPasswordChangeForm
 
-admin.site.register(User, EmailUserAdmin)
+# The admin registry needs the model class itself rather than the lazy SubclassedUser
+admin.site.register(User.resolve(), EmailUserAdmin)
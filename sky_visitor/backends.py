@@ -12,9 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 from django.contrib.auth import backends, login
+from django.contrib.auth.models import Permission, User as AuthUser
 from django.core.exceptions import ImproperlyConfigured
 from django.core.validators import email_re
+from django.db import connections
+from django.db.models import Q
+from sky_visitor.cache import get_cache_backend, permission_cache, user_cache
+from sky_visitor import metrics
+from sky_visitor.hashing import check_password, dummy_hasher
+from sky_visitor.models import get_email_lookup, normalize_email
+from sky_visitor.settings import get_app_setting
+from sky_visitor import snapshot
 from sky_visitor.utils import SubclassedUser as User
 
 
@@ -29,33 +39,146 @@ def auto_login(request, user):
 
 class BaseBackend(backends.ModelBackend):
     def get_user(self, user_id):
+        return user_cache.get(user_id, self.load_user)
+
+    @metrics.timer('backend.load_user')
+    def load_user(self, user_id):
         try:
             return User.objects.get(pk=user_id)
         except User.DoesNotExist:
             return None
 
+    def check_credentials(self, user, identifier, password):
+        """
+        The end of authenticate() shared by the backends: returns `user` if `password` is theirs, counting the outcome
+        """
+        if user is None:
+            metrics.incr('backend.missing_user')
+            return self.user_missing(identifier, password)
+        if check_password(user, password):
+            metrics.incr('backend.success')
+            return user
+        metrics.incr('backend.wrong_password')
+        return None
 
-class UsernameBackend(BaseBackend):
-    def authenticate(self, username=None, password=None):
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            return None
+    def get_group_permissions(self, user_obj, obj=None):
+        if user_obj.is_anonymous() or obj is not None:
+            return set()
+        return set(self.get_cached_permissions(user_obj)[1])
 
-        if user.check_password(password):
-            return user
+    def get_all_permissions(self, user_obj, obj=None):
+        if user_obj.is_anonymous() or obj is not None:
+            return set()
+        return set(self.get_cached_permissions(user_obj)[0])
+
+    def get_cached_permissions(self, user_obj):
+        """
+        Returns (all permissions, group permissions) of `user_obj`, memoized on the instance like ModelBackend does and
+        kept in the shared permission cache across requests. The memo goes straight into __dict__ so that a SnapshotUser
+        doesn't load the user to look for or store it.
+        """
+        permissions = user_obj.__dict__.get('_sky_visitor_perm_cache')
+        if permissions is None:
+            permissions = permission_cache.get(user_obj.pk, lambda: self.load_permissions(user_obj))
+            user_obj.__dict__['_sky_visitor_perm_cache'] = permissions
+        return permissions
+
+    def load_permissions(self, user_obj):
+        """
+        Same permissions as ModelBackend computes, in two queries
+        """
+        if user_obj.is_superuser:
+            group_perms = Permission.objects.all()
         else:
+            group_perms = Permission.objects.filter(group__user=user_obj.pk)
+        group_perms = set(u"%s.%s" % (ct, name) for ct, name in group_perms.values_list('content_type__app_label', 'codename').order_by())
+        user_perms = Permission.objects.filter(user=user_obj.pk).values_list('content_type__app_label', 'codename').order_by()
+        all_perms = group_perms | set(u"%s.%s" % (ct, name) for ct, name in user_perms)
+        return frozenset(all_perms), frozenset(group_perms)
+
+    def make_snapshot(self, user):
+        """
+        Returns the signed session snapshot of `user` used by SnapshotAuthenticationMiddleware. Override this and
+        get_snapshot_user() to keep other fields.
+        """
+        return snapshot.make_snapshot(user)
+
+    def get_snapshot_user(self, data, loader):
+        return snapshot.SnapshotUser(data, loader)
+
+    def user_missing(self, identifier, password):
+        """
+        Called by authenticate() when no user matches `identifier`. With SKY_VISITOR_DUMMY_HASH_ON_MISS on, it takes as
+        long as checking a password would have: the first miss for an identifier runs a dummy hash, and repeated misses
+        within SKY_VISITOR_MISSING_USER_CACHE_TIMEOUT seconds sleep for the measured cost of one. That keeps the CPU
+        spent on probes for unknown accounts to one hash per identifier per timeout.
+        """
+        if not get_app_setting('SKY_VISITOR_DUMMY_HASH_ON_MISS'):
+            return None
+        timeout = get_app_setting('SKY_VISITOR_MISSING_USER_CACHE_TIMEOUT')
+        if not timeout:
+            dummy_hasher.hash(password)
             return None
+        cache = get_cache_backend(get_app_setting('SKY_VISITOR_USER_CACHE_ALIAS'))
+        key = 'sky_visitor.missing_user.%s.%s' % (self.__class__.__name__,
+                                                  hashlib.md5(unicode(identifier).encode('utf-8')).hexdigest())
+        if cache.get(key):
+            dummy_hasher.wait(password)
+        else:
+            dummy_hasher.hash(password)
+            cache.set(key, True, timeout)
+        return None
+
+
+class UsernameBackend(BaseBackend):
+    def authenticate(self, username=None, password=None):
+        with metrics.timer('backend.lookup'):
+            try:
+                user = User.objects.get(username=username)
+            except User.DoesNotExist:
+                user = None
+        return self.check_credentials(user, username, password)
 
 
 class EmailBackend(BaseBackend):
     def authenticate(self, email=None, password=None):
-        try:
-            user = User.objects.get(email=email)
-        except User.DoesNotExist:
-            return None
+        with metrics.timer('backend.lookup'):
+            try:
+                user = User.objects.get(**get_email_lookup(User, email))
+            except User.DoesNotExist:
+                user = None
+        return self.check_credentials(user, normalize_email(email), password)
 
-        if user.check_password(password):
-            return user
-        else:
+
+class UsernameOrEmailBackend(BaseBackend):
+    """
+    Authenticates with either a username or an email address, passed as `identifier`. The user is found with a single
+    query (an OR of the username and email lookups, the latter only when `identifier` looks like an email address,
+    ordered so that an exact username match comes first) and the password is checked at most once. Use it instead of
+    listing both UsernameBackend and EmailBackend.
+    """
+
+    def authenticate(self, identifier=None, password=None):
+        return self.check_credentials(self.get_user_by_identifier(identifier), identifier, password)
+
+    @metrics.timer('backend.lookup')
+    def get_user_by_identifier(self, identifier):
+        if not identifier:
             return None
+        if '@' not in identifier:
+            try:
+                return User.objects.get(username=identifier)
+            except User.DoesNotExist:
+                return None
+        queryset = User.objects.filter(Q(username=identifier) | Q(**get_email_lookup(User, identifier)))
+        # An exact username match wins over other users' email addresses, so it must not be cut off by the LIMIT
+        username_column = '%s.%s' % (connections[queryset.db].ops.quote_name(AuthUser._meta.db_table),
+                                     connections[queryset.db].ops.quote_name(AuthUser._meta.get_field('username').column))
+        users = list(queryset.extra(select={'is_username_match': '%s = %%s' % username_column}, select_params=[identifier],
+                                    order_by=['-is_username_match'])[:2])
+        if users and users[0].username == identifier:
+            return users[0]
+        if len(users) == 1:
+            return users[0]
+        # Nothing matched, or the email address is shared by several users
+        return None
@@ -0,0 +1,336 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import platform
+import sys
+import threading
+import time
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.utils.http import int_to_base36
+from django.utils.importlib import import_module
+from sky_visitor.hashing_policy import policy
+from sky_visitor.utils import SubclassedUser as User
+from sky_visitor.views import LoginView, ForgotPasswordChangeView
+
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+# Named load profiles, so that runs of the same profile are comparable between releases
+PROFILES = {
+    'smoke': {'concurrency': 1, 'iterations': 5},
+    'default': {'concurrency': 4, 'iterations': 50},
+    'stress': {'concurrency': 16, 'iterations': 200},
+}
+
+FLOWS = ('register', 'login', 'logout', 'forgot_password', 'token_change')
+
+PERCENTILES = (50, 95, 99)
+
+
+class FlowFailure(Exception):
+    """
+    Raised by a flow when one of its steps is refused, e.g. a setup login. Counted as an error; anything else is a bug
+    and stops the benchmark.
+    """
+
+
+def percentile(values, percent):
+    """
+    Returns the nearest-rank `percent` percentile of `values`, or None when there are none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class HashTimer(object):
+    """
+    Adds up, per thread, the time spent in the encode() of the configured password hashers while installed. Hashes run
+    in another thread or process by the hashing executor aren't seen.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._originals = {}
+
+    def get_hasher_classes(self):
+        classes = []
+        for path in settings.PASSWORD_HASHERS:
+            module_name, class_name = path.rsplit('.', 1)
+            classes.append(getattr(import_module(module_name), class_name))
+        return classes
+
+    def install(self):
+        for cls in self.get_hasher_classes():
+            if cls in self._originals:
+                continue
+            self._originals[cls] = cls.__dict__.get('encode')
+            cls.encode = self.wrap(cls.encode)
+
+    def uninstall(self):
+        for cls, original in self._originals.items():
+            if original is None:
+                del cls.encode
+            else:
+                cls.encode = original
+        self._originals = {}
+
+    def wrap(self, encode):
+        timer = self
+
+        def timed_encode(self, *args, **kwargs):
+            started_at = time.time()
+            try:
+                return encode(self, *args, **kwargs)
+            finally:
+                timer.add(time.time() - started_at)
+        return timed_encode
+
+    def add(self, seconds):
+        self._local.total = getattr(self._local, 'total', 0.0) + seconds
+
+    def take(self):
+        """
+        Returns the time added in this thread since the last call
+        """
+        total = getattr(self._local, 'total', 0.0)
+        self._local.total = 0.0
+        return total
+
+
+class FlowRun(object):
+    """
+    One worker's client for one flow. request() is timed and its queries counted; setup requests go through `client`.
+    """
+
+    def __init__(self, benchmark, flow, worker):
+        self.benchmark = benchmark
+        self.flow = flow
+        self.worker = worker
+        self.client = Client()
+        self.samples = []
+        self.errors = 0
+        self.exc_info = None
+
+    def request(self, method, path, data=None, expected_status=302):
+        hash_timer = self.benchmark.hash_timer
+        hash_timer.take()
+        started_at = time.time()
+        response = getattr(self.client, method)(path, data or {})
+        seconds = time.time() - started_at
+        # The test client resets connection.queries when the request starts
+        self.samples.append((seconds, len(connection.queries), hash_timer.take()))
+        if response.status_code != expected_status:
+            self.errors += 1
+        return response
+
+
+class Benchmark(object):
+    """
+    Runs the authentication flows through the test client against the current database, `iterations` times each,
+    split between `concurrency` threads, and returns latency percentiles, queries per request and hashing time per flow.
+
+    Users are created up front (not timed) under the "bench" prefix. On SQLite, concurrency above 1 needs a database
+    file every thread can open; the sky_visitor_benchmark command takes care of that.
+    """
+
+    def __init__(self, concurrency=1, iterations=10, flows=FLOWS, prefix='bench'):
+        self.concurrency = concurrency
+        self.iterations = iterations
+        self.flows = flows
+        self.prefix = prefix
+        self.hash_timer = HashTimer()
+
+    def get_identifier_field(self):
+        form_class = LoginView().get_form_class()
+        return [name for name in form_class.base_fields if name != 'password'][0]
+
+    def make_email(self, flow, worker, i):
+        return '%s-%s-%d-%d@example.com' % (self.prefix, flow, worker, i)
+
+    def make_username(self, flow, worker, i):
+        return '%s_%s_%d_%d' % (self.prefix, flow, worker, i)
+
+    def create_user(self, flow, worker, i):
+        return User.objects.create_user(self.make_username(flow, worker, i), self.make_email(flow, worker, i),
+                                        BENCHMARK_PASSWORD)
+
+    def get_login_data(self, user):
+        field = self.get_identifier_field()
+        return {field: user.email if field == 'email' else user.username, 'password': BENCHMARK_PASSWORD}
+
+    def get_worker_iterations(self, worker):
+        share, remainder = divmod(self.iterations, self.concurrency)
+        return share + (1 if worker < remainder else 0)
+
+    # Flows. Each runs one iteration as `run`'s client.
+
+    def flow_register(self, run, i):
+        email = self.make_email('register', run.worker, i)
+        run.request('post', reverse('register'), {
+            'username': self.make_username('register', run.worker, i),
+            'email': email,
+            'password1': BENCHMARK_PASSWORD,
+            'password2': BENCHMARK_PASSWORD,
+        })
+        run.client.logout()
+
+    def flow_login(self, run, i):
+        run.request('post', reverse('login'), self.get_login_data(run.user))
+        run.client.logout()
+
+    def flow_logout(self, run, i):
+        if not run.client.login(**self.get_login_data(run.user)):
+            raise FlowFailure("Setup login refused for %s" % run.user.username)
+        run.request('get', reverse('logout'), expected_status=301)
+
+    def flow_forgot_password(self, run, i):
+        run.request('post', reverse('forgot_password'), {'email': run.user.email})
+
+    def flow_token_change(self, run, i):
+        user = User.objects.get(pk=run.users[i].pk)
+        token = ForgotPasswordChangeView().get_token_generator().make_token(user)
+        path = reverse('forgot_password_change', kwargs={'uidb36': int_to_base36(user.pk), 'token': token})
+        run.request('get', path, expected_status=200)
+        run.request('post', path, {'new_password1': BENCHMARK_PASSWORD, 'new_password2': BENCHMARK_PASSWORD})
+        run.client.logout()
+
+    def prepare(self, run):
+        iterations = self.get_worker_iterations(run.worker)
+        if run.flow in ('login', 'logout', 'forgot_password'):
+            run.user = self.create_user(run.flow, run.worker, 0)
+        elif run.flow == 'token_change':
+            run.users = [self.create_user(run.flow, run.worker, i) for i in range(iterations)]
+        return iterations
+
+    def run_worker(self, run, iterations):
+        flow = getattr(self, 'flow_%s' % run.flow)
+        connection.use_debug_cursor = True
+        try:
+            for i in range(iterations):
+                try:
+                    flow(run, i)
+                except FlowFailure:
+                    run.errors += 1
+        except Exception:
+            if self.concurrency == 1:
+                raise
+            # Handed to run_flow, which re-raises it in the main thread
+            run.exc_info = sys.exc_info()
+        finally:
+            connection.use_debug_cursor = None
+            if self.concurrency > 1:
+                connection.close()
+
+    def run_flow(self, flow):
+        runs = [FlowRun(self, flow, worker) for worker in range(self.concurrency)]
+        iterations = [self.prepare(run) for run in runs]
+        started_at = time.time()
+        if self.concurrency == 1:
+            self.run_worker(runs[0], iterations[0])
+        else:
+            threads = [threading.Thread(target=self.run_worker, args=(run, n)) for run, n in zip(runs, iterations)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for run in runs:
+                if run.exc_info is not None:
+                    raise run.exc_info[0], run.exc_info[1], run.exc_info[2]
+        elapsed = time.time() - started_at
+        return self.summarize(runs, elapsed)
+
+    def summarize(self, runs, elapsed):
+        samples = [sample for run in runs for sample in run.samples]
+        latencies = [seconds for seconds, queries, hash_seconds in samples]
+        queries = [queries for seconds, queries, hash_seconds in samples]
+        hash_seconds = sum(hash_seconds for seconds, queries, hash_seconds in samples)
+        requests = len(latencies)
+        result = {
+            'requests': requests,
+            'errors': sum(run.errors for run in runs),
+            'seconds': elapsed,
+            'requests_per_second': requests / elapsed if elapsed else None,
+            'latency': dict(('p%d' % p, percentile(latencies, p)) for p in PERCENTILES),
+            'queries_per_request': float(sum(queries)) / requests if requests else None,
+            'max_queries': max(queries) if queries else None,
+            'hash_seconds': hash_seconds,
+            'hash_seconds_per_request': hash_seconds / requests if requests else None,
+        }
+        result['latency']['mean'] = sum(latencies) / requests if requests else None
+        return result
+
+    def get_environment(self):
+        hasher = get_hasher()
+        return {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'user_model': '%s.%s' % (User._meta.app_label, User._meta.object_name),
+            'authentication_backends': list(settings.AUTHENTICATION_BACKENDS),
+            'hasher': hasher.algorithm,
+            'hash_iterations': policy.get_iterations(),
+        }
+
+    def run(self):
+        self.hash_timer.install()
+        try:
+            results = {
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'concurrency': self.concurrency,
+                'iterations': self.iterations,
+                'environment': self.get_environment(),
+                'flows': {},
+            }
+            for flow in self.flows:
+                results['flows'][flow] = self.run_flow(flow)
+            return results
+        finally:
+            self.hash_timer.uninstall()
+
+
+def format_result(flow, result):
+    """
+    Returns the one line summary of `result` printed by the sky_visitor_benchmark command. Figures of a flow without
+    samples show as n/a.
+    """
+    def milliseconds(seconds):
+        return 'n/a' if seconds is None else '%.1f ms' % (seconds * 1000)
+    latency = result['latency']
+    queries = result['queries_per_request']
+    return "%-16s p50 %10s  p95 %10s  p99 %10s  %5s queries  %10s hashing  %d errors" % (
+        flow, milliseconds(latency['p50']), milliseconds(latency['p95']), milliseconds(latency['p99']),
+        'n/a' if queries is None else '%.1f' % queries, milliseconds(result['hash_seconds_per_request']),
+        result['errors'])
+
+
+def compare(previous, current, threshold):
+    """
+    Returns a line for each flow whose p95 latency in `current` is more than `threshold` (a fraction) above `previous`
+    """
+    regressions = []
+    for flow, result in sorted(current['flows'].items()):
+        before = previous.get('flows', {}).get(flow, {}).get('latency', {}).get('p95')
+        after = result['latency']['p95']
+        if before and after and after > before * (1 + threshold):
+            regressions.append("%s: p95 %.1f ms -> %.1f ms (+%d%%)"
+                               % (flow, before * 1000, after * 1000, round((after / before - 1) * 100)))
+    return regressions
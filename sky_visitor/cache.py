@@ -0,0 +1,314 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import binascii
+import os
+import threading
+from django.core.cache import get_cache
+from django.core.signals import request_started, request_finished
+from django.test.signals import setting_changed
+from sky_visitor.settings import get_app_setting
+
+
+_cache_backends = {}
+_cache_backends_lock = threading.Lock()
+
+
+def get_cache_backend(alias):
+    """
+    Returns the backend of cache `alias`, created on first use and shared by the whole process. Django 1.4's get_cache()
+    builds a new backend (and for memcached a new client) on every call.
+    """
+    try:
+        return _cache_backends[alias]
+    except KeyError:
+        with _cache_backends_lock:
+            if alias not in _cache_backends:
+                _cache_backends[alias] = get_cache(alias)
+            return _cache_backends[alias]
+
+
+def reset_cache_backends(setting=None, **kwargs):
+    if setting is None or setting == 'CACHES':
+        _cache_backends.clear()
+
+setting_changed.connect(reset_cache_backends, dispatch_uid='sky_visitor.cache.reset_cache_backends')
+
+
+# How long generation and version tokens are kept. Explicit because a timeout of None means the backend's default
+# (usually 300 seconds) in Django 1.4, not "forever".
+GENERATION_TIMEOUT = 60 * 60 * 24 * 365
+
+
+def new_token():
+    return binascii.hexlify(os.urandom(8))
+
+
+# Every UserCache, so that a change to a user can be propagated to all of them
+user_caches = []
+
+
+def invalidate_user(user_id):
+    for cache in user_caches:
+        cache.invalidate(user_id)
+
+
+class UserCache(object):
+    """
+    Caches user objects at two levels: a memo that lives for the duration of a single request and a shared entry in
+    the cache framework that lives across requests (only when the <setting_prefix>_ENABLED setting is True).
+
+    Every shared entry is tagged with the generation of the user it belongs to, a random token that invalidate()
+    replaces, so an entry written by a request that loaded the user before the invalidation is never served afterwards.
+    """
+    key_prefix = 'sky_visitor.user'
+    setting_prefix = 'SKY_VISITOR_USER_CACHE'
+
+    def __init__(self, key_prefix=None, setting_prefix=None):
+        if key_prefix is not None:
+            self.key_prefix = key_prefix
+        if setting_prefix is not None:
+            self.setting_prefix = setting_prefix
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset_stats()
+        user_caches.append(self)
+        request_started.connect(self.start_request, weak=False, dispatch_uid='%s.start_request' % self.key_prefix)
+        request_finished.connect(self.finish_request, weak=False, dispatch_uid='%s.finish_request' % self.key_prefix)
+
+    def is_enabled(self):
+        return get_app_setting('%s_ENABLED' % self.setting_prefix)
+
+    def get_cache(self):
+        return get_cache_backend(get_app_setting('%s_ALIAS' % self.setting_prefix))
+
+    def get_timeout(self):
+        return get_app_setting('%s_TIMEOUT' % self.setting_prefix)
+
+    def get_version(self):
+        return get_app_setting('%s_VERSION' % self.setting_prefix)
+
+    def make_keys(self, user_id):
+        """
+        Returns the (generation key, entry key) pair for `user_id`
+        """
+        return '%s.generation.%s' % (self.key_prefix, user_id), '%s.entry.%s' % (self.key_prefix, user_id)
+
+    def start_request(self, **kwargs):
+        self._local.memo = {}
+
+    def finish_request(self, **kwargs):
+        self._local.memo = None
+
+    def get_request_memo(self):
+        """
+        Returns the memo for the current request, or None when called outside of a request (management commands,
+        task queues, etc.) so that long running processes never hold on to stale users.
+        """
+        return getattr(self._local, 'memo', None)
+
+    def get(self, user_id, loader):
+        """
+        Returns the user with primary key `user_id`, calling `loader(user_id)` only when no level of the cache has it.
+        """
+        memo = self.get_request_memo()
+        if memo is not None and user_id in memo:
+            self.count('request_hits')
+            return memo[user_id]
+
+        if self.is_enabled():
+            cache = self.get_cache()
+            version = self.get_version()
+            generation_key, entry_key = self.make_keys(user_id)
+            values = cache.get_many([generation_key, entry_key], version=version)
+            generation = values.get(generation_key)
+            entry = values.get(entry_key)
+            if generation is not None and entry is not None and entry[0] == generation:
+                self.count('shared_hits')
+                user = entry[1]
+            else:
+                self.count('misses')
+                user = loader(user_id)
+                if generation is None:
+                    generation = new_token()
+                    # add() fails when invalidate() ran while the user was loading: don't cache what may be stale
+                    if not cache.add(generation_key, generation, GENERATION_TIMEOUT, version=version):
+                        generation = None
+                if user is not None and generation is not None:
+                    cache.set(entry_key, (generation, user), self.get_timeout(), version=version)
+        else:
+            self.count('misses')
+            user = loader(user_id)
+
+        if memo is not None:
+            memo[user_id] = user
+        return user
+
+    def invalidate(self, user_id):
+        memo = self.get_request_memo()
+        if memo is not None:
+            memo.pop(user_id, None)
+        if self.is_enabled():
+            cache = self.get_cache()
+            version = self.get_version()
+            generation_key, entry_key = self.make_keys(user_id)
+            # A new random token rather than an increment, so a generation that expired or was evicted never comes back
+            # with a value some surviving entry is tagged with
+            cache.set(generation_key, new_token(), GENERATION_TIMEOUT, version=version)
+            cache.delete(entry_key, version=version)
+            self.count('invalidations')
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'request_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+user_cache = UserCache()
+# Users loaded by TokenValidateMixin, kept briefly so the GET and POST of a token URL load the user once
+token_user_cache = UserCache('sky_visitor.token_user', 'SKY_VISITOR_TOKEN_USER_CACHE')
+
+
+class VersionCounter(object):
+    """
+    A version token per key, kept in the SKY_VISITOR_USER_CACHE_ALIAS cache, that changes every time bump() is called.
+    Copies of data tagged with the token they were made at can be checked for staleness with one cache read.
+
+    Tokens are random rather than incrementing, so a token that is evicted from the cache is replaced by a new one and
+    everything tagged with the old one becomes stale, instead of the count starting over at a value that was used before.
+    """
+
+    def __init__(self, key_prefix):
+        self.key_prefix = key_prefix
+
+    def get_cache(self):
+        return get_cache_backend(get_app_setting('SKY_VISITOR_USER_CACHE_ALIAS'))
+
+    def make_key(self, name):
+        return '%s.%s' % (self.key_prefix, name)
+
+    def get_many(self, names):
+        """
+        Returns {name: token} for each of `names`, creating tokens that are missing
+        """
+        return dict(zip(names, get_version_tokens([(self, name) for name in names])))
+
+    def get(self, name):
+        return self.get_many([name])[name]
+
+    def bump(self, name):
+        self.get_cache().set(self.make_key(name), new_token(), GENERATION_TIMEOUT)
+
+
+def get_version_tokens(counters_and_names):
+    """
+    Returns the token of each (VersionCounter, name) pair in `counters_and_names`, in order, read with one get_many()
+    from the SKY_VISITOR_USER_CACHE_ALIAS cache that every VersionCounter shares. Missing tokens are created.
+    """
+    cache = get_cache_backend(get_app_setting('SKY_VISITOR_USER_CACHE_ALIAS'))
+    keys = [counter.make_key(name) for counter, name in counters_and_names]
+    tokens = cache.get_many(keys)
+    result = []
+    for key in keys:
+        token = tokens.get(key)
+        if token is None:
+            token = new_token()
+            # add() so that concurrent requests agree on one token
+            if not cache.add(key, token, GENERATION_TIMEOUT):
+                token = cache.get(key) or token
+            tokens[key] = token
+        result.append(token)
+    return result
+
+
+# Changes whenever a user is saved or deleted
+user_generations = VersionCounter('sky_visitor.user_generation')
+# Changes whenever the permissions or groups of a user change (keyed by user id), or those of any group or the set of
+# permissions itself (keyed 'groups')
+permission_versions = VersionCounter('sky_visitor.permission_version')
+
+
+def get_user_versions(user_id):
+    """
+    Returns the (generation, permission version) of the user, read with one cache round trip. See
+    get_permission_version().
+    """
+    generation, user_version, groups_version = get_version_tokens(
+        [(user_generations, user_id), (permission_versions, user_id), (permission_versions, 'groups')])
+    return generation, '%s.%s.%s' % (generation, user_version, groups_version)
+
+
+def get_permission_version(user_id):
+    """
+    Returns a token that changes whenever the permissions of the user might have: when the user is saved (is_superuser,
+    is_active), its permissions or groups change, or any group's permissions change
+    """
+    return get_user_versions(user_id)[1]
+
+
+class PermissionCache(object):
+    """
+    Keeps the permission sets computed by BaseBackend in the shared cache (when SKY_VISITOR_PERMISSION_CACHE_ENABLED is
+    True), tagged with get_permission_version(), so that a change to any of the user's permissions is seen on the next
+    lookup.
+    """
+    key_prefix = 'sky_visitor.permissions'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def is_enabled(self):
+        return get_app_setting('SKY_VISITOR_PERMISSION_CACHE_ENABLED')
+
+    def get(self, user_id, loader):
+        """
+        Returns the permissions of user `user_id`, calling `loader()` when the cache has no current entry
+        """
+        if not self.is_enabled():
+            return loader()
+        cache = get_cache_backend(get_app_setting('SKY_VISITOR_USER_CACHE_ALIAS'))
+        # Read the version before loading, so a change made while loading leaves an entry that is already stale
+        version = get_permission_version(user_id)
+        key = '%s.%s' % (self.key_prefix, user_id)
+        entry = cache.get(key)
+        if entry is not None and entry[0] == version:
+            self.count('hits')
+            return entry[1]
+        self.count('misses')
+        value = loader()
+        cache.set(key, (version, value), get_app_setting('SKY_VISITOR_PERMISSION_CACHE_TIMEOUT'))
+        return value
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'hits': 0, 'misses': 0}
+
+
+permission_cache = PermissionCache()
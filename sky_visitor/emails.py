@@ -16,18 +16,134 @@ from django.conf import settings
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.sites.models import get_current_site
 from django.core.exceptions import ImproperlyConfigured
-from django.core.mail import send_mail
-from django.core.urlresolvers import reverse
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.urlresolvers import reverse, get_urlconf, NoReverseMatch
 from django.template import loader
 from django.template.context import Context
+from django.test.signals import setting_changed
 from django.utils.http import int_to_base36
+from sky_visitor import metrics
+from sky_visitor.outbox import enqueue
+from sky_visitor.settings import get_app_setting
+
+# Placeholders reversed in place of the real uidb36 and token. Both match TOKEN_REGEX in sky_visitor.urls.
+UIDB36_PLACEHOLDER = 'SKYVISITORUID'
+TOKEN_PLACEHOLDER = 'SKYVISITOR-TOKENPLACEHOLDER'
+# Rendered in place of {{ content }} in HTML layouts, then split on to get the parts before and after the content
+LAYOUT_CONTENT_PLACEHOLDER = 'SKYVISITORLAYOUTCONTENT'
+# The only context available to HTML layouts. They are the same for every recipient, which is what makes caching possible.
+LAYOUT_CONTEXT_KEYS = ('site_name', 'domain', 'protocol')
+
+# Process-wide caches of compiled email templates and of reversed token URLs (with placeholders). The compiled templates
+# are only valid for the template loaders that produced them.
+_template_cache = {}
+_template_cache_loaders = None
+_token_url_cache = {}
+_layout_cache = {}
+
+
+def is_email_cache_enabled():
+    enabled = get_app_setting('SKY_VISITOR_EMAIL_TEMPLATE_CACHE')
+    if enabled is None:
+        return not settings.DEBUG
+    return enabled
+
+
+def clear_email_caches(**kwargs):
+    global _template_cache_loaders
+    _template_cache.clear()
+    _template_cache_loaders = None
+    _token_url_cache.clear()
+    _layout_cache.clear()
+
+
+def clear_email_caches_on_setting_change(setting, **kwargs):
+    if setting.startswith('TEMPLATE') or setting in ('ROOT_URLCONF', 'SKY_VISITOR_EMAIL_TEMPLATE_CACHE'):
+        clear_email_caches()
+
+setting_changed.connect(clear_email_caches_on_setting_change, dispatch_uid='sky_visitor.emails.clear_email_caches')
+
+
+def get_email_template(template_name):
+    """
+    Same as loader.get_template(), but compiled templates are kept for the life of the process unless
+    SKY_VISITOR_EMAIL_TEMPLATE_CACHE is False (it defaults to off when DEBUG is on, so template edits show up right away).
+    The cache is thrown away whenever Django resets its template loaders.
+    """
+    global _template_cache_loaders
+    if not is_email_cache_enabled():
+        return loader.get_template(template_name)
+    if _template_cache_loaders is not loader.template_source_loaders:
+        _template_cache.clear()
+    try:
+        return _template_cache[template_name]
+    except KeyError:
+        template = loader.get_template(template_name)
+        _template_cache[template_name] = template
+        _template_cache_loaders = loader.template_source_loaders
+        return template
+
+
+def reverse_token_url(view_name, uidb36, token):
+    """
+    Same as reverse(view_name, kwargs={'uidb36': uidb36, 'token': token}), but the URL is only resolved once per view
+    name and URLconf. Later calls substitute the values into the cached result.
+    """
+    if not is_email_cache_enabled():
+        return reverse(view_name, kwargs={'uidb36': uidb36, 'token': token})
+    key = (view_name, get_urlconf())
+    try:
+        url = _token_url_cache[key]
+    except KeyError:
+        try:
+            url = reverse(view_name, kwargs={'uidb36': UIDB36_PLACEHOLDER, 'token': TOKEN_PLACEHOLDER})
+        except NoReverseMatch:
+            # The URL pattern doesn't accept the placeholders. Resolve it every time instead.
+            url = None
+        _token_url_cache[key] = url
+    if url is None:
+        return reverse(view_name, kwargs={'uidb36': uidb36, 'token': token})
+    return url.replace(UIDB36_PLACEHOLDER, uidb36).replace(TOKEN_PLACEHOLDER, token)
+
+
+def render_layout(template_name, context_data):
+    """
+    Returns the (head, tail) of HTML layout `template_name` rendered around its {{ content }} variable. Each layout is
+    rendered once per combination of LAYOUT_CONTEXT_KEYS values when the email cache is enabled.
+    """
+    layout_context = dict((key, context_data.get(key)) for key in LAYOUT_CONTEXT_KEYS)
+    key = (template_name,) + tuple(layout_context[key] for key in LAYOUT_CONTEXT_KEYS)
+    cache_enabled = is_email_cache_enabled()
+    if cache_enabled and key in _layout_cache:
+        return _layout_cache[key]
+    layout_context['content'] = LAYOUT_CONTENT_PLACEHOLDER
+    rendered = get_email_template(template_name).render(Context(layout_context))
+    if rendered.count(LAYOUT_CONTENT_PLACEHOLDER) != 1:
+        raise ImproperlyConfigured("The email layout %s must contain {{ content }} exactly once." % template_name)
+    head, tail = rendered.split(LAYOUT_CONTENT_PLACEHOLDER)
+    if cache_enabled:
+        _layout_cache[key] = (head, tail)
+    return head, tail
 
 
 class TokenTemplateEmail(object):
+    """
+    Renders and sends an email containing a one-time token URL.
+
+    The plain text body is rendered from `email_template_name`. Give `html_email_template_name` to also send an HTML
+    alternative. The HTML template only needs to render the per-recipient part of the message: when
+    `html_layout_template_name` is given as well, the result is inserted into that layout's {{ content }}, and the
+    layout itself is rendered once rather than once per recipient. `subject_template_name` renders the subject (on a
+    single line) instead of using `subject`.
+    """
 
-    def __init__(self, user, email_template_name=None, token_view_name=None, request=None, protocol='http', domain='localhost', subject=None, from_email=None, token_generator=default_token_generator):
+    def __init__(self, user, email_template_name=None, token_view_name=None, request=None, protocol='http', domain='localhost', subject=None, from_email=None, token_generator=default_token_generator,
+                 html_email_template_name=None, html_layout_template_name=None, subject_template_name=None):
         self.user = user
         self.email_template_name = email_template_name
+        self.html_email_template_name = html_email_template_name
+        self.html_layout_template_name = html_layout_template_name
+        self.subject_template_name = subject_template_name
         self.token_view_name = token_view_name
         self.request = request
         self.protocol = protocol
@@ -49,6 +165,20 @@ class TokenTemplateEmail(object):
     def get_subject(self):
         return self.subject
 
+    def render_subject(self, context_data):
+        if self.subject_template_name is None:
+            return self.get_subject()
+        subject = get_email_template(self.subject_template_name).render(Context(context_data))
+        # Email subject *must not* contain newlines
+        return ''.join(subject.splitlines()).strip()
+
+    def render_html(self, context_data):
+        html = get_email_template(self.html_email_template_name).render(Context(context_data))
+        if self.html_layout_template_name is None:
+            return html
+        head, tail = render_layout(self.html_layout_template_name, context_data)
+        return ''.join((head, html, tail))
+
     def get_email_template_name(self):
         if self.email_template_name is None:
             raise ImproperlyConfigured("No email_template_name. Please provide an email_template_name in the view class.")
@@ -57,7 +187,7 @@ class TokenTemplateEmail(object):
 
     def get_complete_token_url_path(self, uidb36, token):
         if self.token_view_name:
-            return reverse(self.token_view_name, kwargs={'uidb36': uidb36, 'token': token})
+            return reverse_token_url(self.token_view_name, uidb36, token)
         else:
             raise ImproperlyConfigured("No token_view_name. Please provide a token_view_name in the view class or "
                                         "override get_complete_token_url_path().")
@@ -81,17 +211,37 @@ class TokenTemplateEmail(object):
             'site_name': self.get_site_name(),
             'uid': int_to_base36(self.user.id),
             'user': self.user,
-            'token': self.get_token_generator().make_token(self.user),
             'protocol': self.protocol,
         }
+        with metrics.timer('tokens.make'):
+            context_data['token'] = self.get_token_generator().make_token(self.user)
         context_data['token_url_path'] = self.get_complete_token_url_path(uidb36=context_data['uid'], token=context_data['token'])
         context_data['token_url'] = '%s://%s%s' % (context_data['protocol'], context_data['domain'], context_data['token_url_path'])
         return context_data
 
-    def send_email(self):
+    @metrics.timer('email.render')
+    def get_message(self, connection=None):
         """
-        This plus get_context_data() is effectively the same email sending process as auth.forms.PasswordResetForm.save()
+        This plus get_context_data() is effectively the same email rendering process as auth.forms.PasswordResetForm.save()
         """
-        t = loader.get_template(self.get_email_template_name())
+        t = get_email_template(self.get_email_template_name())
         context_data = self.get_context_data()
-        return send_mail(self.get_subject(), t.render(Context(context_data)), self.get_from_email(), [context_data['email']])
+        subject = self.render_subject(context_data)
+        body = t.render(Context(context_data))
+        if self.html_email_template_name is None:
+            return EmailMessage(subject, body, self.get_from_email(), [context_data['email']], connection=connection)
+        message = EmailMultiAlternatives(subject, body, self.get_from_email(), [context_data['email']], connection=connection)
+        message.attach_alternative(self.render_html(context_data), 'text/html')
+        return message
+
+    def send_email(self, connection=None):
+        """
+        Sends the email right away, or stores it in the outbox when SKY_VISITOR_EMAIL_DELIVERY is 'queue'
+        """
+        message = self.get_message(connection=connection)
+        if get_app_setting('SKY_VISITOR_EMAIL_DELIVERY') == 'queue':
+            enqueue(message)
+            metrics.incr('email.queued')
+            return 1
+        with metrics.timer('email.send'):
+            return message.send()
@@ -14,4 +14,8 @@
 
 
 class Http403(Exception):
-    pass
+
+    def __init__(self, *args, **kwargs):
+        # Extra context for 403.html. A 403 with context is always rendered with a full RequestContext.
+        self.context = kwargs.pop('context', None)
+        super(Http403, self).__init__(*args, **kwargs)
@@ -16,9 +16,11 @@ from django import forms
 from django.conf import settings
 from django.contrib.auth import forms as auth_forms, authenticate
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.auth.models import User as AuthUser
+from django.contrib.auth.models import User as AuthUser, UNUSABLE_PASSWORD
 from sky_visitor.utils import SubclassedUser as User
 from sky_visitor.forms.fields import UniqueRequiredEmailField, PasswordRulesField
+from sky_visitor.hashing import check_password, set_password, HashingQueueFull
+from sky_visitor.models import get_email_lookup
 
 
 class NameRequiredMixin(object):
@@ -29,6 +31,24 @@ class NameRequiredMixin(object):
             self.fields['last_name'].required = True
 
 
+class UniqueEmailFormMixin(object):
+    """
+    Passes the result of UniqueRequiredEmailField's uniqueness query on to the model instance, so that the instance's
+    clean() and save() don't query the database for the same email address again. When editing an existing user, the
+    user's own address doesn't count as taken.
+    """
+    def __init__(self, *args, **kwargs):
+        super(UniqueEmailFormMixin, self).__init__(*args, **kwargs)
+        if isinstance(self.fields.get('email'), UniqueRequiredEmailField) and self.instance.pk is not None:
+            self.fields['email'].exclude_id = self.instance.pk
+
+    def _post_clean(self):
+        email = self.cleaned_data.get('email')
+        if email and isinstance(self.fields.get('email'), UniqueRequiredEmailField) and hasattr(self.instance, 'mark_email_unique'):
+            self.instance.mark_email_unique(email)
+        super(UniqueEmailFormMixin, self)._post_clean()
+
+
 class RegisterBasicForm(auth_forms.UserCreationForm):
     """
     Use the default contrib.auth form here and change the model to our SubclassedUser
@@ -47,7 +67,7 @@ class RegisterForm(RegisterBasicForm):
         fields = ['username', 'email']
 
 
-class EmailRegisterForm(forms.ModelForm):
+class EmailRegisterForm(UniqueEmailFormMixin, forms.ModelForm):
     error_messages = {
         'password_mismatch': _("The two password fields didn't match."),
     }
@@ -71,13 +91,13 @@ class EmailRegisterForm(forms.ModelForm):
 
     def save(self, commit=True):
         user = super(EmailRegisterForm, self).save(commit=False)
-        user.set_password(self.cleaned_data["password1"])
+        set_password(user, self.cleaned_data["password1"])
         if commit:
             user.save()
         return user
 
 
-class UserCreateAdminForm(forms.ModelForm):
+class UserCreateAdminForm(UniqueEmailFormMixin, forms.ModelForm):
     # TODO: Make email and non-email version
     password1 = PasswordRulesField(label=_("Password"))
     username = None
@@ -105,19 +125,19 @@ class UserCreateAdminForm(forms.ModelForm):
 
     def save(self, commit=True):
         user = super(UserCreateAdminForm, self).save(commit=False)
-        user.set_password(self.cleaned_data["password1"])
+        set_password(user, self.cleaned_data["password1"])
         if commit:
             user.save()
         return user
 
 
-class UserChangeAdminForm(auth_forms.UserChangeForm):
+class UserChangeAdminForm(UniqueEmailFormMixin, auth_forms.UserChangeForm):
     email = UniqueRequiredEmailField()
     # TODO: Need a way to have a username-based option and an email-based option
 
 
 # TODO: Inheriting from this form creates a auth.User instead of a subclassed User. Fix that.
-class RegisterForm(auth_forms.UserCreationForm):
+class RegisterForm(UniqueEmailFormMixin, auth_forms.UserCreationForm):
     # TODO: Make email and non-email version
     email = UniqueRequiredEmailField()
 
@@ -126,7 +146,7 @@ class RegisterForm(auth_forms.UserCreationForm):
         fields = ['username', 'email']
 
 
-class InvitationForm(forms.ModelForm):
+class InvitationForm(UniqueEmailFormMixin, forms.ModelForm):
     # TODO: Make email and non-email version
     email = UniqueRequiredEmailField()
 
@@ -146,6 +166,12 @@ class InvitationForm(forms.ModelForm):
 class SetPasswordForm(auth_forms.SetPasswordForm):
     new_password1 = PasswordRulesField(label=_("New password"))
 
+    def save(self, commit=True):
+        set_password(self.user, self.cleaned_data['new_password1'])
+        if commit:
+            self.user.save()
+        return self.user
+
 
 # Borrowed from django.contrib.auth so we can define our own inheritance
 class PasswordChangeForm(SetPasswordForm):
@@ -155,6 +181,7 @@ class PasswordChangeForm(SetPasswordForm):
     """
     error_messages = dict(SetPasswordForm.error_messages, **{
         'password_incorrect': _("Your old password was entered incorrectly. Please enter it again."),
+        'busy': _("We are receiving too many requests right now. Please try again in a moment."),
     })
     old_password = forms.CharField(label=_("Old password"), widget=forms.PasswordInput)
 
@@ -163,13 +190,17 @@ class PasswordChangeForm(SetPasswordForm):
         Validates that the old_password field is correct.
         """
         old_password = self.cleaned_data["old_password"]
-        if not self.user.check_password(old_password):
+        try:
+            is_correct = check_password(self.user, old_password)
+        except HashingQueueFull:
+            raise forms.ValidationError(self.error_messages['busy'])
+        if not is_correct:
             raise forms.ValidationError(self.error_messages['password_incorrect'])
         return old_password
 PasswordChangeForm.base_fields.keyOrder = ['old_password', 'new_password1', 'new_password2']
 
 
-class InvitationCompleteForm(forms.ModelForm):
+class InvitationCompleteForm(UniqueEmailFormMixin, forms.ModelForm):
     # TODO: Make email and non-email version
     email = UniqueRequiredEmailField()
 
@@ -183,12 +214,19 @@ class BaseLoginForm(forms.Form):
 
     error_messages = {
         'inactive': _("This account is inactive."),
+        'busy': _("We are receiving too many requests right now. Please try again in a moment."),
     }
 
     def __init__(self, *args, **kwargs):
         self.user_cache = None
         super(BaseLoginForm, self).__init__(*args, **kwargs)
 
+    def authenticate(self, **credentials):
+        try:
+            return authenticate(**credentials)
+        except HashingQueueFull:
+            raise forms.ValidationError(self.error_messages['busy'])
+
     def get_user_id(self):
         if self.user_cache:
             return self.user_cache.id
@@ -211,7 +249,7 @@ class LoginForm(BaseLoginForm):
         password = self.cleaned_data.get('password')
 
         if username and password:
-            self.user_cache = authenticate(username=username, password=password)
+            self.user_cache = self.authenticate(username=username, password=password)
             if self.user_cache is None:
                 raise forms.ValidationError(self.error_messages['invalid_login'])
             elif not self.user_cache.is_active:
@@ -232,7 +270,31 @@ class EmailLoginForm(BaseLoginForm):
         password = self.cleaned_data.get('password')
 
         if email and password:
-            self.user_cache = authenticate(email=email, password=password)
+            self.user_cache = self.authenticate(email=email, password=password)
+            if self.user_cache is None:
+                raise forms.ValidationError(self.error_messages['invalid_login'])
+            elif not self.user_cache.is_active:
+                raise forms.ValidationError(self.error_messages['inactive'])
+        return self.cleaned_data
+
+
+class IdentifierLoginForm(BaseLoginForm):
+    """
+    Login form for sky_visitor.backends.UsernameOrEmailBackend
+    """
+    identifier = forms.CharField(label=_("Username or email"), max_length=75)
+    password = forms.CharField(label=_("Password"), widget=forms.PasswordInput)
+
+    def __init__(self, *args, **kwargs):
+        self.error_messages['invalid_login'] = _("Please enter a correct username or email and password. Note that both fields are case-sensitive.")
+        super(IdentifierLoginForm, self).__init__(*args, **kwargs)
+
+    def clean(self):
+        identifier = self.cleaned_data.get('identifier')
+        password = self.cleaned_data.get('password')
+
+        if identifier and password:
+            self.user_cache = self.authenticate(identifier=identifier, password=password)
             if self.user_cache is None:
                 raise forms.ValidationError(self.error_messages['invalid_login'])
             elif not self.user_cache.is_active:
@@ -241,6 +303,18 @@ class EmailLoginForm(BaseLoginForm):
 
 
 class PasswordResetForm(auth_forms.PasswordResetForm):
+    def clean_email(self):
+        """
+        Same as auth_forms.PasswordResetForm.clean_email(), but looks the user up through the indexed email column
+        """
+        email = self.cleaned_data["email"]
+        self.users_cache = User.objects.filter(is_active=True, **get_email_lookup(User, email))
+        if not len(self.users_cache):
+            raise forms.ValidationError(self.error_messages['unknown'])
+        if any((user.password == UNUSABLE_PASSWORD) for user in self.users_cache):
+            raise forms.ValidationError(self.error_messages['unusable'])
+        return email
+
     def save(self, *args, **kwargs):
         """
         Override standard forgot password email sending. Sending now occurs in the view.
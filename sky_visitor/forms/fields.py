@@ -15,7 +15,7 @@
 from django import forms
 from django.forms import widgets
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.auth.models import User as AuthUser
+from sky_visitor.models import email_is_taken
 
 
 class Html5EmailInput(widgets.Input):
@@ -25,6 +25,8 @@ class Html5EmailInput(widgets.Input):
 class UniqueRequiredEmailField(forms.EmailField):
     nonunique_error = _("This email address is already in use. Please enter a different email address.")
     required = True
+    # Primary key of the user being edited, whose own address doesn't count as taken. Set by UniqueEmailFormMixin.
+    exclude_id = None
 
     def __init__(self, *args, **kwargs):
         if not 'label' in kwargs:
@@ -36,7 +38,7 @@ class UniqueRequiredEmailField(forms.EmailField):
 
     def clean(self, value):
         value = super(UniqueRequiredEmailField, self).clean(value)
-        if AuthUser.objects.filter(email__iexact=value):
+        if email_is_taken(value, self.exclude_id):
             raise forms.ValidationError(self.nonunique_error)
         return value
 
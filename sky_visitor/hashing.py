@@ -0,0 +1,341 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import threading
+import multiprocessing
+from django.contrib.auth import hashers
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User as AuthUser
+from django.core.signals import request_started, request_finished
+from sky_visitor import hashing_policy, metrics
+from sky_visitor.cache import invalidate_user
+from sky_visitor.hashing_policy import policy
+from sky_visitor.settings import get_app_setting
+
+
+class HashingQueueFull(Exception):
+    """
+    Raised when a password check could not get a slot in the hashing executor within SKY_VISITOR_HASHING_QUEUE_TIMEOUT
+    """
+    pass
+
+
+def get_hashing_pool(processes=None):
+    """
+    Returns a process pool for hash_passwords(), or None when `processes` is 1 and hashing should happen inline.
+    `processes` defaults to the number of CPUs.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1:
+        return None
+    return multiprocessing.Pool(processes)
+
+
+def hash_passwords(passwords, pool=None):
+    """
+    Returns the make_password() hash of each of `passwords`, in order. Hashes are computed in `pool` when given.
+    """
+    if pool is None:
+        return [make_password(password) for password in passwords]
+    return pool.map(make_password, passwords)
+
+
+def _timed_call(func, args):
+    return time.time(), func(*args)
+
+
+def _verify_password(raw_password, encoded):
+    """
+    Runs in a worker process. Returns whether `raw_password` matches `encoded` and whether the hash should be upgraded to
+    the preferred hasher (which has to happen in the calling process, where the user can be saved).
+    """
+    must_update = []
+    is_correct = hashers.check_password(raw_password, encoded, setter=lambda password: must_update.append(True))
+    return is_correct, bool(must_update)
+
+
+class HashingExecutor(object):
+    """
+    Runs password hashes in a pool of `processes` worker processes instead of on the request thread.
+
+    At most `max_pending` hashes can be queued or running at once. A caller that can't get a slot within `queue_timeout`
+    seconds gets HashingQueueFull, so a login storm turns into quick "try again" responses instead of every request
+    worker waiting on the pool.
+    """
+
+    def __init__(self, processes, max_pending=None, queue_timeout=None):
+        self.processes = processes
+        self.max_pending = max_pending or processes * 2
+        self.queue_timeout = queue_timeout
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._pool = None
+        self._pool_pid = None
+        self.reset_stats()
+
+    def get_pool(self):
+        # Pools don't survive a fork, so every process (e.g. each prefork server worker) gets its own
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = multiprocessing.Pool(self.processes)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def acquire(self):
+        deadline = None if self.queue_timeout is None else time.time() + self.queue_timeout
+        with self._condition:
+            while self._pending >= self.max_pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._stats['rejected'] += 1
+                    raise HashingQueueFull()
+                self._condition.wait(remaining)
+            self._pending += 1
+
+    def release(self):
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify()
+
+    def run(self, func, *args):
+        """
+        Returns func(*args), computed in the pool. `func` and `args` must be picklable.
+        """
+        submitted_at = time.time()
+        self.acquire()
+        try:
+            started_at, result = self.get_pool().apply_async(_timed_call, (func, args)).get()
+        finally:
+            self.release()
+        finished_at = time.time()
+        with self._condition:
+            queue_time = max(started_at - submitted_at, 0)
+            self._stats['completed'] += 1
+            self._stats['queue_time_total'] += queue_time
+            self._stats['queue_time_max'] = max(self._stats['queue_time_max'], queue_time)
+            self._stats['hash_time_total'] += finished_at - started_at
+        return result
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending
+        return stats
+
+    def reset_stats(self):
+        self._stats = {'completed': 0, 'rejected': 0, 'queue_time_total': 0.0, 'queue_time_max': 0.0, 'hash_time_total': 0.0}
+
+    def shutdown(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.terminate()
+        self._pool = None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the shared HashingExecutor, or None when SKY_VISITOR_HASHING_PROCESSES is 0 and hashing happens inline
+    """
+    global _executor
+    processes = get_app_setting('SKY_VISITOR_HASHING_PROCESSES')
+    if not processes:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = HashingExecutor(processes, get_app_setting('SKY_VISITOR_HASHING_MAX_PENDING'),
+                                        get_app_setting('SKY_VISITOR_HASHING_QUEUE_TIMEOUT'))
+        return _executor
+
+
+def reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = None
+
+
+def check_password(user, raw_password):
+    """
+    Same as user.check_password(), routed through the hashing executor when one is configured. Raises HashingQueueFull
+    when the executor is saturated.
+
+    The time taken is recorded in hashing_policy.policy. With SKY_VISITOR_HASH_UPGRADE_ON_LOGIN on, a correct password
+    whose hash is below the policy is rehashed after the response has been sent (see defer_rehash()).
+    """
+    executor = get_executor()
+    encoded = user.password
+    upgrade = get_app_setting('SKY_VISITOR_HASH_UPGRADE_ON_LOGIN')
+    started_at = time.time()
+    if executor is None and not upgrade:
+        is_correct = user.check_password(raw_password)
+    elif executor is None:
+        is_correct = hashers.check_password(raw_password, encoded)
+    else:
+        try:
+            is_correct, must_update = executor.run(_verify_password, raw_password, encoded)
+        except HashingQueueFull:
+            metrics.incr('hashing.queue_full')
+            raise
+        if is_correct and must_update and not upgrade:
+            set_password(user, raw_password)
+            user.save()
+    elapsed = time.time() - started_at
+    policy.record(encoded, elapsed)
+    metrics.timing('hashing.check', elapsed)
+    if is_correct and upgrade and policy.needs_rehash(encoded):
+        defer_rehash(user, raw_password)
+    return is_correct
+
+
+@metrics.timer('hashing.set')
+def set_password(user, raw_password):
+    """
+    Same as user.set_password(), routed through the hashing executor when one is configured, and hashed with the
+    iterations of hashing_policy.policy. Setting a password is rare compared to checking one, so it hashes inline rather
+    than failing when the executor is saturated.
+    """
+    if not raw_password:
+        return user.set_password(raw_password)
+    args = (raw_password, policy.get_hasher().algorithm, policy.get_iterations())
+    executor = get_executor()
+    if executor is None:
+        user.password = hashing_policy.make_password(*args)
+        return
+    try:
+        user.password = executor.run(hashing_policy.make_password, *args)
+    except HashingQueueFull:
+        user.password = hashing_policy.make_password(*args)
+
+
+_deferred = threading.local()
+
+
+def start_request(**kwargs):
+    _deferred.rehashes = []
+
+
+def finish_request(**kwargs):
+    rehashes = getattr(_deferred, 'rehashes', None)
+    _deferred.rehashes = None
+    for args in rehashes or []:
+        try:
+            rehash(*args)
+        except Exception:
+            # The hash stays as it is and gets another chance at the next login
+            pass
+
+
+request_started.connect(start_request, weak=False, dispatch_uid='sky_visitor.hashing.start_request')
+request_finished.connect(finish_request, weak=False, dispatch_uid='sky_visitor.hashing.finish_request')
+
+
+def defer_rehash(user, raw_password):
+    """
+    Rehashes the password of `user` with the policy once the current request has finished, so the extra hash isn't part
+    of the login response time. Outside of a request it happens right away.
+    """
+    rehashes = getattr(_deferred, 'rehashes', None)
+    if rehashes is None:
+        rehash(user.pk, user.password, raw_password)
+    else:
+        rehashes.append((user.pk, user.password, raw_password))
+
+
+def rehash(user_id, old_encoded, raw_password):
+    """
+    Replaces the password hash of the user, unless it changed since `old_encoded` was read. Returns whether it did.
+    """
+    user = AuthUser(pk=user_id)
+    set_password(user, raw_password)
+    updated = AuthUser.objects.filter(pk=user_id, password=old_encoded).update(password=user.password)
+    if updated:
+        # update() doesn't send post_save
+        invalidate_user(user_id)
+    return bool(updated)
+
+
+class DummyHasher(object):
+    """
+    Spends the same time on a login for an unknown user as check_password() spends on a known one, so response times
+    don't reveal which accounts exist.
+
+    hash() checks the password against a hash made with the preferred hasher at the iterations of hashing_policy.policy,
+    the same as set_password() uses, so the cost tracks PASSWORD_HASHERS and the policy. wait() sleeps for the average
+    measured cost instead, for callers that want the timing without the CPU.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encoded = None
+        self._cost = None
+        self.reset_stats()
+
+    def get_encoded(self):
+        key = (policy.get_hasher().algorithm, policy.get_iterations())
+        with self._lock:
+            if self._encoded is None or self._encoded[0] != key:
+                self._encoded = (key, hashing_policy.make_password(os.urandom(16).encode('hex'), *key))
+                self._cost = None
+            return self._encoded[1]
+
+    def get_cost(self):
+        """
+        Returns the average seconds a dummy hash took in this process, or None before the first one
+        """
+        return self._cost
+
+    def hash(self, raw_password):
+        encoded = self.get_encoded()
+        started_at = time.time()
+        executor = get_executor()
+        if executor is None:
+            hashers.check_password(raw_password or '', encoded)
+        else:
+            executor.run(_verify_password, raw_password or '', encoded)
+        elapsed = time.time() - started_at
+        metrics.timing('hashing.dummy', elapsed)
+        with self._lock:
+            self._cost = elapsed if self._cost is None else self._cost * 0.9 + elapsed * 0.1
+            self._stats['hashes'] += 1
+            self._stats['hash_time_total'] += elapsed
+
+    def wait(self, raw_password=None):
+        """
+        Sleeps for the measured cost of a hash, or hashes when there is no measurement yet
+        """
+        cost = self.get_cost()
+        if cost is None:
+            return self.hash(raw_password)
+        time.sleep(cost)
+        metrics.incr('hashing.dummy_wait')
+        with self._lock:
+            self._stats['waits'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['cost'] = self._cost
+        return stats
+
+    def reset_stats(self):
+        self._stats = {'hashes': 0, 'waits': 0, 'hash_time_total': 0.0}
+
+
+dummy_hasher = DummyHasher()
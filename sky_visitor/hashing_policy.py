@@ -0,0 +1,177 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import threading
+import time
+from django.contrib.auth.hashers import get_hasher, is_password_usable
+from django.utils.encoding import smart_str
+from sky_visitor.settings import get_app_setting
+
+
+# Upper bounds, in seconds, of the verification time histogram buckets. The last bucket holds everything slower.
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def make_password(raw_password, algorithm, iterations):
+    """
+    Same as django.contrib.auth.hashers.make_password(), with the iteration count of hashers that have one overridden.
+    Module level so that it can run in the hashing executor.
+    """
+    hasher = get_hasher(algorithm)
+    salt = smart_str(hasher.salt())
+    if iterations and hasattr(hasher, 'iterations'):
+        return hasher.encode(smart_str(raw_password), salt, iterations)
+    return hasher.encode(smart_str(raw_password), salt)
+
+
+class HashingPolicy(object):
+    """
+    Decides how expensive new password hashes should be and whether a stored hash should be upgraded.
+
+    The iteration count of the preferred hasher (for hashers that have one, like PBKDF2) is SKY_VISITOR_HASH_ITERATIONS
+    when set. Otherwise, with SKY_VISITOR_HASH_TARGET_SECONDS set, it's the count chosen by calibrate(), which the project
+    calls once at startup; until then the hasher's default is used. It never goes below the hasher's own default.
+
+    Also keeps per-algorithm histograms of how long password checks take.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # ((algorithm, target seconds), iterations) from the last calibrate()
+        self._calibrated = None
+        self.reset_stats()
+
+    def get_hasher(self):
+        return get_hasher()
+
+    def get_iterations(self):
+        """
+        Returns the iteration count for new hashes, or None when the preferred hasher doesn't have one
+        """
+        hasher = self.get_hasher()
+        if not hasattr(hasher, 'iterations'):
+            return None
+        iterations = get_app_setting('SKY_VISITOR_HASH_ITERATIONS')
+        if iterations is None:
+            calibrated = self._calibrated
+            if calibrated is not None and calibrated[0] == self.get_calibration_key(hasher):
+                iterations = calibrated[1]
+            else:
+                iterations = hasher.iterations
+        return max(iterations, hasher.iterations)
+
+    def get_calibration_key(self, hasher):
+        return hasher.algorithm, get_app_setting('SKY_VISITOR_HASH_TARGET_SECONDS')
+
+    def calibrate(self):
+        """
+        Turns SKY_VISITOR_HASH_TARGET_SECONDS into the iteration count for new hashes, unless SKY_VISITOR_HASH_ITERATIONS
+        is set: benchmarks the preferred hasher and keeps the chosen count in this policy. Never called implicitly; call
+        it once from the WSGI module (before the server forks its workers, so they share the count). Returns the count,
+        or None when there was nothing to calibrate.
+        """
+        if get_app_setting('SKY_VISITOR_HASH_ITERATIONS') is not None:
+            return None
+        target = get_app_setting('SKY_VISITOR_HASH_TARGET_SECONDS')
+        hasher = self.get_hasher()
+        if target is None or not hasattr(hasher, 'iterations'):
+            return None
+        iterations = self.choose_iterations(target, hasher)
+        self._calibrated = (self.get_calibration_key(hasher), iterations)
+        return iterations
+
+    def reset_calibration(self):
+        self._calibrated = None
+
+    def benchmark(self, hasher=None, iterations=None, rounds=3):
+        """
+        Returns the fastest of `rounds` timings, in seconds, of hashing a password with `hasher` at `iterations`
+        """
+        if hasher is None:
+            hasher = self.get_hasher()
+        salt = hasher.salt()
+        timings = []
+        for i in range(rounds):
+            started_at = time.time()
+            if iterations is None:
+                hasher.encode('benchmark-password', salt)
+            else:
+                hasher.encode('benchmark-password', salt, iterations)
+            timings.append(time.time() - started_at)
+        return min(timings)
+
+    def choose_iterations(self, target_seconds, hasher=None, rounds=3):
+        """
+        Returns the iteration count that makes one hash with `hasher` take about `target_seconds`, rounded to a thousand.
+        The cost of PBKDF2-style hashers is linear in the iteration count, so one benchmark at the default is enough.
+        """
+        if hasher is None:
+            hasher = self.get_hasher()
+        elapsed = max(self.benchmark(hasher, hasher.iterations, rounds), 1e-6)
+        iterations = int(hasher.iterations * target_seconds / elapsed)
+        return max(int(round(iterations, -3)), 1000)
+
+    def get_algorithm(self, encoded):
+        return encoded.split('$', 1)[0] if '$' in encoded else None
+
+    def needs_rehash(self, encoded):
+        """
+        Returns whether `encoded` was made with another hasher or with fewer iterations than the policy asks for
+        """
+        if not encoded or not is_password_usable(encoded):
+            return False
+        hasher = self.get_hasher()
+        if self.get_algorithm(encoded) != hasher.algorithm:
+            return True
+        iterations = self.get_iterations()
+        if iterations is None:
+            return False
+        try:
+            return int(encoded.split('$')[1]) < iterations
+        except (IndexError, ValueError):
+            return False
+
+    def make_password(self, raw_password):
+        return make_password(raw_password, self.get_hasher().algorithm, self.get_iterations())
+
+    def record(self, encoded, seconds):
+        """
+        Adds a password check that took `seconds` to the histogram of the algorithm `encoded` was made with
+        """
+        algorithm = self.get_algorithm(encoded or '') or 'unknown'
+        with self._lock:
+            histogram = self._histograms.get(algorithm)
+            if histogram is None:
+                histogram = self._histograms[algorithm] = {'count': 0, 'total': 0.0, 'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1)}
+            histogram['count'] += 1
+            histogram['total'] += seconds
+            histogram['buckets'][bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+
+    def histograms(self):
+        """
+        Returns {algorithm: {'count', 'total', 'buckets'}}, where buckets is a list of (upper bound, count) pairs and the
+        last upper bound is None
+        """
+        with self._lock:
+            return dict((algorithm, {'count': h['count'], 'total': h['total'],
+                                     'buckets': zip(HISTOGRAM_BUCKETS + (None,), h['buckets'])})
+                        for algorithm, h in self._histograms.items())
+
+    def reset_stats(self):
+        with self._lock:
+            self._histograms = {}
+
+
+policy = HashingPolicy()
@@ -0,0 +1,95 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import namedtuple
+from itertools import islice
+from django.core.mail import get_connection
+from django.db import DatabaseError, transaction
+from sky_visitor import metrics
+from sky_visitor.emails import TokenTemplateEmail
+from sky_visitor.forms import InvitationForm
+
+# What happened to one chunk passed to send_invitations(). `failed` counts the addresses no user was created for,
+# `email_failed` those whose user was created but whose invitation could not be rendered or sent. `errors` is a list of
+# (email, message) pairs for both.
+InvitationChunkReport = namedtuple('InvitationChunkReport', ['number', 'created', 'sent', 'failed', 'email_failed', 'errors', 'seconds'])
+
+
+def send_invitations(emails, chunk_size=100, email_kwargs=None, email_template_class=TokenTemplateEmail,
+                     form_class=InvitationForm, connection=None):
+    """
+    Invites every address in `emails` (any iterable, read lazily). Each address goes through `form_class`, which creates
+    an inactive user, and the invitations are rendered with `email_template_class(user, **email_kwargs)`.
+
+    Messages are sent in chunks of `chunk_size` with send_messages() over a single connection that stays open for the
+    whole run, instead of one SMTP connection per message. Yields an InvitationChunkReport per chunk.
+    """
+    email_kwargs = email_kwargs or {}
+    emails = iter(emails)
+    if connection is None:
+        connection = get_connection()
+    opened = connection.open()
+    try:
+        number = 0
+        while True:
+            chunk = list(islice(emails, chunk_size))
+            if not chunk:
+                break
+            number += 1
+            yield _send_chunk(number, chunk, email_kwargs, email_template_class, form_class, connection)
+    finally:
+        if opened:
+            connection.close()
+
+
+def format_error(e):
+    return u'%s: %s' % (e.__class__.__name__, e)
+
+
+def _send_chunk(number, chunk, email_kwargs, email_template_class, form_class, connection):
+    started_at = time.time()
+    errors = []
+    messages = []
+    created = 0
+    for email in chunk:
+        form = form_class({'email': email})
+        if not form.is_valid():
+            errors.append((email, u' '.join(u' '.join(field_errors) for field_errors in form.errors.values())))
+            continue
+        # One bad address must not cost the report of the others
+        try:
+            user = form.save()
+        except DatabaseError as e:
+            transaction.rollback_unless_managed()
+            errors.append((email, format_error(e)))
+            continue
+        except Exception as e:
+            errors.append((email, format_error(e)))
+            continue
+        created += 1
+        try:
+            messages.append(email_template_class(user, **email_kwargs).get_message(connection=connection))
+        except Exception as e:
+            errors.append((email, format_error(e)))
+    sent = 0
+    if messages:
+        try:
+            with metrics.timer('email.send_chunk'):
+                sent = connection.send_messages(messages) or 0
+        except Exception as e:
+            metrics.incr('email.send_failed', len(messages))
+            errors.extend((message.to[0], format_error(e)) for message in messages)
+    return InvitationChunkReport(number, created, sent, len(chunk) - created, created - sent, errors,
+                                 time.time() - started_at)
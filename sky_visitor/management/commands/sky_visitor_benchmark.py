@@ -0,0 +1,101 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from sky_visitor.benchmark import Benchmark, FLOWS, PROFILES, compare, format_result
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--profile', action='store', dest='profile', default='default',
+            help='Load profile: %s. Default is "default".' % ', '.join(sorted(PROFILES))),
+        make_option('--concurrency', action='store', dest='concurrency', type='int', default=None,
+            help='Number of client threads. Overrides the profile.'),
+        make_option('--iterations', action='store', dest='iterations', type='int', default=None,
+            help='Iterations of each flow, split between the threads. Overrides the profile.'),
+        make_option('--flows', action='store', dest='flows', default=None,
+            help='Comma separated flows to run. Default is all of them: %s.' % ','.join(FLOWS)),
+        make_option('--output', action='store', dest='output', default=None,
+            help='File to write the JSON results to. Default is sky_visitor_benchmark-<profile>.json.'),
+        make_option('--compare', action='store', dest='compare', default=None,
+            help='JSON results of a previous run. Fails when a flow\'s p95 latency got worse by more than --threshold.'),
+        make_option('--threshold', action='store', dest='threshold', type='float', default=0.2,
+            help='Allowed p95 latency increase for --compare, as a fraction. Default is 0.2.'),
+    )
+    help = "Benchmarks the register, login, logout, forgot password and token change flows against a test database."
+
+    def handle_noargs(self, **options):
+        profile_name = options.get('profile')
+        if profile_name not in PROFILES:
+            raise CommandError("Unknown profile %r. Choose from %s." % (profile_name, ', '.join(sorted(PROFILES))))
+        profile = dict(PROFILES[profile_name])
+        for name in ('concurrency', 'iterations'):
+            if options.get(name) is not None:
+                profile[name] = options[name]
+        if profile['concurrency'] < 1 or profile['iterations'] < profile['concurrency']:
+            raise CommandError("Need at least one thread and at least one iteration per thread")
+        flows = options.get('flows').split(',') if options.get('flows') else FLOWS
+        unknown = [flow for flow in flows if flow not in FLOWS]
+        if unknown:
+            raise CommandError("Unknown flows: %s" % ', '.join(unknown))
+        verbosity = int(options.get('verbosity', 1))
+
+        results = self.run_benchmark(Benchmark(profile['concurrency'], profile['iterations'], flows), verbosity)
+        results['profile'] = profile_name
+        results['settings'] = os.environ.get('DJANGO_SETTINGS_MODULE')
+
+        output = options.get('output') or 'sky_visitor_benchmark-%s.json' % profile_name
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        for flow in flows:
+            self.stdout.write("%s\n" % format_result(flow, results['flows'][flow]))
+        self.stdout.write("Results written to %s\n" % output)
+
+        if options.get('compare'):
+            with open(options['compare']) as f:
+                regressions = compare(json.load(f), results, options.get('threshold'))
+            if regressions:
+                raise CommandError("Latency regressions:\n%s" % '\n'.join(regressions))
+
+    def run_benchmark(self, benchmark, verbosity):
+        """
+        Runs `benchmark` against a fresh test database. SQLite gets a file instead of :memory:, so every thread sees the
+        same database.
+        """
+        setup_test_environment()
+        settings.DEBUG = False
+        test_file = None
+        if connection.vendor == 'sqlite' and not connection.settings_dict.get('TEST_NAME'):
+            handle, test_file = tempfile.mkstemp(prefix='sky_visitor_benchmark', suffix='.sqlite3')
+            os.close(handle)
+            connection.settings_dict['TEST_NAME'] = test_file
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=max(verbosity - 1, 0), autoclobber=True)
+        try:
+            return benchmark.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=max(verbosity - 1, 0))
+            if test_file is not None:
+                connection.settings_dict['TEST_NAME'] = None
+                if os.path.exists(test_file):
+                    os.remove(test_file)
+            teardown_test_environment()
@@ -0,0 +1,80 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db import transaction
+from sky_visitor.emails import TOKEN_PLACEHOLDER, UIDB36_PLACEHOLDER
+from sky_visitor.invitations import send_invitations
+
+
+class Command(BaseCommand):
+    args = '<csv file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=100,
+            help='Number of invitations to send per batch. Default is 100.'),
+        make_option('--domain', action='store', dest='domain', default='localhost',
+            help='Domain used in the invitation links. Default is "localhost".'),
+        make_option('--protocol', action='store', dest='protocol', default='http',
+            help='Protocol used in the invitation links. Default is "http".'),
+        make_option('--subject', action='store', dest='subject', default='Invitation',
+            help='Subject of the invitation emails.'),
+        make_option('--from-email', action='store', dest='from_email', default=None,
+            help='Sender of the invitation emails. Default is DEFAULT_FROM_EMAIL.'),
+        make_option('--template', action='store', dest='template', default='sky_visitor/invitation_email.html',
+            help='Template for the body of the invitation emails. Default is "sky_visitor/invitation_email.html".'),
+        make_option('--token-view', action='store', dest='token_view', default='invitation_complete',
+            help='URL name of the view that completes an invitation. Default is "invitation_complete", which you need to route yourself.'),
+    )
+    help = "Creates inactive users for the email addresses in the first column of a CSV file (or stdin when given '-') and emails them an invitation."
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the path of a CSV file, or '-' to read from stdin")
+        email_kwargs = {
+            'email_template_name': options['template'],
+            'token_view_name': options['token_view'],
+            'domain': options['domain'],
+            'protocol': options['protocol'],
+            'subject': options['subject'],
+            'from_email': options['from_email'],
+        }
+        try:
+            # Fail before anyone is created rather than on the first invitation
+            reverse(options['token_view'], kwargs={'uidb36': UIDB36_PLACEHOLDER, 'token': TOKEN_PLACEHOLDER})
+        except NoReverseMatch:
+            raise CommandError("Can't reverse --token-view %r. Add InvitationCompleteView to your URLconf under that name "
+                               "or pass the name of the view that completes invitations." % options['token_view'])
+        csv_file = sys.stdin if args[0] == '-' else open(args[0], 'rb')
+        emails = (row[0].strip() for row in csv.reader(csv_file) if row and row[0].strip())
+        totals = {'sent': 0, 'failed': 0, 'email_failed': 0}
+        try:
+            for report in send_invitations(emails, chunk_size=options['chunk_size'], email_kwargs=email_kwargs):
+                transaction.commit_unless_managed()
+                totals['sent'] += report.sent
+                totals['failed'] += report.failed
+                totals['email_failed'] += report.email_failed
+                rate = report.sent / report.seconds if report.seconds else 0
+                self.stdout.write("Chunk %d: %d sent, %d failed, %d created but not emailed in %.2fs (%.1f messages/s)\n" % (
+                    report.number, report.sent, report.failed, report.email_failed, report.seconds, rate))
+                for email, error in report.errors:
+                    self.stderr.write("  %s: %s\n" % (email, error))
+        finally:
+            if csv_file is not sys.stdin:
+                csv_file.close()
+            # Also reached when a chunk raised, so what was done so far is still reported
+            self.stdout.write("Done: %(sent)d sent, %(failed)d failed, %(email_failed)d created but not emailed\n" % totals)
@@ -0,0 +1,87 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from sky_visitor.models import has_normalized_email, normalize_email
+from sky_visitor.utils import SubclassedUser as User
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+            help='Specifies the database to use. Default is "default".'),
+        make_option('--batch-size', action='store', dest='batch_size', type='int', default=1000,
+            help='Number of users to read per query. Default is 1000.'),
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the SQL that adds the email_normalized column to an existing table instead of backfilling it.'),
+    )
+    help = "Fills in ExtendedUser.email_normalized for users created before the column existed."
+
+    def handle_noargs(self, **options):
+        if not has_normalized_email(User):
+            raise CommandError("SKY_VISITOR_USER_MODEL must be a subclass of sky_visitor.models.ExtendedUser")
+        database = options.get('database')
+        if options.get('sql'):
+            self.stdout.write(self.get_sql(connections[database]))
+        else:
+            self.backfill(database, options.get('batch_size'))
+
+    def get_sql(self, connection):
+        field = User._meta.get_field('email_normalized')
+        qn = connection.ops.quote_name
+        statements = ['ALTER TABLE %s ADD COLUMN %s %s NULL%s;' % (qn(User._meta.db_table), qn(field.column),
+                      field.db_type(connection=connection), ' UNIQUE' if field.unique else '')]
+        statements.extend(connection.creation.sql_indexes_for_field(User, field, no_style()))
+        return '\n'.join(statements) + '\n'
+
+    def backfill(self, database, batch_size):
+        queryset = User.objects.using(database).order_by('pk')
+        last_pk = None
+        updated = 0
+        while True:
+            batch = queryset
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', 'email', 'email_normalized')[:batch_size])
+            if not rows:
+                break
+            changes = [(pk, normalize_email(email)) for pk, email, email_normalized in rows
+                       if normalize_email(email) != email_normalized]
+            if changes:
+                self.update_batch(connections[database], changes)
+                updated += len(changes)
+            transaction.commit_unless_managed(using=database)
+            last_pk = rows[-1][0]
+        self.stdout.write("Normalized %d email address(es)\n" % updated)
+
+    def update_batch(self, connection, changes):
+        """
+        Writes the (pk, normalized email) pairs in `changes` with one UPDATE ... CASE statement per chunk that fits the
+        database's parameter limit. Only this column is written and no signals are sent.
+        """
+        qn = connection.ops.quote_name
+        pk_column = qn(User._meta.pk.column)
+        # Three parameters per row
+        chunk_size = max(connection.ops.bulk_batch_size(['pk', 'email', 'pk'], changes), 1)
+        cursor = connection.cursor()
+        for start in range(0, len(changes), chunk_size):
+            chunk = changes[start:start + chunk_size]
+            sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(User._meta.db_table), qn(User._meta.get_field('email_normalized').column), pk_column,
+                ' '.join(['WHEN %s THEN %s'] * len(chunk)), pk_column, ', '.join(['%s'] * len(chunk)))
+            params = [value for change in chunk for value in change] + [pk for pk, normalized in chunk]
+            cursor.execute(sql, params)
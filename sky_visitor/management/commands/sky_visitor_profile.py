@@ -0,0 +1,72 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pstats
+from collections import defaultdict
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from sky_visitor.profiling import request_profiler, list_profiles, get_profile_name, summarize_samples
+from sky_visitor.settings import get_app_setting
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--trigger', action='store_true', dest='trigger', default=False,
+            help='Print a value for the X-Sky-Visitor-Profile header instead, which gets any request to a sky_visitor view profiled.'),
+        make_option('--dir', action='store', dest='dir', default=None,
+            help='Directory to read profiles from. Default is SKY_VISITOR_PROFILE_DIR.'),
+        make_option('--mode', action='store', dest='mode', default=None,
+            help='Kind of profiles to summarize: cprofile or sampler. Default is SKY_VISITOR_PROFILE_MODE.'),
+        make_option('--view', action='store', dest='view', default=None,
+            help='Only summarize the profiles of this view class, e.g. LoginView.'),
+        make_option('--sort', action='store', dest='sort', default='cumulative',
+            help='cumulative (time in the function and what it calls) or tottime (time in the function itself). Default is cumulative.'),
+        make_option('--limit', action='store', dest='limit', type='int', default=25,
+            help='Number of functions to show. Default is 25.'),
+    )
+    help = "Summarizes the top functions across the profiles captured from sky_visitor views."
+
+    def handle_noargs(self, **options):
+        if options.get('trigger'):
+            self.stdout.write("X-Sky-Visitor-Profile: %s\n" % request_profiler.make_trigger())
+            return
+        sort = options.get('sort')
+        if sort not in ('cumulative', 'tottime'):
+            raise CommandError("--sort must be cumulative or tottime")
+        mode = options.get('mode') or get_app_setting('SKY_VISITOR_PROFILE_MODE')
+        if mode not in ('cprofile', 'sampler'):
+            raise CommandError("--mode must be cprofile or sampler")
+        directory = options.get('dir') or request_profiler.get_directory()
+        paths = list_profiles(directory, mode, options.get('view'))
+        if not paths:
+            raise CommandError("No %s profiles in %s" % (mode, directory))
+
+        views = defaultdict(int)
+        for path in paths:
+            views[get_profile_name(path)] += 1
+        self.stdout.write("%d %s profiles in %s: %s\n\n" % (len(paths), mode, directory,
+                          ', '.join('%s %d' % view for view in sorted(views.items()))))
+        if mode == 'cprofile':
+            stats = pstats.Stats(*paths, stream=self.stdout)
+            stats.sort_stats(sort).print_stats(options.get('limit'))
+        else:
+            self.print_samples(paths, sort, options.get('limit'))
+
+    def print_samples(self, paths, sort, limit):
+        samples, functions = summarize_samples(paths)
+        functions.sort(key=lambda function: function[2 if sort == 'cumulative' else 1], reverse=True)
+        self.stdout.write("%d samples\n\n%8s %7s %8s %7s  %s\n" % (samples, 'self', '%', 'total', '%', 'function'))
+        for function, self_samples, total_samples in functions[:limit]:
+            self.stdout.write("%8d %6.1f%% %8d %6.1f%%  %s\n" % (self_samples, 100.0 * self_samples / samples,
+                                                              total_samples, 100.0 * total_samples / samples, function))
@@ -0,0 +1,41 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from sky_visitor.outbox import send_queued_email
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', action='store', dest='limit', type='int', default=None,
+            help='Maximum number of messages to send per pass. Default is all that are due.'),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep polling the outbox instead of exiting after one pass.'),
+        make_option('--interval', action='store', dest='interval', type='float', default=5,
+            help='Seconds to sleep between passes when --loop is given. Default is 5.'),
+    )
+    help = "Sends the emails queued in the sky_visitor outbox (SKY_VISITOR_EMAIL_DELIVERY = 'queue')."
+
+    def handle_noargs(self, **options):
+        while True:
+            counts = send_queued_email(limit=options.get('limit'))
+            transaction.commit_unless_managed()
+            if int(options.get('verbosity', 1)) > 0 and any(counts.values()):
+                self.stdout.write("Sent %(sent)d, failed %(failed)d, dead %(dead)d\n" % counts)
+            if not options.get('loop'):
+                break
+            time.sleep(options.get('interval'))
@@ -0,0 +1,42 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+from sky_visitor.hashing_policy import policy
+from sky_visitor.settings import get_app_setting
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--target', action='store', dest='target', type='float', default=None,
+            help='Seconds one password hash should take. Default is SKY_VISITOR_HASH_TARGET_SECONDS, or 0.25.'),
+        make_option('--rounds', action='store', dest='rounds', type='int', default=3,
+            help='Number of timings to take the fastest of. Default is 3.'),
+    )
+    help = "Benchmarks the preferred password hasher and prints the SKY_VISITOR_HASH_ITERATIONS for a target hash time."
+
+    def handle_noargs(self, **options):
+        hasher = policy.get_hasher()
+        if not hasattr(hasher, 'iterations'):
+            raise CommandError("The preferred hasher (%s) has no iteration count to tune" % hasher.algorithm)
+        target = options.get('target') or get_app_setting('SKY_VISITOR_HASH_TARGET_SECONDS') or 0.25
+        rounds = options.get('rounds')
+        current = policy.get_iterations()
+        self.stdout.write("%s at %d iterations (current policy): %.1f ms\n"
+                          % (hasher.algorithm, current, policy.benchmark(hasher, current, rounds) * 1000))
+        iterations = policy.choose_iterations(target, hasher, rounds)
+        self.stdout.write("%s at %d iterations: %.1f ms\n"
+                          % (hasher.algorithm, iterations, policy.benchmark(hasher, iterations, rounds) * 1000))
+        self.stdout.write("SKY_VISITOR_HASH_ITERATIONS = %d\n" % iterations)
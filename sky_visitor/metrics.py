@@ -0,0 +1,187 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+import time
+from functools import wraps
+from django.test.signals import setting_changed
+from django.utils.importlib import import_module
+from sky_visitor.settings import get_app_setting
+
+
+class NullSink(object):
+    """
+    Drops every metric. Used when SKY_VISITOR_METRICS_SINK is None, so instrumented code only pays for a function call.
+    """
+    enabled = False
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+
+class MemorySink(object):
+    """
+    Adds up counters and timings in this process, e.g. to expose them on a status page or check them in tests
+    """
+    enabled = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                self._timings[name] = {'count': 1, 'total': seconds, 'min': seconds, 'max': seconds}
+            else:
+                timing['count'] += 1
+                timing['total'] += seconds
+                timing['min'] = min(timing['min'], seconds)
+                timing['max'] = max(timing['max'], seconds)
+
+    def stats(self):
+        """
+        Returns {'counters': {name: value}, 'timings': {name: {'count', 'total', 'min', 'max'}}}, times in seconds
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timings': dict((name, dict(timing)) for name, timing in self._timings.items())}
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+
+
+class StatsdSink(object):
+    """
+    Sends each metric to a StatsD daemon as one line in a UDP datagram: "<prefix>.<name>:<value>|c" for counters and
+    "<prefix>.<name>:<milliseconds>|ms" for timings. Sending never blocks on or fails because of the daemon; metrics are
+    dropped when it isn't there.
+    """
+    enabled = True
+
+    def __init__(self, host=None, port=None, prefix=None):
+        host = host or get_app_setting('SKY_VISITOR_METRICS_STATSD_HOST')
+        port = port or get_app_setting('SKY_VISITOR_METRICS_STATSD_PORT')
+        prefix = get_app_setting('SKY_VISITOR_METRICS_PREFIX') if prefix is None else prefix
+        self.prefix = '%s.' % prefix if prefix else ''
+        try:
+            # Resolve once, not on every sendto()
+            family, socktype, proto, canonname, self.address = socket.getaddrinfo(host, port, 0, socket.SOCK_DGRAM)[0]
+        except socket.error:
+            family, self.address = socket.AF_INET, (host, port)
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def incr(self, name, value=1):
+        self.send(u'%s%s:%d|c' % (self.prefix, name, value))
+
+    def timing(self, name, seconds):
+        self.send(u'%s%s:%.3f|ms' % (self.prefix, name, seconds * 1000))
+
+
+_sink = None
+
+
+def load_sink():
+    path = get_app_setting('SKY_VISITOR_METRICS_SINK')
+    if not path:
+        return NullSink()
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)()
+
+
+def get_sink():
+    """
+    Returns the sink named by SKY_VISITOR_METRICS_SINK, created on first use and shared by the whole process
+    """
+    global _sink
+    sink = _sink
+    if sink is None:
+        sink = _sink = load_sink()
+    return sink
+
+
+def reset_sink(setting=None, **kwargs):
+    global _sink
+    if setting is None or setting.startswith('SKY_VISITOR_METRICS'):
+        _sink = None
+
+setting_changed.connect(reset_sink, dispatch_uid='sky_visitor.metrics.reset_sink')
+
+
+def incr(name, value=1):
+    get_sink().incr(name, value)
+
+
+def timing(name, seconds):
+    get_sink().timing(name, seconds)
+
+
+class timer(object):
+    """
+    Reports how long a block or function takes as timing `name`. Does nothing (not even read the clock) when metrics
+    are off.
+
+        with metrics.timer('hashing.check'):
+            ...
+
+        @metrics.timer('email.render')
+        def get_message(self):
+            ...
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.sink = get_sink()
+        if self.sink.enabled:
+            self.started_at = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.sink.enabled:
+            self.sink.timing(self.name, time.time() - self.started_at)
+
+    def __call__(self, func):
+        name = self.name
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sink = get_sink()
+            if not sink.enabled:
+                return func(*args, **kwargs)
+            started_at = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                sink.timing(name, time.time() - started_at)
+        return wrapper
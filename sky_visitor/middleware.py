@@ -12,11 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from django.template import RequestContext, loader
+import json
+import threading
+from django.template import Context, RequestContext, loader
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.http import HttpResponseForbidden
+from django.test.signals import setting_changed
+from django.utils import translation
+from django.utils.functional import SimpleLazyObject
+from sky_visitor import snapshot
 from sky_visitor.exceptions import Http403
+from sky_visitor.settings import get_app_setting
+
+
+# Rendered 403 bodies by (template, language, host), for SKY_VISITOR_403_CACHE
+_403_cache = {}
+_403_cache_lock = threading.Lock()
+# Host headers are chosen by the client, so only this many bodies are kept before the cache starts over
+MAX_403_CACHE_ENTRIES = 100
 
 
 def render_to_403(*args, **kwargs):
@@ -34,7 +48,87 @@ def render_to_403(*args, **kwargs):
     return response
 
 
+def render_cached_403(request, template_name='403.html'):
+    """
+    Same as render_to_403(), but the body is rendered once per template, language and host and served from memory after
+    that. The template gets a plain Context with only LANGUAGE_CODE and host, since per-request values (user, csrf_token,
+    messages) would be wrong for the next request.
+    """
+    language = translation.get_language()
+    host = request.get_host()
+    key = (template_name, language, host)
+    content = _403_cache.get(key)
+    if content is None:
+        content = loader.render_to_string(template_name, context_instance=Context({'LANGUAGE_CODE': language, 'host': host}))
+        with _403_cache_lock:
+            if len(_403_cache) >= MAX_403_CACHE_ENTRIES:
+                _403_cache.clear()
+            _403_cache[key] = content
+    return HttpResponseForbidden(content)
+
+
+def clear_403_cache():
+    with _403_cache_lock:
+        _403_cache.clear()
+
+
+def _clear_403_cache_on_setting_changed(sender, setting, **kwargs):
+    if setting.startswith('TEMPLATE') or setting == 'SKY_VISITOR_403_CACHE':
+        clear_403_cache()
+setting_changed.connect(_clear_403_cache_on_setting_changed, dispatch_uid='sky_visitor.middleware.clear_403_cache')
+
+
+def wants_json(request):
+    """
+    Returns whether the Accept header ranks application/json above text/html
+    """
+    accept = request.META.get('HTTP_ACCEPT', '')
+    if 'json' not in accept:
+        return False
+    quality = {}
+    for media_range in accept.split(','):
+        parts = media_range.strip().split(';')
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality.setdefault(parts[0].strip().lower(), q)
+    return quality.get('application/json', 0) > quality.get('text/html', 0)
+
+
+def render_json_403(exception=None):
+    detail = unicode(exception) if exception is not None and exception.args else u'Forbidden'
+    return HttpResponseForbidden(json.dumps({'detail': detail}), content_type='application/json')
+
+
 class Http403Middleware(object):
+    """
+    Turns Http403 into a 403 response. API clients that ask for JSON get {"detail": ...}. With SKY_VISITOR_403_CACHE on,
+    403.html is rendered once per language and host instead of with a full RequestContext every time, unless the
+    exception carries its own context.
+    """
+
     def process_exception(self, request, exception):
         if isinstance(exception, Http403):
-            return render_to_403(context_instance=RequestContext(request))
+            if get_app_setting('SKY_VISITOR_403_JSON') and wants_json(request):
+                return render_json_403(exception)
+            if get_app_setting('SKY_VISITOR_403_CACHE') and not exception.context:
+                return render_cached_403(request)
+            context_instance = RequestContext(request, exception.context or {})
+            return render_to_403(context_instance=context_instance)
+
+
+class SnapshotAuthenticationMiddleware(object):
+    """
+    Use instead of django.contrib.auth.middleware.AuthenticationMiddleware. request.user is answered from a signed
+    snapshot kept in the session (see sky_visitor.snapshot), so requests that only need the id, name, email or flags of
+    the user don't load it. The snapshot is replaced when the user is saved or its permissions change.
+    """
+
+    def process_request(self, request):
+        assert hasattr(request, 'session'), "SnapshotAuthenticationMiddleware requires SessionMiddleware to be installed before it."
+        request.user = SimpleLazyObject(lambda: snapshot.get_user(request))
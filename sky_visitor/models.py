@@ -12,32 +12,108 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import uuid
+import os
+import time
+import binascii
 import datetime
+from collections import namedtuple
+from itertools import islice
 from django.contrib.auth import models as auth_models
+from django.db import connections, models, router, transaction, IntegrityError
 from django.db.models.query_utils import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
-
-# Truncate the UUID for usernames a bit shorter so it is easier to use as a slug if needed
 from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from sky_visitor import metrics
+from sky_visitor.cache import invalidate_user, user_generations, permission_versions
+from sky_visitor.hashing import get_hashing_pool, hash_passwords
+from sky_visitor.settings import app_settings, get_app_setting
+from sky_visitor.utils import LazyModel, SubclassedUser as User
+
+# Models are loaded when the project starts (runserver, WSGI, manage.py), so bad settings fail there instead of on the
+# first request that uses them
+app_settings.validate()
+
+# Usernames are lower case base36 so they are easy to use as a slug if needed. 25 digits holds the full 128 bits.
+USERNAME_LENGTH = 25
+USERNAME_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+# How many generated usernames to try before giving up on an insert that keeps raising IntegrityError
+USERNAME_MAX_ATTEMPTS = 3
 
-USERNAME_LENGTH = 10
+EMAIL_UNIQUENESS_QUERY = 'query'
+EMAIL_UNIQUENESS_INDEX = 'index'
 
 
 def get_uuid_username_string():
-    return str(uuid.uuid4().int)[:USERNAME_LENGTH]
+    """
+    Returns a 128 bit identifier: a 48 bit millisecond timestamp followed by 80 random bits (the same layout as a ULID).
+    Usernames generated later sort after earlier ones and two usernames can only collide when generated in the same
+    millisecond, so no database query is needed to pick one.
+    """
+    value = (int(time.time() * 1000) << 80) | int(binascii.hexlify(os.urandom(10)), 16)
+    digits = []
+    while value:
+        value, remainder = divmod(value, 36)
+        digits.append(USERNAME_ALPHABET[remainder])
+    return ''.join(reversed(digits)).rjust(USERNAME_LENGTH, '0')
 
 
 def get_uuid_username():
-    username = get_uuid_username_string()
-    try:
-        # We use AuthUser here because it's more straight forward and we don't need to check the subclassed user since we just need a count
-        while auth_models.User.objects.get(username=username).count() > 0:
-            username = get_uuid_username_string()
-    except auth_models.User.DoesNotExist:
-        pass
-    return username
+    """
+    Returns a new username without checking the database. EmailExtendedUser.save() retries with a fresh username in
+    the unlikely event of a collision.
+    """
+    return get_uuid_username_string()
+
+
+def normalize_email(email):
+    """
+    Returns the canonical form of `email` stored in ExtendedUser.email_normalized: stripped and lower cased. Empty
+    addresses become None so that they never collide under a unique index.
+    """
+    if not email:
+        return None
+    return email.strip().lower()
+
+
+def has_normalized_email(model):
+    if isinstance(model, LazyModel):
+        model = model.resolve()
+    return isinstance(model, type) and issubclass(model, ExtendedUser)
+
+
+def get_email_lookup(model, email):
+    """
+    Returns filter() keyword arguments that match `email` case-insensitively on `model`. Uses the indexed
+    email_normalized column when `model` has one and falls back to an email__iexact scan (auth.User) otherwise. An empty
+    address matches nobody, rather than every user without one.
+    """
+    normalized = normalize_email(email)
+    if normalized is None:
+        # Django answers an empty __in without a query
+        return {'pk__in': []}
+    if has_normalized_email(model):
+        return {'email_normalized': normalized}
+    return {'email__iexact': email}
+
+
+def email_is_taken(email, exclude_id=None):
+    """
+    The email uniqueness check shared by UniqueRequiredEmailField and EmailExtendedUser: a single EXISTS query, against
+    the indexed email_normalized column when the user model has one.
+    """
+    if normalize_email(email) is None:
+        return False
+    queryset = User.objects.filter(**get_email_lookup(User, email))
+    if exclude_id is not None:
+        queryset = queryset.exclude(pk=exclude_id)
+    with metrics.timer('uniqueness.email'):
+        taken = queryset.exists()
+    if taken:
+        metrics.incr('uniqueness.email_taken')
+    return taken
 
 
 class UserManager(auth_models.UserManager):
@@ -50,14 +126,52 @@ class ExtendedUser(auth_models.User):
     """
     _is_email_only = False
 
+    # Lower cased copy of auth.User.email, kept in sync by save(). auth_user.email can only be searched case-insensitively
+    # with a full scan, this column can be searched through a plain index. Run `manage.py sky_visitor_normalize_emails`
+    # after adding it to an existing table.
+    email_normalized = models.CharField(max_length=75, null=True, blank=True, editable=False, db_index=True,
+                                        unique=get_app_setting('SKY_VISITOR_EMAIL_NORMALIZED_UNIQUE'))
+
     # Redefining objects is needed because of our subclassing. Weird quirk. Any subclass of this model also needs to define BaseUserManager as well.
     objects = UserManager()
 
     class Meta:
         abstract = True
 
+    def __init__(self, *args, **kwargs):
+        super(ExtendedUser, self).__init__(*args, **kwargs)
+        # What the database holds for this user when it was loaded. Only trusted once _state.adding is False, which Django
+        # sets on loaded instances after __init__.
+        self.remember_saved_values()
+
+    def remember_saved_values(self):
+        # __dict__ rather than getattr() so that a deferred email isn't loaded
+        self._saved_email = normalize_email(self.__dict__.get('email'))
+
+    def has_saved_email(self):
+        """
+        Whether the email address is the one the database already holds for this user
+        """
+        return not self._state.adding and self.pk is not None and self._saved_email == normalize_email(self.email)
+
     def save(self, *args, **kwargs):
+        self.email_normalized = normalize_email(self.email)
+        if self.pk is None and not args and not kwargs.get('force_update'):
+            # Skip the SELECT Django runs on the child table to check whether the row exists. The parent row is inserted
+            # first, which gives this row a primary key even though it has never been saved.
+            kwargs.setdefault('force_insert', True)
         super(ExtendedUser, self).save(*args, **kwargs)
+        self.remember_saved_values()
+
+    def clear_pk(self):
+        """
+        Forget the primary keys assigned by a failed insert so the save can be retried
+        """
+        for parent, field in self._meta.parents.items():
+            setattr(self, parent._meta.pk.attname, None)
+            if field:
+                setattr(self, field.attname, None)
+        self.pk = None
 
 
 class EmailUserManager(UserManager):
@@ -88,6 +202,128 @@ class EmailUserManager(UserManager):
         user.save(using=self._db)
         return user
 
+    def bulk_create_users(self, rows, batch_size=500, processes=None):
+        """
+        Creates users from `rows` in batches of `batch_size`, without calling save() or sending any signals.
+
+        Each row is either an (email, password) tuple or a dict of field values that contains at least 'email'. Usernames
+        are generated, so a dict with 'username' or with keys that aren't fields of the model is reported as an error. Rows are
+        read lazily, so `rows` can be a generator over a file of any size. Per batch this runs one query to find emails
+        that are already taken, one multi-row INSERT per user table and one query to read back the new primary keys.
+        Passwords are hashed in a pool of `processes` worker processes (defaults to the number of CPUs, 1 hashes inline).
+
+        Returns a generator of BulkUserResult, one per row and in the same order. Nothing is created until it is iterated.
+        """
+        using = self._db or router.db_for_write(self.model)
+        if self.model._meta.parents.keys() != [auth_models.User]:
+            raise ValueError("bulk_create_users() only supports models that directly subclass auth.User")
+        rows = iter(rows)
+        pool = get_hashing_pool(processes)
+        try:
+            index = 0
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                for result in self._bulk_create_batch(batch, index, pool, using):
+                    yield result
+                index += len(batch)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def get_bulk_settable_fields(self):
+        """
+        Names a bulk_create_users() row may set: the model's fields but the primary key, parent link and username
+        """
+        parent_link = self.model._meta.parents[auth_models.User]
+        return set(f.name for f in self.model._meta.fields
+                   if not f.primary_key and f is not parent_link and f.name != 'username')
+
+    def _bulk_create_batch(self, batch, first_index, pool, using):
+        now = timezone.now()
+        results = [None] * len(batch)
+        pending = []
+        normalized_emails = set()
+        settable = self.get_bulk_settable_fields()
+        for offset, row in enumerate(batch):
+            if not isinstance(row, dict):
+                row = dict(zip(('email', 'password'), row))
+            else:
+                row = dict(row)
+            email = EmailUserManager.normalize_email(row.get('email') or '')
+            unknown = sorted(key for key in row if key not in settable)
+            if unknown:
+                results[offset] = BulkUserResult(first_index + offset, email, None,
+                                                 _("Fields that can't be set: %s") % ', '.join(unknown))
+                continue
+            try:
+                validate_email(email)
+            except ValidationError as e:
+                results[offset] = BulkUserResult(first_index + offset, email, None, e.messages[0])
+                continue
+            if normalize_email(email) in normalized_emails:
+                results[offset] = BulkUserResult(first_index + offset, email, None, self.model.error_messages['unique_email'])
+                continue
+            normalized_emails.add(normalize_email(email))
+            row['email'] = email
+            pending.append((offset, row))
+
+        taken = set()
+        if normalized_emails and self.model.validate_email_uniqueness:
+            taken.update(self.using(using).filter(email_normalized__in=normalized_emails).values_list('email_normalized', flat=True))
+        creatable = []
+        for offset, row in pending:
+            if normalize_email(row['email']) in taken:
+                results[offset] = BulkUserResult(first_index + offset, row['email'], None, self.model.error_messages['unique_email'])
+            else:
+                creatable.append((offset, row))
+
+        if creatable:
+            passwords = hash_passwords([row.pop('password', None) for offset, row in creatable], pool=pool)
+            users = []
+            for (offset, row), password in zip(creatable, passwords):
+                values = {'is_staff': False, 'is_active': True, 'is_superuser': False, 'last_login': now, 'date_joined': now}
+                values.update(row)
+                user = self.model(username=get_uuid_username(), password=password, **values)
+                user.email_normalized = normalize_email(user.email)
+                users.append(user)
+            try:
+                ids = self._bulk_insert(users, using)
+            except IntegrityError as e:
+                # Most likely a concurrent signup took one of these addresses. The batch was rolled back as a whole.
+                for offset, row in creatable:
+                    results[offset] = BulkUserResult(first_index + offset, row['email'], None, unicode(e))
+            else:
+                for (offset, row), user in zip(creatable, users):
+                    results[offset] = BulkUserResult(first_index + offset, row['email'], ids[user.username], None)
+        return results
+
+    def _bulk_insert(self, users, using):
+        """
+        Inserts `users` into the auth_user table and then the subclass table in one transaction, returning a username
+        to id mapping. QuerySet.bulk_create() can't be used because it refuses inherited models and commits on its own.
+        """
+        with transaction.commit_on_success(using=using):
+            parent_fields = [f for f in auth_models.User._meta.local_fields if not f.primary_key]
+            self._insert_rows(auth_models.User, users, parent_fields, using)
+            ids = dict(auth_models.User.objects.using(using).filter(username__in=[user.username for user in users]).values_list('username', 'id'))
+            parent_link = self.model._meta.parents[auth_models.User]
+            for user in users:
+                user.id = ids[user.username]
+                setattr(user, parent_link.attname, user.id)
+            self._insert_rows(self.model, users, self.model._meta.local_fields, using)
+        return ids
+
+    def _insert_rows(self, model, objs, fields, using):
+        batch_size = max(connections[using].ops.bulk_batch_size(fields, objs), 1)
+        for start in range(0, len(objs), batch_size):
+            model._base_manager._insert(objs[start:start + batch_size], fields=fields, using=using)
+
+
+# The outcome of one row passed to EmailUserManager.bulk_create_users(). `error` is None when the user was created.
+BulkUserResult = namedtuple('BulkUserResult', ['index', 'email', 'user_id', 'error'])
+
 
 class EmailExtendedUser(ExtendedUser):
     """
@@ -95,6 +331,11 @@ class EmailExtendedUser(ExtendedUser):
     """
     _is_email_only = True
     validate_email_uniqueness = True
+    # EMAIL_UNIQUENESS_QUERY checks with a query before saving. EMAIL_UNIQUENESS_INDEX skips the query and relies on the
+    # unique index created when SKY_VISITOR_EMAIL_NORMALIZED_UNIQUE is True, turning the resulting IntegrityError into a
+    # ValidationError.
+    email_uniqueness_mode = EMAIL_UNIQUENESS_QUERY
+    _unique_email = None
     error_messages = {
         'unique_email': _("This email address is already in use. Please supply a different email address."),
     }
@@ -109,21 +350,170 @@ class EmailExtendedUser(ExtendedUser):
         abstract = True
 
     def save(self, allow_email_uniqueness_validation=True, *args, **kwargs):
-        if not self.pk and not self.username:
+        generate_username = not self.pk and not self.username
+        if generate_username:
             self.username = get_uuid_username()
         if allow_email_uniqueness_validation:
             self.validate_email_is_unique()
-        super(EmailExtendedUser, self).save(*args, **kwargs)
+        rely_on_index = allow_email_uniqueness_validation and self.validate_email_uniqueness and self.email_uniqueness_mode == EMAIL_UNIQUENESS_INDEX
+        if not generate_username and not rely_on_index:
+            return super(EmailExtendedUser, self).save(*args, **kwargs)
+
+        # Optimistically insert and only pick another username (or report the duplicate email) if the database objects
+        is_new = self.pk is None
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        attempts = USERNAME_MAX_ATTEMPTS if generate_username else 1
+        # savepoint() returns an id either way, but rolling back to it only works on backends that use savepoints
+        uses_savepoints = connections[using].features.uses_savepoints
+        for attempt in range(1, attempts + 1):
+            sid = transaction.savepoint(using=using)
+            try:
+                super(EmailExtendedUser, self).save(*args, **kwargs)
+            except IntegrityError:
+                if uses_savepoints:
+                    transaction.savepoint_rollback(sid, using=using)
+                elif transaction.is_managed(using=using):
+                    # No savepoint to roll back to and the caller's transaction goes on: the auth_user row inserted
+                    # before the subclass table's unique index failed would be committed with it
+                    if is_new and self.id is not None:
+                        auth_models.User.objects.using(using).filter(pk=self.id).delete()
+                else:
+                    transaction.rollback_unless_managed(using=using)
+                if is_new:
+                    self.clear_pk()
+                if rely_on_index and email_is_taken(self.email, exclude_id=self.pk):
+                    raise ValidationError({'email': self.error_messages['unique_email']})
+                if attempt == attempts:
+                    raise
+                metrics.incr('uniqueness.username_collision')
+                self.username = get_uuid_username()
+            else:
+                if sid:
+                    transaction.savepoint_commit(sid, using=using)
+                self.mark_email_unique(self.email)
+                return
 
     def validate_email_is_unique(self, force_validation=False):
-        from sky_visitor.utils import SubclassedUser as User
-        if self.validate_email_uniqueness or force_validation:
-            if User.objects.filter(email__iexact=self.email).exclude(id=self.id).exists():
-                raise ValidationError({'email': self.error_messages['unique_email']})
+        """
+        Raises a ValidationError if another user has this email address. Runs at most one query per email address: the
+        result is remembered on the instance, so clean() followed by save() only checks once. In index mode the check is
+        left to the database unless `force_validation` is True.
+        """
+        if not (self.validate_email_uniqueness or force_validation):
+            return
+        if self.email_uniqueness_mode == EMAIL_UNIQUENESS_INDEX and not force_validation:
+            return
+        if self._unique_email is not None and self._unique_email == normalize_email(self.email):
+            return
+        if self.has_saved_email():
+            # Unchanged since it was loaded
+            return
+        if email_is_taken(self.email, exclude_id=self.pk):
+            raise ValidationError({'email': self.error_messages['unique_email']})
+        self.mark_email_unique(self.email)
+
+    def mark_email_unique(self, email):
+        """
+        Record that `email` is known to be unique, for example because a form field already checked it
+        """
+        self._unique_email = normalize_email(email)
 
     def clean(self):
         """
         Validate uniqueness of the email address here. If you're concerned about the extra query and any perforamce issues,
-        you can disable this by settings `validate_email_uniqueness` to False and handling uniqueness yourself.
+        you can disable this by settings `validate_email_uniqueness` to False and handling uniqueness yourself, or set
+        `email_uniqueness_mode` to EMAIL_UNIQUENESS_INDEX and make email_normalized unique.
         """
         self.validate_email_is_unique()
+
+class QueuedEmail(models.Model):
+    """
+    An outgoing email waiting in the outbox. Used when SKY_VISITOR_EMAIL_DELIVERY is 'queue', see sky_visitor.outbox.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_DEAD = 'dead'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_SENDING, _("Sending")),
+        (STATUS_SENT, _("Sent")),
+        (STATUS_DEAD, _("Dead")),
+    )
+
+    from_email = models.CharField(max_length=255)
+    # One address per line
+    recipients = models.TextField()
+    subject = models.TextField()
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # When a worker marked it as sending, see SKY_VISITOR_EMAIL_CLAIM_TIMEOUT
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'%s to %s' % (self.subject, ', '.join(self.get_recipients()))
+
+    def get_recipients(self):
+        return self.recipients.splitlines()
+
+
+def versions_in_use():
+    """
+    Whether anything reads user_generations and permission_versions: the permission cache or snapshot sessions
+    """
+    from django.conf import settings
+    from sky_visitor.snapshot import SNAPSHOT_MIDDLEWARE
+    return get_app_setting('SKY_VISITOR_PERMISSION_CACHE_ENABLED') or SNAPSHOT_MIDDLEWARE in settings.MIDDLEWARE_CLASSES
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    """
+    Drop cached copies of a user whenever it is saved (this includes password changes) or deleted
+    """
+    if isinstance(instance, auth_models.User):
+        invalidate_user(instance.pk)
+        if versions_in_use():
+            user_generations.bump(instance.pk)
+
+post_save.connect(invalidate_cached_user, dispatch_uid='sky_visitor.invalidate_cached_user.post_save')
+post_delete.connect(invalidate_cached_user, dispatch_uid='sky_visitor.invalidate_cached_user.post_delete')
+
+
+def bump_permission_versions(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Mark cached permissions stale when a user's permissions or groups, or a group's permissions, change
+    """
+    if not action.startswith('post_') or not versions_in_use():
+        return
+    if sender is auth_models.Group.permissions.through or (reverse and not pk_set):
+        # A group's permissions changed, or a permission/group was cleared from an unknown set of users
+        permission_versions.bump('groups')
+    elif reverse:
+        for user_id in pk_set:
+            permission_versions.bump(user_id)
+    else:
+        permission_versions.bump(instance.pk)
+
+for through in (auth_models.User.user_permissions.through, auth_models.User.groups.through, auth_models.Group.permissions.through):
+    m2m_changed.connect(bump_permission_versions, sender=through,
+                        dispatch_uid='sky_visitor.bump_permission_versions.%s' % through._meta.object_name)
+
+
+def bump_all_permission_versions(sender, **kwargs):
+    """
+    Groups and permissions being added or deleted can change the permissions of any user (superusers have them all)
+    """
+    if versions_in_use():
+        permission_versions.bump('groups')
+
+for model in (auth_models.Group, auth_models.Permission):
+    post_save.connect(bump_all_permission_versions, sender=model,
+                      dispatch_uid='sky_visitor.bump_all_permission_versions.post_save.%s' % model._meta.object_name)
+    post_delete.connect(bump_all_permission_versions, sender=model,
+                        dispatch_uid='sky_visitor.bump_all_permission_versions.post_delete.%s' % model._meta.object_name)
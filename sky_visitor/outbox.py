@@ -0,0 +1,134 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.db.models import F, Q
+from django.utils import timezone
+from sky_visitor import metrics
+from sky_visitor.models import QueuedEmail
+from sky_visitor.settings import get_app_setting
+
+
+def enqueue(message):
+    """
+    Stores an already rendered EmailMessage in the outbox instead of sending it. Returns the QueuedEmail.
+    """
+    html_body = ''
+    for content, mimetype in getattr(message, 'alternatives', []):
+        if mimetype == 'text/html':
+            html_body = content
+    return QueuedEmail.objects.create(from_email=message.from_email, recipients='\n'.join(message.recipients()),
+                                      subject=message.subject, body=message.body, html_body=html_body)
+
+
+def to_message(queued_email, connection=None):
+    if not queued_email.html_body:
+        return EmailMessage(queued_email.subject, queued_email.body, queued_email.from_email, queued_email.get_recipients(),
+                            connection=connection)
+    message = EmailMultiAlternatives(queued_email.subject, queued_email.body, queued_email.from_email,
+                                     queued_email.get_recipients(), connection=connection)
+    message.attach_alternative(queued_email.html_body, 'text/html')
+    return message
+
+
+def get_retry_delay(attempts):
+    """
+    Seconds to wait before the next attempt after `attempts` failed ones: SKY_VISITOR_EMAIL_RETRY_DELAY, doubling each time
+    """
+    return get_app_setting('SKY_VISITOR_EMAIL_RETRY_DELAY') * 2 ** (attempts - 1)
+
+
+def send_queued_email(limit=None, connection=None):
+    """
+    Sends outbox messages that are due, oldest first, over a single connection. A message that fails is retried with
+    exponential backoff and marked dead after SKY_VISITOR_EMAIL_MAX_ATTEMPTS attempts.
+
+    Each message is claimed with a conditional UPDATE before it is sent, so several workers can drain the same outbox.
+    A claim is a lease of SKY_VISITOR_EMAIL_CLAIM_TIMEOUT seconds: messages left marked as sending by a worker that died
+    are claimed again once it runs out. Claiming counts as an attempt, and an expired claim that already used up
+    SKY_VISITOR_EMAIL_MAX_ATTEMPTS is marked dead instead, so a message that keeps killing its worker ends up dead too.
+    Returns a dict of counts: sent, failed (will be retried) and dead.
+    """
+    max_attempts = get_app_setting('SKY_VISITOR_EMAIL_MAX_ATTEMPTS')
+    counts = {'sent': 0, 'failed': 0, 'dead': dead_letter_expired(max_attempts)}
+    due = QueuedEmail.objects.filter(get_claimable(max_attempts)).order_by('next_attempt_at', 'pk')
+    if limit is not None:
+        due = due[:limit]
+    if connection is None:
+        connection = get_connection()
+    opened = connection.open()
+    try:
+        for queued_email in due:
+            _send_one(queued_email, connection, max_attempts, counts)
+    finally:
+        if opened:
+            connection.close()
+    return counts
+
+
+def get_claim_expiry(now):
+    return now - datetime.timedelta(seconds=get_app_setting('SKY_VISITOR_EMAIL_CLAIM_TIMEOUT'))
+
+
+def get_claimable(max_attempts, now=None):
+    """
+    Returns a Q matching messages that are due, or whose claim has expired with attempts left
+    """
+    if now is None:
+        now = timezone.now()
+    return (Q(status=QueuedEmail.STATUS_PENDING, next_attempt_at__lte=now)
+            | Q(status=QueuedEmail.STATUS_SENDING, claimed_at__lt=get_claim_expiry(now), attempts__lt=max_attempts))
+
+
+def dead_letter_expired(max_attempts):
+    """
+    Marks dead the messages whose claim expired on their last attempt, i.e. that crashed or hung their worker every time.
+    Returns how many there were.
+    """
+    dead = QueuedEmail.objects.filter(status=QueuedEmail.STATUS_SENDING, claimed_at__lt=get_claim_expiry(timezone.now()),
+                                      attempts__gte=max_attempts).update(
+        status=QueuedEmail.STATUS_DEAD, claimed_at=None, last_error=u"Claim expired on the last attempt")
+    if dead:
+        metrics.incr('email.claim_expired', dead)
+    return dead
+
+
+def _send_one(queued_email, connection, max_attempts, counts):
+    now = timezone.now()
+    claimed = QueuedEmail.objects.filter(get_claimable(max_attempts, now), pk=queued_email.pk).update(
+        status=QueuedEmail.STATUS_SENDING, claimed_at=now, attempts=F('attempts') + 1)
+    if not claimed:
+        # Another worker got to it first
+        return
+    queued_email.attempts += 1
+    queued_email.claimed_at = None
+    try:
+        with metrics.timer('email.send'):
+            to_message(queued_email, connection=connection).send()
+    except Exception as e:
+        metrics.incr('email.send_failed')
+        queued_email.last_error = u'%s: %s' % (e.__class__.__name__, e)
+        if queued_email.attempts >= max_attempts:
+            queued_email.status = QueuedEmail.STATUS_DEAD
+            counts['dead'] += 1
+        else:
+            queued_email.status = QueuedEmail.STATUS_PENDING
+            queued_email.next_attempt_at = timezone.now() + datetime.timedelta(seconds=get_retry_delay(queued_email.attempts))
+            counts['failed'] += 1
+    else:
+        queued_email.status = QueuedEmail.STATUS_SENT
+        queued_email.sent_at = timezone.now()
+        counts['sent'] += 1
+    queued_email.save()
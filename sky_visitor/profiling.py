@@ -0,0 +1,201 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from django.core import signing
+from sky_visitor.settings import get_app_setting
+
+# request.META key of the X-Sky-Visitor-Profile header that asks for a request to be profiled
+TRIGGER_HEADER = 'HTTP_X_SKY_VISITOR_PROFILE'
+TRIGGER_SALT = 'sky_visitor.profiling.trigger'
+# Response header naming the file a triggered profile was written to
+PROFILE_FILE_HEADER = 'X-Sky-Visitor-Profile-File'
+
+PROFILE_EXTENSIONS = {'cprofile': '.prof', 'sampler': '.samples'}
+
+
+def format_function(filename, lineno, name):
+    # Same as pstats.func_std_string()
+    return '%s:%d(%s)' % (filename, lineno, name)
+
+
+class WallClockSampler(object):
+    """
+    Records the stack of the thread that started it every `interval` seconds, from a background thread. Unlike cProfile
+    it doesn't slow down the code it watches and it sees time spent waiting (database, cache, locks), at the price of
+    only seeing what runs long enough to be sampled.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = {}
+
+    def start(self):
+        self.thread_id = threading.current_thread().ident
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sky_visitor profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(format_function(code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        """
+        Writes the samples as collapsed stacks ("outer;inner;leaf <count>" per line), the input format of flame graph tools
+        """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class RequestProfiler(object):
+    """
+    Profiles a share of requests (SKY_VISITOR_PROFILE_SAMPLE_RATE) plus every request carrying a valid trigger header,
+    and writes each profile to SKY_VISITOR_PROFILE_DIR, keeping the newest SKY_VISITOR_PROFILE_MAX_FILES.
+    """
+
+    def make_trigger(self):
+        """
+        Returns a value for the X-Sky-Visitor-Profile header, valid for SKY_VISITOR_PROFILE_TRIGGER_MAX_AGE seconds
+        """
+        return signing.dumps('profile', salt=TRIGGER_SALT)
+
+    def check_trigger(self, value):
+        try:
+            return signing.loads(value, salt=TRIGGER_SALT,
+                                 max_age=get_app_setting('SKY_VISITOR_PROFILE_TRIGGER_MAX_AGE')) == 'profile'
+        except signing.BadSignature:
+            return False
+
+    def is_triggered(self, request):
+        value = request.META.get(TRIGGER_HEADER)
+        return bool(value) and self.check_trigger(value)
+
+    def is_sampled(self):
+        rate = get_app_setting('SKY_VISITOR_PROFILE_SAMPLE_RATE')
+        return bool(rate) and random.random() < rate
+
+    def get_directory(self):
+        return get_app_setting('SKY_VISITOR_PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'sky_visitor_profiles')
+
+    def make_path(self, name, mode):
+        directory = self.get_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Starts with the time in milliseconds, so file names sort oldest first
+        filename = '%d-%s-%d-%04x%s' % (time.time() * 1000, name, os.getpid(), random.getrandbits(16),
+                                        PROFILE_EXTENSIONS[mode])
+        return os.path.join(directory, filename)
+
+    def rotate(self):
+        directory = self.get_directory()
+        filenames = sorted(filename for filename in os.listdir(directory)
+                           if os.path.splitext(filename)[1] in PROFILE_EXTENSIONS.values())
+        for filename in filenames[:-get_app_setting('SKY_VISITOR_PROFILE_MAX_FILES')]:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except OSError:
+                # Removed by another process
+                pass
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Returns func(*args, **kwargs), profiled with SKY_VISITOR_PROFILE_MODE. The profile is saved as `name` and its
+        path returned as well.
+        """
+        mode = get_app_setting('SKY_VISITOR_PROFILE_MODE')
+        if mode == 'sampler':
+            profiler = WallClockSampler(get_app_setting('SKY_VISITOR_PROFILE_SAMPLER_INTERVAL'))
+            profiler.start()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                profiler.stop()
+        else:
+            profiler = cProfile.Profile()
+            result = profiler.runcall(func, *args, **kwargs)
+        try:
+            path = self.make_path(name, mode)
+            if mode == 'sampler':
+                profiler.dump(path)
+            else:
+                profiler.dump_stats(path)
+            self.rotate()
+        except EnvironmentError:
+            # A full or read-only disk must not fail the request
+            path = None
+        return result, path
+
+
+request_profiler = RequestProfiler()
+
+
+def list_profiles(directory, mode, name=None):
+    """
+    Returns the paths of the profiles of `mode` saved in `directory`, oldest first, only those of view `name` if given
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for filename in sorted(os.listdir(directory)):
+        if os.path.splitext(filename)[1] != PROFILE_EXTENSIONS[mode]:
+            continue
+        if name is not None and get_profile_name(filename) != name:
+            continue
+        paths.append(os.path.join(directory, filename))
+    return paths
+
+
+def get_profile_name(path):
+    return os.path.basename(path).split('-')[1]
+
+
+def summarize_samples(paths):
+    """
+    Returns the number of samples in the collapsed stack files at `paths` and a list of (function, self samples, total
+    samples) for every function seen. Self samples are those where the function was running, total samples those where
+    it was anywhere on the stack.
+    """
+    samples = 0
+    functions = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                count = int(count)
+                samples += count
+                frames = stack.split(';')
+                for function in set(frames):
+                    functions.setdefault(function, [0, 0])[1] += count
+                functions[frames[-1]][0] += count
+    return samples, [(function, counts[0], counts[1]) for function, counts in functions.items()]
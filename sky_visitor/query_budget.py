@@ -0,0 +1,119 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import difflib
+import json
+import os
+from functools import wraps
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+
+# Set this environment variable to write the recorded queries to the budget files instead of failing
+UPDATE_BUDGETS_ENV = 'SKY_VISITOR_UPDATE_QUERY_BUDGETS'
+
+
+class QueryRecorder(object):
+    """
+    Context manager that records the SQL run on `connection`, without parameters, across any number of test client
+    requests (which normally reset connection.queries when they start).
+    """
+
+    def __init__(self, connection=connection):
+        self.connection = connection
+        self.queries = []
+
+    def __enter__(self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        # Keep the statement rather than the statement with its parameters filled in, so budgets don't depend on ids,
+        # timestamps or salts
+        self.connection.ops.last_executed_query = lambda cursor, sql, params: sql
+        request_started.disconnect(reset_queries)
+        self.start = len(self.connection.queries)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        request_started.connect(reset_queries)
+        del self.connection.ops.last_executed_query
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        self.queries = [query['sql'] for query in self.connection.queries[self.start:]]
+
+
+class QueryBudgetMixin(object):
+    """
+    TestCase mixin that holds flows to the queries recorded in `query_budget_file`, a JSON file of
+    {flow name: [SQL, ...]} checked in next to the tests:
+
+        with self.assertQueryBudget('login'):
+            self.client.post('/user/login/', data)
+
+    A flow that runs more queries than its budget fails with a diff of the SQL. Running the tests with
+    SKY_VISITOR_UPDATE_QUERY_BUDGETS=1 writes the recorded queries to the file instead, to be reviewed and committed
+    along with the change that made them necessary.
+    """
+    query_budget_file = None
+
+    def get_query_budgets(self):
+        if not os.path.exists(self.query_budget_file):
+            return {}
+        with open(self.query_budget_file) as f:
+            return json.load(f)
+
+    def update_query_budget(self, name, queries):
+        budgets = self.get_query_budgets()
+        budgets[name] = queries
+        with open(self.query_budget_file, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def check_query_budget(self, name, queries):
+        if os.environ.get(UPDATE_BUDGETS_ENV):
+            self.update_query_budget(name, queries)
+            return
+        budget = self.get_query_budgets().get(name)
+        if budget is None:
+            self.fail("No query budget for %r in %s. Run the tests with %s=1 to record one."
+                      % (name, self.query_budget_file, UPDATE_BUDGETS_ENV))
+        if len(queries) > len(budget):
+            diff = '\n'.join(difflib.unified_diff(budget, queries, 'budget', 'recorded', lineterm=''))
+            self.fail("%r ran %d queries, over its budget of %d:\n%s" % (name, len(queries), len(budget), diff))
+
+    def assertQueryBudget(self, name):
+        return QueryBudgetContext(self, name)
+
+
+class QueryBudgetContext(QueryRecorder):
+
+    def __init__(self, test_case, name):
+        super(QueryBudgetContext, self).__init__()
+        self.test_case = test_case
+        self.name = name
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(QueryBudgetContext, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            self.test_case.check_query_budget(self.name, self.queries)
+
+
+def query_budget(name):
+    """
+    Decorator for the test methods of a QueryBudgetMixin test case. Holds the whole test to the budget of `name`.
+    """
+    def decorator(test_method):
+        @wraps(test_method)
+        def wrapper(self, *args, **kwargs):
+            with self.assertQueryBudget(name):
+                return test_method(self, *args, **kwargs)
+        return wrapper
+    return decorator
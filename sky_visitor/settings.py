@@ -15,6 +15,7 @@
 """
 Default settings. See __init__.py for code that injects these defaults
 """
+from django.test.signals import setting_changed
 
 # Defaults to auth.User in case you don't want to take advantage of user subclassing features of this app
 SKY_VISITOR_USER_MODEL = 'django.contrib.auth.User'
@@ -28,18 +29,233 @@ SKY_VISITOR_USER_MODEL = 'django.contrib.auth.User'
 # TODO: Implement this
 #SKY_VISITOR_EMAIL_LOGIN = False
 
+# Cache users loaded by BaseBackend.get_user() in the cache framework between requests. Users are always memoized for the
+# duration of a single request. Entries are invalidated when a user is saved or deleted.
+SKY_VISITOR_USER_CACHE_ENABLED = False
+SKY_VISITOR_USER_CACHE_ALIAS = 'default'
+SKY_VISITOR_USER_CACHE_TIMEOUT = 300
+# Bump this to orphan every cached user, for example after adding fields to your user model
+SKY_VISITOR_USER_CACHE_VERSION = 1
+
+# Put a unique index on ExtendedUser.email_normalized. Combine with `email_uniqueness_mode = EMAIL_UNIQUENESS_INDEX` to
+# have the database enforce email uniqueness instead of a query before every save.
+SKY_VISITOR_EMAIL_NORMALIZED_UNIQUE = False
+
+# Number of worker processes that check and set passwords (sky_visitor.hashing). 0 hashes on the request thread.
+SKY_VISITOR_HASHING_PROCESSES = 0
+# Hashes that may be queued or running at once. Defaults to twice SKY_VISITOR_HASHING_PROCESSES.
+SKY_VISITOR_HASHING_MAX_PENDING = None
+# Seconds a login waits for a free slot before it is turned away with a "try again" error. None waits forever.
+SKY_VISITOR_HASHING_QUEUE_TIMEOUT = 5
+
+# 'immediate' sends token emails (forgot password, invitations) during the request. 'queue' stores them in the outbox
+# for `manage.py sky_visitor_send_queued_email` to deliver.
+SKY_VISITOR_EMAIL_DELIVERY = 'immediate'
+# Failed deliveries are retried after SKY_VISITOR_EMAIL_RETRY_DELAY seconds, doubling each time, until the message has
+# been tried SKY_VISITOR_EMAIL_MAX_ATTEMPTS times. Then it is marked dead.
+SKY_VISITOR_EMAIL_MAX_ATTEMPTS = 5
+SKY_VISITOR_EMAIL_RETRY_DELAY = 60
+# Seconds a worker may hold a message it claimed. Messages still marked as sending after that (the worker died) are
+# claimed again by the next run.
+SKY_VISITOR_EMAIL_CLAIM_TIMEOUT = 600
+
+# Keep compiled email templates and reversed token URLs for the life of the process. None turns the cache on only when
+# DEBUG is off.
+SKY_VISITOR_EMAIL_TEMPLATE_CACHE = None
+
+# TokenValidateMixin remembers (uidb36, token) pairs that failed validation for this many seconds and rejects them
+# without a query. 0 turns this off. Kept in the SKY_VISITOR_TOKEN_USER_CACHE_ALIAS cache.
+SKY_VISITOR_INVALID_TOKEN_CACHE_TIMEOUT = 300
+# Keep the user a valid token belongs to in the cache so the GET and POST of a token URL only load it once. Users are
+# invalidated when saved, so only turn this on when every process shares the same cache backend.
+SKY_VISITOR_TOKEN_USER_CACHE_ENABLED = False
+SKY_VISITOR_TOKEN_USER_CACHE_ALIAS = 'default'
+SKY_VISITOR_TOKEN_USER_CACHE_TIMEOUT = 60
+SKY_VISITOR_TOKEN_USER_CACHE_VERSION = 1
+
+# Reject logins and password reset requests that exceed SKY_VISITOR_THROTTLE_RULES before any query or password hash.
+# Only failed logins count towards the login limits; every password reset request counts.
+SKY_VISITOR_THROTTLE_ENABLED = False
+# Counters are kept in this cache. They fall back to process memory when it is a DummyCache or unreachable.
+SKY_VISITOR_THROTTLE_CACHE_ALIAS = 'default'
+# Per action, (scope, limit, window in seconds) tuples. Scopes are 'ip', 'account' and 'ip_account'.
+SKY_VISITOR_THROTTLE_RULES = {
+    'login': [('ip', 50, 300), ('account', 10, 300), ('ip_account', 5, 300)],
+    'forgot_password': [('ip', 20, 3600), ('account', 3, 3600)],
+}
+
+# Make logins for unknown users as slow as logins with a wrong password, so response times don't reveal which accounts
+# exist. The first miss for an identifier runs a dummy hash; further misses within SKY_VISITOR_MISSING_USER_CACHE_TIMEOUT
+# seconds sleep for the same time instead of hashing again (0 hashes on every miss). Uses SKY_VISITOR_USER_CACHE_ALIAS.
+SKY_VISITOR_DUMMY_HASH_ON_MISS = False
+SKY_VISITOR_MISSING_USER_CACHE_TIMEOUT = 300
+
+# Iterations for new password hashes, for hashers that have an iteration count (PBKDF2). None uses the hasher's default,
+# or the count that makes a hash take SKY_VISITOR_HASH_TARGET_SECONDS on this machine when that is set, measured by
+# sky_visitor.hashing_policy.policy.calibrate(). Never goes below the hasher's default. See
+# `manage.py sky_visitor_tune_hasher`.
+SKY_VISITOR_HASH_ITERATIONS = None
+SKY_VISITOR_HASH_TARGET_SECONDS = None
+# Rehash passwords on login when the stored hash uses another hasher or fewer iterations than the above. The new hash is
+# saved after the response has been sent.
+SKY_VISITOR_HASH_UPGRADE_ON_LOGIN = False
+
+# Http403Middleware: render 403.html once per language and host and serve the cached body, instead of rendering it with
+# a full RequestContext (every context processor) for each denied request. Answer clients whose Accept header prefers
+# application/json with a small JSON body.
+SKY_VISITOR_403_CACHE = False
+SKY_VISITOR_403_JSON = True
+
+# Keep the permission sets computed by the sky_visitor backends in the SKY_VISITOR_USER_CACHE_ALIAS cache. Entries are
+# marked stale when the user, its groups or permissions, or any group's permissions change, so every process must share
+# that cache.
+SKY_VISITOR_PERMISSION_CACHE_ENABLED = False
+SKY_VISITOR_PERMISSION_CACHE_TIMEOUT = 300
+
+# Where timings and counters for backend lookups, password hashing, tokens, emails and uniqueness checks go: None (off),
+# 'sky_visitor.metrics.MemorySink' (added up in each process), 'sky_visitor.metrics.StatsdSink' (StatsD over UDP to
+# SKY_VISITOR_METRICS_STATSD_HOST:PORT) or the dotted path of your own class with incr() and timing() methods.
+SKY_VISITOR_METRICS_SINK = None
+SKY_VISITOR_METRICS_PREFIX = 'sky_visitor'
+SKY_VISITOR_METRICS_STATSD_HOST = 'localhost'
+SKY_VISITOR_METRICS_STATSD_PORT = 8125
+
+# Profile this share (0 to 1) of the requests to the sky_visitor views, plus every request with an X-Sky-Visitor-Profile
+# header made by `manage.py sky_visitor_profile --trigger` in the last SKY_VISITOR_PROFILE_TRIGGER_MAX_AGE seconds.
+# SKY_VISITOR_PROFILE_MODE is 'cprofile' (every function call, slows the request down) or 'sampler' (the stack every
+# SKY_VISITOR_PROFILE_SAMPLER_INTERVAL seconds). Profiles are written to SKY_VISITOR_PROFILE_DIR (default
+# <temp dir>/sky_visitor_profiles), which keeps the newest SKY_VISITOR_PROFILE_MAX_FILES.
+SKY_VISITOR_PROFILE_SAMPLE_RATE = 0
+SKY_VISITOR_PROFILE_TRIGGER_MAX_AGE = 3600
+SKY_VISITOR_PROFILE_MODE = 'cprofile'
+SKY_VISITOR_PROFILE_SAMPLER_INTERVAL = 0.005
+SKY_VISITOR_PROFILE_DIR = None
+SKY_VISITOR_PROFILE_MAX_FILES = 200
+
+
+app_default_settings = dict((k, v) for k, v in vars().items() if k.startswith('SKY_VISITOR_'))
+
+
+def _is_int(value, minimum=0):
+    return isinstance(value, (int, long)) and not isinstance(value, bool) and value >= minimum
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool) and value >= 0
+
+def _is_cache_alias(value):
+    from django.conf import settings
+    return value in settings.CACHES
+
+def _is_throttle_rules(value):
+    return isinstance(value, dict) and all(
+        isinstance(rules, (list, tuple)) and all(
+            len(rule) == 3 and rule[0] in ('ip', 'account', 'ip_account') and _is_int(rule[1], 1) and _is_int(rule[2], 1)
+            for rule in rules)
+        for rules in value.values())
+
+# What AppSettings.validate() expects of each setting, with the message shown when it doesn't hold
+SETTING_CHECKS = {
+    'SKY_VISITOR_USER_MODEL': (lambda v: isinstance(v, basestring) and '.' in v, "a dotted path like 'myapp.User'"),
+    'SKY_VISITOR_USER_CACHE_ENABLED': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_USER_CACHE_ALIAS': (_is_cache_alias, "a key of CACHES"),
+    'SKY_VISITOR_USER_CACHE_TIMEOUT': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_USER_CACHE_VERSION': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_EMAIL_NORMALIZED_UNIQUE': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_HASHING_PROCESSES': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_HASHING_MAX_PENDING': (lambda v: v is None or _is_int(v, 1), "None or an integer >= 1"),
+    'SKY_VISITOR_HASHING_QUEUE_TIMEOUT': (lambda v: v is None or _is_number(v), "None or a number >= 0"),
+    'SKY_VISITOR_EMAIL_DELIVERY': (lambda v: v in ('immediate', 'queue'), "'immediate' or 'queue'"),
+    'SKY_VISITOR_EMAIL_MAX_ATTEMPTS': (lambda v: _is_int(v, 1), "an integer >= 1"),
+    'SKY_VISITOR_EMAIL_RETRY_DELAY': (_is_number, "a number >= 0"),
+    'SKY_VISITOR_EMAIL_CLAIM_TIMEOUT': (lambda v: _is_number(v) and v > 0, "a number > 0"),
+    'SKY_VISITOR_EMAIL_TEMPLATE_CACHE': (lambda v: v in (None, True, False), "None, True or False"),
+    'SKY_VISITOR_INVALID_TOKEN_CACHE_TIMEOUT': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_TOKEN_USER_CACHE_ENABLED': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_TOKEN_USER_CACHE_ALIAS': (_is_cache_alias, "a key of CACHES"),
+    'SKY_VISITOR_TOKEN_USER_CACHE_TIMEOUT': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_TOKEN_USER_CACHE_VERSION': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_THROTTLE_ENABLED': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_THROTTLE_CACHE_ALIAS': (lambda v: isinstance(v, basestring), "a key of CACHES"),
+    'SKY_VISITOR_THROTTLE_RULES': (_is_throttle_rules, "a dict of lists of (scope, limit, window) tuples"),
+    'SKY_VISITOR_DUMMY_HASH_ON_MISS': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_MISSING_USER_CACHE_TIMEOUT': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_HASH_ITERATIONS': (lambda v: v is None or _is_int(v, 1), "None or an integer >= 1"),
+    'SKY_VISITOR_HASH_TARGET_SECONDS': (lambda v: v is None or _is_number(v), "None or a number >= 0"),
+    'SKY_VISITOR_HASH_UPGRADE_ON_LOGIN': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_PERMISSION_CACHE_ENABLED': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_PERMISSION_CACHE_TIMEOUT': (_is_int, "an integer >= 0"),
+    'SKY_VISITOR_403_CACHE': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_403_JSON': (lambda v: isinstance(v, bool), "True or False"),
+    'SKY_VISITOR_METRICS_SINK': (lambda v: v is None or (isinstance(v, basestring) and '.' in v), "None or a dotted path to a class"),
+    'SKY_VISITOR_METRICS_PREFIX': (lambda v: isinstance(v, basestring), "a string"),
+    'SKY_VISITOR_METRICS_STATSD_HOST': (lambda v: isinstance(v, basestring) and bool(v), "a host name or address"),
+    'SKY_VISITOR_METRICS_STATSD_PORT': (lambda v: _is_int(v, 1), "an integer >= 1"),
+    'SKY_VISITOR_PROFILE_SAMPLE_RATE': (lambda v: _is_number(v) and v <= 1, "a number from 0 to 1"),
+    'SKY_VISITOR_PROFILE_TRIGGER_MAX_AGE': (lambda v: _is_int(v, 1), "an integer >= 1"),
+    'SKY_VISITOR_PROFILE_MODE': (lambda v: v in ('cprofile', 'sampler'), "'cprofile' or 'sampler'"),
+    'SKY_VISITOR_PROFILE_SAMPLER_INTERVAL': (lambda v: _is_number(v) and v > 0, "a number > 0"),
+    'SKY_VISITOR_PROFILE_DIR': (lambda v: v is None or isinstance(v, basestring), "None or a directory"),
+    'SKY_VISITOR_PROFILE_MAX_FILES': (lambda v: _is_int(v, 1), "an integer >= 1"),
+}
+
+
+class AppSettings(object):
+    """
+    The SKY_VISITOR_* settings as attributes (app_settings.SKY_VISITOR_USER_MODEL). Each one is read from the project
+    settings, falling back to the defaults above, the first time it's used and cached after that. The cache is cleared
+    when Django sends setting_changed (override_settings() and TestCase.settings() in tests).
+    """
+
+    def __init__(self, defaults):
+        self._defaults = defaults
+        self._cache = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._defaults:
+            raise AttributeError(name)
+        try:
+            return self._cache[name]
+        except KeyError:
+            from django.conf import settings
+            value = self._cache[name] = getattr(settings, name, self._defaults[name])
+            return value
+
+    def clear(self, setting=None, **kwargs):
+        if setting is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(setting, None)
+
+    def validate(self):
+        """
+        Raises ImproperlyConfigured listing every SKY_VISITOR_* setting with a value its code can't use
+        """
+        from django.core.exceptions import ImproperlyConfigured
+        errors = []
+        for name, (check, expected) in sorted(SETTING_CHECKS.items()):
+            value = getattr(self, name)
+            if not check(value):
+                errors.append("%s should be %s, not %r" % (name, expected, value))
+        if errors:
+            raise ImproperlyConfigured("Invalid sky_visitor settings:\n  " + "\n  ".join(errors))
+
+
+app_settings = AppSettings(app_default_settings)
+
+
+def _clear_app_settings(sender, setting=None, **kwargs):
+    app_settings.clear(setting)
+
+setting_changed.connect(_clear_app_settings, dispatch_uid='sky_visitor.settings.clear_app_settings')
 
-app_default_settings = vars()
 
 def get_app_setting(s, d=None):
     """
     Returns the first instance of the setting `s` that can be found in the order of priority: end user setting, the default `d` passed into the function, the app default setting specified in this file
     """
-    import sys
+    if d is None and s in app_default_settings:
+        return getattr(app_settings, s)
     from django.conf import settings
-    global app_default_settings
-    try:
-        app_default = app_default_settings[s]
-    except KeyError:
-        pass
-    return getattr(settings, s, d or app_default)
+    if d is None:
+        d = app_default_settings.get(s)
+    return getattr(settings, s, d)
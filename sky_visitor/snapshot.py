@@ -0,0 +1,182 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_logged_in
+from django.core import signing
+from sky_visitor.cache import get_user_versions
+
+SNAPSHOT_MIDDLEWARE = 'sky_visitor.middleware.SnapshotAuthenticationMiddleware'
+SNAPSHOT_SESSION_KEY = '_sky_visitor_user_snapshot'
+SNAPSHOT_SALT = 'sky_visitor.snapshot'
+# The user fields kept in a snapshot. Anything else loads the user.
+SNAPSHOT_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser')
+
+
+def get_versions(user_id):
+    """
+    Returns the (user generation, permission version) a snapshot of the user must carry to still be current
+    """
+    return get_user_versions(user_id)
+
+
+def make_snapshot(user):
+    """
+    Returns a signed string holding SNAPSHOT_FIELDS of `user` and the versions it was made at
+    """
+    data = dict((field, getattr(user, field)) for field in SNAPSHOT_FIELDS)
+    data['generation'], data['perm_version'] = get_versions(user.pk)
+    return signing.dumps(data, salt=SNAPSHOT_SALT, compress=True)
+
+
+def load_snapshot(value, user_id):
+    """
+    Returns the snapshot data in `value` if it's signed, belongs to `user_id` and the user hasn't changed since, or None
+    """
+    try:
+        data = signing.loads(value, salt=SNAPSHOT_SALT)
+    except signing.BadSignature:
+        return None
+    if data.get('id') != user_id:
+        return None
+    if (data.get('generation'), data.get('perm_version')) != get_versions(user_id):
+        return None
+    return data
+
+
+class SnapshotUser(object):
+    """
+    A request.user that answers from a session snapshot. SNAPSHOT_FIELDS, is_authenticated() and friends don't touch the
+    database. Anything else (has_perm(), save(), custom fields...) loads the user through `loader` once and is delegated
+    to it.
+    """
+
+    def __init__(self, data, loader):
+        self.__dict__['_snapshot'] = data
+        self.__dict__['_loader'] = loader
+        self.__dict__['_user'] = None
+        for field in SNAPSHOT_FIELDS:
+            self.__dict__[field] = data[field]
+        self.__dict__['pk'] = data['id']
+
+    def get_user(self):
+        """
+        Returns the full user, loading it on first use
+        """
+        if self._user is None:
+            self.__dict__['_user'] = self._loader()
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.get_user(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_user(), name, value)
+        if name in self.__dict__:
+            self.__dict__[name] = value
+
+    def __eq__(self, other):
+        return getattr(other, 'pk', None) == self.pk and hasattr(other, 'is_authenticated') and other.is_authenticated()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __unicode__(self):
+        return self.username
+
+    def __str__(self):
+        return self.username.encode('utf-8')
+
+    def is_anonymous(self):
+        return False
+
+    def is_authenticated(self):
+        return True
+
+    def get_full_name(self):
+        return (u'%s %s' % (self.first_name, self.last_name)).strip()
+
+    # Same as auth.User's, but asking the backends directly so that, with the sky_visitor backends and the permission
+    # cache, permission checks don't load the user either
+
+    def get_all_permissions(self, obj=None):
+        permissions = set()
+        for backend in auth.get_backends():
+            if hasattr(backend, 'get_all_permissions'):
+                permissions.update(backend.get_all_permissions(self, obj))
+        return permissions
+
+    def has_perm(self, perm, obj=None):
+        if self.is_active and self.is_superuser:
+            return True
+        for backend in auth.get_backends():
+            if hasattr(backend, 'has_perm') and backend.has_perm(self, perm, obj):
+                return True
+        return False
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, app_label):
+        if self.is_active and self.is_superuser:
+            return True
+        for backend in auth.get_backends():
+            if hasattr(backend, 'has_module_perms') and backend.has_module_perms(self, app_label):
+                return True
+        return False
+
+
+def get_user(request):
+    """
+    Same as django.contrib.auth.get_user(), but returns a SnapshotUser when the session has a current snapshot and the
+    backend supports them. Otherwise the user is loaded and a new snapshot stored.
+    """
+    try:
+        user_id = request.session[SESSION_KEY]
+        backend = load_backend(request.session[BACKEND_SESSION_KEY])
+    except KeyError:
+        return AnonymousUser()
+    if not hasattr(backend, 'make_snapshot'):
+        return backend.get_user(user_id) or AnonymousUser()
+
+    value = request.session.get(SNAPSHOT_SESSION_KEY)
+    data = load_snapshot(value, user_id) if value else None
+    if data is not None:
+        return backend.get_snapshot_user(data, lambda: backend.get_user(user_id) or AnonymousUser())
+
+    user = backend.get_user(user_id)
+    if user is None:
+        return AnonymousUser()
+    request.session[SNAPSHOT_SESSION_KEY] = backend.make_snapshot(user)
+    return user
+
+
+def store_snapshot(sender, request, user, **kwargs):
+    """
+    Stores a snapshot of the user at login (including auto_login()), when SnapshotAuthenticationMiddleware is installed
+    and the backend supports snapshots
+    """
+    if SNAPSHOT_MIDDLEWARE not in settings.MIDDLEWARE_CLASSES:
+        return
+    backend = load_backend(user.backend) if getattr(user, 'backend', None) else None
+    if backend is not None and hasattr(backend, 'make_snapshot'):
+        request.session[SNAPSHOT_SESSION_KEY] = backend.make_snapshot(user)
+
+user_logged_in.connect(store_snapshot, dispatch_uid='sky_visitor.snapshot.store_snapshot')
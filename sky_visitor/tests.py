@@ -12,13 +12,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import json
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+from StringIO import StringIO
 from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import AnonymousUser, Group, Permission
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.auth.tokens import default_token_generator
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from django.contrib.auth.models import User as AuthUser
+from django.utils import timezone
+from django.utils.http import int_to_base36
 from django.utils.unittest.case import skipUnless
-from sky_visitor import utils
+from sky_visitor import metrics, middleware, models, utils
+from sky_visitor.exceptions import Http403
+from sky_visitor.benchmark import Benchmark, FLOWS, FlowFailure, compare, format_result, percentile
+from sky_visitor.backends import auto_login, BaseBackend, EmailBackend, UsernameOrEmailBackend
+from sky_visitor.cache import GENERATION_TIMEOUT, get_cache_backend, user_cache, user_generations
+from sky_visitor import hashing
+from sky_visitor.hashing_policy import policy
+from sky_visitor import emails
+from sky_visitor.emails import TokenTemplateEmail
+from sky_visitor.invitations import send_invitations
+from sky_visitor.models import QueuedEmail
+from sky_visitor.outbox import send_queued_email
+from sky_visitor.profiling import PROFILE_FILE_HEADER, get_profile_name, request_profiler, summarize_samples
+from sky_visitor.query_budget import QueryBudgetMixin, UPDATE_BUDGETS_ENV
+from sky_visitor.settings import get_app_setting
 from sky_visitor.utils import SubclassedUser as User
-from sky_visitor.forms import UniqueRequiredEmailField
+from sky_visitor.forms import UniqueRequiredEmailField, EmailRegisterForm, IdentifierLoginForm
+from sky_visitor.snapshot import SNAPSHOT_MIDDLEWARE, SNAPSHOT_SESSION_KEY, SnapshotUser
+from sky_visitor.tokens import SignedTokenGenerator
+from sky_visitor.urls import TOKEN_REGEX
+from sky_visitor.views import LoginView, TokenValidateMixin
 
 subclassed_user_only_test = skipUnless(utils.is_subclassed_user(), "Only test these if configured in an sky_visitor subclassed user mode")
 username_user_only_test = skipUnless(utils.is_username_user(), "Only test these if configured in username-based user mode")
@@ -31,6 +74,9 @@ class BaseTestCase(TestCase):
 
 @email_user_only_test
 class UniqueEmailTest(BaseTestCase):
+    def tearDown(self):
+        User.validate_email_uniqueness = True
+
     def test_should_error_on_duplicate_email_on_create(self):
         nonunique_email = 'nonunique@example.com'
         first_user = User.objects.create_user(nonunique_email, password='asdf')
@@ -60,6 +106,57 @@ class UniqueEmailTest(BaseTestCase):
         second_user = User(username='foo', email=nonunique_email, password='asdf')
         second_user.save(allow_email_uniqueness_validation=False)
 
+    def test_should_check_uniqueness_once_when_registering_through_form(self):
+        data = {'email': 'onecheck@example.com', 'password1': 'asdfasdf', 'password2': 'asdfasdf'}
+        # One uniqueness query from the form field, then one INSERT for each of the two user tables
+        with self.assertNumQueries(3):
+            form = EmailRegisterForm(data)
+            self.assertTrue(form.is_valid())
+            form.save()
+
+    def test_should_check_uniqueness_once_for_clean_and_save(self):
+        user = User(email='cleanandsave@example.com')
+        with self.assertNumQueries(1):
+            user.clean()
+            user.validate_email_is_unique()
+        # Changing the email address runs the check again
+        User.objects.create_user('taken@example.com', password='asdf')
+        user.email = 'TAKEN@example.com'
+        with self.assertRaises(ValidationError):
+            user.clean()
+
+    def test_should_translate_unique_index_violation(self):
+        cursor = connection.cursor()
+        cursor.execute('CREATE UNIQUE INDEX sky_visitor_test_email ON auth_user (email)')
+        User.email_uniqueness_mode = models.EMAIL_UNIQUENESS_INDEX
+        try:
+            User.objects.create_user('indexed@example.com', password='asdf')
+            second_user = User(email='indexed@example.com')
+            with self.assertRaises(ValidationError):
+                second_user.save()
+            self.assertIsNone(second_user.pk)
+        finally:
+            User.email_uniqueness_mode = models.EMAIL_UNIQUENESS_QUERY
+            cursor.execute('DROP INDEX sky_visitor_test_email')
+
+    def test_should_not_leave_parent_row_when_subclass_index_fails(self):
+        # The index SKY_VISITOR_EMAIL_NORMALIZED_UNIQUE creates is on the subclass table, after auth_user was inserted
+        cursor = connection.cursor()
+        cursor.execute('CREATE UNIQUE INDEX sky_visitor_test_email ON %s (email_normalized)'
+                       % connection.ops.quote_name(User._meta.db_table))
+        User.email_uniqueness_mode = models.EMAIL_UNIQUENESS_INDEX
+        try:
+            User.objects.create_user('orphan@example.com', password='asdf')
+            second_user = User(email='Orphan@example.com')
+            with self.assertRaises(ValidationError):
+                with transaction.commit_on_success():
+                    second_user.save()
+            self.assertIsNone(second_user.pk)
+            self.assertEqual(AuthUser.objects.filter(email__iexact='orphan@example.com').count(), 1)
+        finally:
+            User.email_uniqueness_mode = models.EMAIL_UNIQUENESS_QUERY
+            cursor.execute('DROP INDEX sky_visitor_test_email')
+
 
 @email_user_only_test
 class EmailCreateUserTest(BaseTestCase):
@@ -88,8 +185,1103 @@ class EmailCreateUserTest(BaseTestCase):
         self.assertNotEqual(user.username, email)
         self.assertEqual(user.email, email)
 
+    def test_should_create_user_without_username_lookup(self):
+        # One email uniqueness check plus one INSERT for each of the two user tables
+        with self.assertNumQueries(3):
+            User.objects.create_user_by_email('newuser@example.com', 'fake')
+
+    def test_should_retry_with_new_username_on_collision(self):
+        first_user = User.objects.create_user_by_email('first@example.com', 'fake')
+        usernames = iter([first_user.username, 'freshusername'])
+        original = models.get_uuid_username
+        models.get_uuid_username = lambda: next(usernames)
+        try:
+            second_user = User.objects.create_user_by_email('second@example.com', 'fake')
+        finally:
+            models.get_uuid_username = original
+        self.assertEqual(second_user.username, 'freshusername')
+        self.assertEqual(User.objects.get(email='second@example.com').username, 'freshusername')
+
+
+@email_user_only_test
+class BulkCreateUsersTest(BaseTestCase):
+
+    def test_should_create_users_in_batches(self):
+        User.objects.create_user('existing@example.com', password='asdf')
+        rows = [
+            ('first@example.com', 'password1'),
+            {'email': 'second@example.com', 'password': 'password2', 'first_name': 'Second'},
+            ('EXISTING@example.com', 'password3'),
+            ('not an email', 'password4'),
+            ('third@example.com', None),
+            ('First@Example.com', 'password5'),
+        ]
+        results = list(User.objects.bulk_create_users(iter(rows), batch_size=4, processes=1))
+        self.assertEqual([result.index for result in results], range(6))
+        self.assertEqual([result.error is None for result in results], [True, True, False, False, True, False])
+
+        second = User.objects.get(pk=results[1].user_id)
+        self.assertEqual(second.email, 'second@example.com')
+        self.assertEqual(second.email_normalized, 'second@example.com')
+        self.assertEqual(second.first_name, 'Second')
+        self.assertTrue(second.check_password('password2'))
+        self.assertFalse(User.objects.get(pk=results[4].user_id).has_usable_password())
+        self.assertEqual(User.objects.filter(email_normalized='first@example.com').count(), 1)
+
+    def test_should_report_rows_with_unknown_fields(self):
+        rows = [
+            {'email': 'extra@example.com', 'password': 'asdf', 'partner_id': '42'},
+            {'email': 'named@example.com', 'username': 'named'},
+            {'email': 'valid@example.com', 'last_name': 'Valid'},
+        ]
+        results = list(User.objects.bulk_create_users(rows, processes=1))
+        self.assertIn("partner_id", results[0].error)
+        self.assertIn("username", results[1].error)
+        self.assertIsNone(results[2].error)
+        self.assertEqual(User.objects.get(pk=results[2].user_id).last_name, 'Valid')
+        self.assertFalse(User.objects.filter(email__in=['extra@example.com', 'named@example.com']).exists())
+
+    def test_should_hash_passwords_in_process_pool(self):
+        results = list(User.objects.bulk_create_users([('pooled%d@example.com' % i, 'password') for i in range(4)], processes=2))
+        self.assertTrue(all(result.error is None for result in results))
+        self.assertTrue(User.objects.get(pk=results[3].user_id).check_password('password'))
+
+    def test_should_use_constant_queries_per_batch(self):
+        rows = [('batched%d@example.com' % i, None) for i in range(20)]
+        # Uniqueness check, auth_user INSERT, primary key lookup and subclass table INSERT
+        with self.assertNumQueries(4):
+            list(User.objects.bulk_create_users(rows, batch_size=20, processes=1))
+
+
+@subclassed_user_only_test
+class NormalizedEmailTest(BaseTestCase):
+
+    def test_should_keep_normalized_email_in_sync(self):
+        user = User.objects.create_user('normalized', ' Mixed.Case@Example.com', 'asdf')
+        self.assertEqual(User.objects.get(pk=user.pk).email_normalized, 'mixed.case@example.com')
+        user.email = 'Other@Example.com'
+        user.save()
+        self.assertEqual(User.objects.get(pk=user.pk).email_normalized, 'other@example.com')
+
+    def test_should_backfill_normalized_email(self):
+        user = User.objects.create_user('backfill', 'Backfill@Example.com', 'asdf')
+        User.objects.filter(pk=user.pk).update(email_normalized=None)
+        call_command('sky_visitor_normalize_emails', batch_size=1, stdout=StringIO())
+        self.assertEqual(User.objects.get(pk=user.pk).email_normalized, 'backfill@example.com')
+
+    def test_should_backfill_with_one_update_per_batch(self):
+        users = [User.objects.create_user('backfill%d' % i, 'Backfill%d@Example.com' % i, 'asdf') for i in range(3)]
+        User.objects.update(email_normalized=None)
+        # Read the batch, update it, find nothing more to read
+        with self.assertNumQueries(3):
+            call_command('sky_visitor_normalize_emails', batch_size=10, stdout=StringIO())
+        for i, user in enumerate(users):
+            self.assertEqual(User.objects.get(pk=user.pk).email_normalized, 'backfill%d@example.com' % i)
+
+    def test_empty_email_should_match_nobody(self):
+        user = User.objects.create_user('blankemail', 'blankemail@example.com', 'asdf')
+        User.objects.filter(pk=user.pk).update(email='', email_normalized=None)
+        with self.assertNumQueries(0):
+            self.assertFalse(models.email_is_taken(''))
+            self.assertFalse(models.email_is_taken(None))
+            self.assertEqual(list(User.objects.filter(**models.get_email_lookup(User, ''))), [])
+
+    def test_unchanged_email_should_skip_uniqueness_check(self):
+        user = User.objects.get(pk=User.objects.create_user('lastlogin', 'lastlogin@example.com', 'asdf').pk)
+        user.last_login = user.last_login.replace(year=2000)
+        # Existence check and UPDATE for each of the two user tables, no uniqueness check
+        with self.assertNumQueries(4):
+            user.save()
+        self.assertEqual(User.objects.get(pk=user.pk).last_login.year, 2000)
+
+    @email_user_only_test
+    def test_should_authenticate_by_email_case_insensitively(self):
+        user = User.objects.create_user('casing@example.com', password='asdf')
+        self.assertEqual(authenticate(email='Casing@Example.com', password='asdf'), user)
+
+
+class UsernameGenerationTest(BaseTestCase):
+
+    def test_should_generate_sortable_slug_friendly_usernames(self):
+        with self.assertNumQueries(0):
+            usernames = [models.get_uuid_username() for i in range(100)]
+        self.assertEqual(len(set(usernames)), 100)
+        for username in usernames:
+            self.assertEqual(len(username), models.USERNAME_LENGTH)
+            self.assertRegexpMatches(username, r'^[0-9a-z]+$')
+        self.assertLessEqual(models.get_uuid_username()[:8], models.get_uuid_username()[:8])
+
 
 class InviteUserTests(BaseTestCase):
 
     def setUp(self):
         pass
+
+
+@override_settings(SKY_VISITOR_USER_CACHE_ENABLED=True)
+class UserCacheTest(BaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('cacheduser', 'cacheduser@example.com', 'asdf')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_should_serve_second_lookup_from_cache(self):
+        backend = BaseBackend()
+        user_cache.reset_stats()
+        self.assertEqual(backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.get_user(self.user.pk).email, self.user.email)
+        self.assertEqual(user_cache.stats()['misses'], 1)
+        self.assertEqual(user_cache.stats()['shared_hits'], 1)
+
+    def test_should_invalidate_on_save(self):
+        backend = BaseBackend()
+        backend.get_user(self.user.pk)
+        self.user.first_name = 'Changed'
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.get_user(self.user.pk).first_name, 'Changed')
+
+    def test_should_invalidate_on_delete(self):
+        backend = BaseBackend()
+        user_id = self.user.pk
+        backend.get_user(user_id)
+        self.user.delete()
+        self.assertIsNone(backend.get_user(user_id))
+
+    def test_should_memoize_within_request(self):
+        backend = BaseBackend()
+        user_cache.start_request()
+        try:
+            with self.settings(SKY_VISITOR_USER_CACHE_ENABLED=False):
+                first = backend.get_user(self.user.pk)
+                with self.assertNumQueries(0):
+                    self.assertIs(backend.get_user(self.user.pk), first)
+        finally:
+            user_cache.finish_request()
+
+    def test_should_not_serve_entry_after_generation_is_evicted(self):
+        backend = BaseBackend()
+        backend.get_user(self.user.pk)
+        generation_key, entry_key = user_cache.make_keys(self.user.pk)
+        user_cache.get_cache().delete(generation_key, version=user_cache.get_version())
+        with self.assertNumQueries(1):
+            backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            backend.get_user(self.user.pk)
+
+    @override_settings(SKY_VISITOR_USER_CACHE_ENABLED=False)
+    def test_should_not_bump_generation_when_nothing_reads_it(self):
+        self.user.save()
+        self.assertIsNone(user_generations.get_cache().get(user_generations.make_key(self.user.pk)))
+
+    def test_should_reuse_cache_backend(self):
+        backend = get_cache_backend('default')
+        self.assertIs(get_cache_backend('default'), backend)
+        self.assertIs(user_cache.get_cache(), backend)
+        with self.settings(CACHES=settings.CACHES):
+            self.assertIsNot(get_cache_backend('default'), backend)
+
+
+class TokenValidationTest(BaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('tokenuser', 'tokenuser@example.com', 'asdf')
+        self.uidb36 = int_to_base36(self.user.pk)
+        self.mixin = TokenValidateMixin()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_should_reject_malformed_and_expired_tokens_without_query(self):
+        generator = self.mixin.get_token_generator()
+        expired = '%s-0123456789abcdef0123' % int_to_base36(generator._num_days(generator._today()) - settings.PASSWORD_RESET_TIMEOUT_DAYS - 1)
+        future = '%s-0123456789abcdef0123' % int_to_base36(generator._num_days(generator._today()) + 1)
+        with self.assertNumQueries(0):
+            for token in ['garbage', 'zzzzzzzzzzzzz-abc', expired, future]:
+                self.assertIsNone(self.mixin.get_valid_token_user(self.uidb36, token))
+
+    def test_should_cache_invalid_tokens(self):
+        generator = self.mixin.get_token_generator()
+        token = '%s-0123456789abcdef0123' % int_to_base36(generator._num_days(generator._today()))
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.mixin.get_valid_token_user(self.uidb36, token))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.mixin.get_valid_token_user(self.uidb36, token))
+
+    @override_settings(CACHES=dict(settings.CACHES, tokens={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tokens'}),
+                       SKY_VISITOR_TOKEN_USER_CACHE_ALIAS='tokens')
+    def test_should_cache_invalid_tokens_in_configured_cache(self):
+        generator = self.mixin.get_token_generator()
+        token = '%s-0123456789abcdef0123' % int_to_base36(generator._num_days(generator._today()))
+        self.mixin.get_valid_token_user(self.uidb36, token)
+        key = self.mixin.get_invalid_token_cache_key(self.uidb36, token)
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(get_cache_backend('tokens').get(key))
+        get_cache_backend('tokens').clear()
+
+    @override_settings(SKY_VISITOR_TOKEN_USER_CACHE_ENABLED=True)
+    def test_should_load_user_once_until_saved(self):
+        token = default_token_generator.make_token(self.user)
+        self.assertEqual(self.mixin.get_valid_token_user(self.uidb36, token).pk, self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.mixin.get_valid_token_user(self.uidb36, token).pk, self.user.pk)
+        # Changing the password invalidates both the cached user and the token
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertIsNone(self.mixin.get_valid_token_user(self.uidb36, token))
+
+
+class SignedTokenGeneratorTest(BaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('signeduser', 'signeduser@example.com', 'asdf')
+        self.generator = SignedTokenGenerator('password_reset')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_should_check_signature_without_user(self):
+        token = self.generator.make_token(self.user)
+        self.assertTrue(re.match('^%s$' % TOKEN_REGEX, '%s-%s' % (int_to_base36(self.user.pk), token)))
+        self.assertTrue(self.generator.check_token(self.user, token))
+        self.assertFalse(self.generator.check_token_signature(self.user.pk + 1, token))
+        self.assertFalse(SignedTokenGenerator('invitation').check_token_signature(self.user.pk, token))
+        self.assertFalse(self.generator.check_token_signature(self.user.pk, token[:-1] + ('0' if token[-1] != '0' else '1')))
+
+    def test_should_expire(self):
+        generator = SignedTokenGenerator('password_reset', timeout=60)
+        token = generator.make_token(self.user)
+        generator._now = lambda: time.time() + 61
+        self.assertFalse(generator.check_token_signature(self.user.pk, token))
+
+    def test_should_be_single_use(self):
+        token = self.generator.make_token(self.user)
+        self.user.set_password('changed')
+        self.assertFalse(self.generator.check_token(self.user, token))
+
+    def test_should_reject_forged_token_without_query(self):
+        mixin = TokenValidateMixin()
+        mixin.token_generator = self.generator
+        token = self.generator.make_token(self.user)
+        with self.assertNumQueries(0):
+            self.assertIsNone(mixin.get_valid_token_user(int_to_base36(self.user.pk + 1), token))
+        with self.assertNumQueries(1):
+            self.assertEqual(mixin.get_valid_token_user(int_to_base36(self.user.pk), token).pk, self.user.pk)
+
+
+class HashingExecutorTest(BaseTestCase):
+
+    def setUp(self):
+        hashing.reset_executor()
+        self.user = User.objects.create_user('hasheduser', 'hasheduser@example.com', 'asdf')
+
+    def tearDown(self):
+        hashing.reset_executor()
+
+    def test_should_hash_inline_by_default(self):
+        self.assertIsNone(hashing.get_executor())
+        self.assertTrue(hashing.check_password(self.user, 'asdf'))
+
+    @override_settings(SKY_VISITOR_HASHING_PROCESSES=1)
+    def test_should_check_and_set_passwords_in_pool(self):
+        executor = hashing.get_executor()
+        hashing.set_password(self.user, 'newpassword')
+        self.assertTrue(hashing.check_password(self.user, 'newpassword'))
+        self.assertFalse(hashing.check_password(self.user, 'asdf'))
+        self.assertTrue(self.user.check_password('newpassword'))
+        self.assertEqual(executor.stats()['completed'], 3)
+        self.assertEqual(executor.stats()['pending'], 0)
+
+    def test_should_reject_when_queue_is_full(self):
+        executor = hashing.HashingExecutor(1, max_pending=1, queue_timeout=0)
+        executor.acquire()
+        try:
+            with self.assertRaises(hashing.HashingQueueFull):
+                executor.run(hashing.make_password, 'asdf')
+        finally:
+            executor.release()
+            executor.shutdown()
+        self.assertEqual(executor.stats()['rejected'], 1)
+
+
+class AppSettingsTest(BaseTestCase):
+
+    def test_should_cache_until_setting_changed(self):
+        from sky_visitor.settings import app_settings, get_app_setting
+        self.assertEqual(get_app_setting('SKY_VISITOR_EMAIL_DELIVERY'), 'immediate')
+        self.assertIn('SKY_VISITOR_EMAIL_DELIVERY', app_settings._cache)
+        with self.settings(SKY_VISITOR_EMAIL_DELIVERY='queue'):
+            self.assertEqual(get_app_setting('SKY_VISITOR_EMAIL_DELIVERY'), 'queue')
+        self.assertEqual(get_app_setting('SKY_VISITOR_EMAIL_DELIVERY'), 'immediate')
+
+    def test_should_fall_back_to_given_default(self):
+        from sky_visitor.settings import get_app_setting
+        self.assertEqual(get_app_setting('SKY_VISITOR_NOT_A_SETTING', 'fallback'), 'fallback')
+        self.assertIsNone(get_app_setting('SKY_VISITOR_NOT_A_SETTING'))
+
+    def test_should_validate_settings(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from sky_visitor.settings import app_settings
+        app_settings.validate()
+        with self.settings(SKY_VISITOR_EMAIL_DELIVERY='carrier pigeon', SKY_VISITOR_HASHING_PROCESSES=-1):
+            try:
+                app_settings.validate()
+            except ImproperlyConfigured as e:
+                self.assertIn('SKY_VISITOR_EMAIL_DELIVERY', str(e))
+                self.assertIn('SKY_VISITOR_HASHING_PROCESSES', str(e))
+            else:
+                self.fail("validate() should have raised ImproperlyConfigured")
+
+
+class Http403MiddlewareTest(BaseTestCase):
+
+    def setUp(self):
+        middleware.clear_403_cache()
+        self.factory = RequestFactory()
+
+    def get_response(self, exception=None, **headers):
+        request = self.factory.get('/', **headers)
+        request.user = AnonymousUser()
+        return middleware.Http403Middleware().process_exception(request, exception or Http403())
+
+    @override_settings(SKY_VISITOR_403_CACHE=True)
+    def test_should_render_once_per_language_and_host(self):
+        first = self.get_response()
+        self.assertEqual(first.status_code, 403)
+        self.assertIn('Forbidden', first.content)
+        with self.assertTemplateNotUsed('403.html'):
+            self.assertEqual(self.get_response().content, first.content)
+        with self.assertTemplateUsed('403.html'):
+            self.get_response(HTTP_HOST='other.example.com')
+
+    @override_settings(SKY_VISITOR_403_CACHE=True)
+    def test_should_render_context_per_request(self):
+        self.assertIn('Not yours', self.get_response(Http403(context={'reason': 'Not yours'})).content)
+        self.assertNotIn('Not yours', self.get_response().content)
+
+    def test_should_answer_json_clients_with_json(self):
+        response = self.get_response(Http403('No access'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), {'detail': 'No access'})
+        self.assertTrue(self.get_response(HTTP_ACCEPT='text/html,application/json;q=0.9')['Content-Type'].startswith('text/html'))
+
+
+@override_settings(MIDDLEWARE_CLASSES=settings.MIDDLEWARE_CLASSES + (SNAPSHOT_MIDDLEWARE,))
+class SnapshotAuthenticationTest(BaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('snapshotuser', 'snapshotuser@example.com', 'asdf')
+        self.factory = RequestFactory()
+        request = self.factory.get('/')
+        request.session = SessionStore()
+        request.user = AnonymousUser()
+        auto_login(request, self.user)
+        self.session = request.session
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_request(self):
+        request = self.factory.get('/')
+        request.session = self.session
+        middleware.SnapshotAuthenticationMiddleware().process_request(request)
+        return request
+
+    def test_should_check_snapshot_with_one_cache_read(self):
+        backend = get_cache_backend(get_app_setting('SKY_VISITOR_USER_CACHE_ALIAS'))
+        calls = []
+        depth = [0]
+
+        def make_recorder(method):
+            # Backends may implement get_many with get; only count the outer call
+            def record(*args, **kwargs):
+                if not depth[0]:
+                    calls.append((method, args, kwargs))
+                depth[0] += 1
+                try:
+                    return getattr(type(backend), method)(backend, *args, **kwargs)
+                finally:
+                    depth[0] -= 1
+            return record
+        for method in ('get', 'get_many', 'set', 'add'):
+            setattr(backend, method, make_recorder(method))
+        try:
+            with self.assertNumQueries(0):
+                self.assertEqual(self.get_request().user.email, 'snapshotuser@example.com')
+            self.assertEqual([call[0] for call in calls], ['get_many'])
+            del calls[:]
+            user_generations.bump(self.user.pk)
+        finally:
+            for method in ('get', 'get_many', 'set', 'add'):
+                delattr(backend, method)
+        # Version tokens must outlive the backend's default timeout
+        self.assertEqual(calls[0][0], 'set')
+        self.assertEqual(calls[0][1][2], GENERATION_TIMEOUT)
+
+    def test_should_answer_from_snapshot(self):
+        request = self.get_request()
+        with self.assertNumQueries(0):
+            self.assertTrue(request.user.is_authenticated())
+            self.assertEqual(request.user.pk, self.user.pk)
+            self.assertEqual(request.user.email, 'snapshotuser@example.com')
+        # Anything else loads the user, once
+        date_joined = User.objects.get(pk=self.user.pk).date_joined
+        with self.assertNumQueries(1):
+            self.assertEqual(request.user.date_joined, date_joined)
+            request.user.last_login
+
+    def test_should_check_permissions_without_loading_user(self):
+        self.user.user_permissions.add(Permission.objects.get(codename='add_user', content_type__app_label='auth'))
+        with self.settings(SKY_VISITOR_PERMISSION_CACHE_ENABLED=True,
+                           AUTHENTICATION_BACKENDS=['sky_visitor.backends.UsernameBackend']):
+            self.assertTrue(self.get_request().user.has_perm('auth.add_user'))
+            request = self.get_request()
+            with self.assertNumQueries(0):
+                self.assertTrue(request.user.has_perm('auth.add_user'))
+                self.assertFalse(request.user.has_perm('auth.delete_user'))
+                self.assertEqual(request.user.get_all_permissions(), set(['auth.add_user']))
+            self.assertIsNone(request.user._wrapped.__dict__['_user'])
+
+    def test_should_refresh_after_save(self):
+        self.user.first_name = 'Changed'
+        self.user.save()
+        self.assertEqual(self.get_request().user.first_name, 'Changed')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_request().user.first_name, 'Changed')
+
+    def test_should_reject_tampered_snapshot(self):
+        self.session[SNAPSHOT_SESSION_KEY] = self.session[SNAPSHOT_SESSION_KEY].replace(':', ':x', 1)
+        request = self.get_request()
+        self.assertEqual(request.user.email, 'snapshotuser@example.com')
+        self.assertNotIsInstance(request.user, SnapshotUser)
+
+
+@override_settings(SKY_VISITOR_PERMISSION_CACHE_ENABLED=True)
+class PermissionCacheTest(BaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('permuser', 'permuser@example.com', 'asdf')
+        self.backend = BaseBackend()
+        self.permission = Permission.objects.get(codename='add_user', content_type__app_label='auth')
+        self.group = Group.objects.create(name='editors')
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_user(self):
+        return User.objects.get(pk=self.user.pk)
+
+    def test_should_serve_permissions_from_cache(self):
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+        user = self.get_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(self.backend.has_perm(user, 'auth.add_user'))
+            self.assertFalse(self.backend.has_perm(user, 'auth.delete_user'))
+
+    def test_should_see_permission_changes(self):
+        self.assertFalse(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+        self.user.user_permissions.add(self.permission)
+        self.assertTrue(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+        self.permission.user_set.remove(self.user)
+        self.assertFalse(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+
+    def test_should_see_group_changes(self):
+        self.user.groups.add(self.group)
+        self.assertFalse(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+        self.group.permissions.add(self.permission)
+        self.assertTrue(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+        self.assertEqual(self.backend.get_group_permissions(self.get_user()), set(['auth.add_user']))
+        self.group.user_set.clear()
+        self.assertFalse(self.backend.has_perm(self.get_user(), 'auth.add_user'))
+
+
+class LazyModelTest(BaseTestCase):
+
+    def test_should_resolve_on_first_use(self):
+        calls = []
+
+        def get_model():
+            calls.append(True)
+            return AuthUser
+        model = utils.LazyModel(get_model)
+        self.assertEqual(calls, [])
+        self.assertIs(model.DoesNotExist, AuthUser.DoesNotExist)
+        self.assertIsInstance(model(username='lazyuser'), AuthUser)
+        self.assertIsInstance(AuthUser(), model)
+        self.assertTrue(issubclass(AuthUser, model))
+        self.assertIs(model.resolve(), AuthUser)
+        self.assertEqual(len(calls), 1)
+
+    def test_subclassed_user_should_work_as_model(self):
+        self.assertEqual(models.has_normalized_email(User), models.has_normalized_email(User.resolve()))
+        self.assertEqual(User.objects.model, User.resolve())
+
+
+class UsernameOrEmailBackendTest(BaseTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('identifieruser', 'identifieruser@example.com', 'asdf')
+        self.backend = UsernameOrEmailBackend()
+
+    def test_should_authenticate_with_either_identifier_in_one_query(self):
+        for identifier in [self.user.username, 'IdentifierUser@example.com']:
+            with self.assertNumQueries(1):
+                self.assertEqual(self.backend.authenticate(identifier=identifier, password='asdf').pk, self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.backend.authenticate(identifier='nobody@example.com', password='asdf'))
+        self.assertIsNone(self.backend.authenticate(identifier=self.user.username, password='wrong'))
+
+    def test_should_prefer_username_match(self):
+        other = User.objects.create_user('otheruser', 'other@example.com', 'qwer')
+        # Set explicitly, since email-only users get a generated username
+        other.username = 'identifieruser@example.com'
+        other.save()
+        self.assertEqual(self.backend.authenticate(identifier='identifieruser@example.com', password='qwer').pk, other.pk)
+
+    def test_username_match_should_win_over_several_email_matches(self):
+        others = [User.objects.create_user('sharing%d' % i, 'sharing%d@example.com' % i, 'asdf') for i in range(2)]
+        # Bypass uniqueness checks: two users share an address, a third has it as username
+        shared = {'email': 'shared@example.com'}
+        if models.has_normalized_email(User):
+            shared['email_normalized'] = 'shared@example.com'
+        User.objects.filter(pk__in=[other.pk for other in others]).update(**shared)
+        owner = User.objects.create_user('owner', 'owner@example.com', 'qwer')
+        AuthUser.objects.filter(pk=owner.pk).update(username='shared@example.com')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_user_by_identifier('shared@example.com').pk, owner.pk)
+        AuthUser.objects.filter(pk=owner.pk).update(username='owner')
+        # Ambiguous without the username match
+        self.assertIsNone(self.backend.get_user_by_identifier('shared@example.com'))
+
+    @override_settings(AUTHENTICATION_BACKENDS=['sky_visitor.backends.UsernameOrEmailBackend'])
+    def test_login_view_should_use_identifier_form(self):
+        self.assertIs(LoginView().get_form_class(), IdentifierLoginForm)
+        form = IdentifierLoginForm(data={'identifier': 'identifieruser@example.com', 'password': 'asdf'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.get_user().pk, self.user.pk)
+
+
+class HashingPolicyTest(BaseTestCase):
+
+    def setUp(self):
+        policy.reset_stats()
+        self.user = User.objects.create_user('policyuser', 'policyuser@example.com', 'asdf')
+        self.iterations = policy.get_hasher().iterations
+
+    def test_should_rehash_weaker_hashes(self):
+        self.assertFalse(policy.needs_rehash(self.user.password))
+        with self.settings(SKY_VISITOR_HASH_ITERATIONS=self.iterations + 1000):
+            self.assertTrue(policy.needs_rehash(self.user.password))
+            self.assertFalse(policy.needs_rehash(policy.make_password('asdf')))
+        self.assertTrue(policy.needs_rehash('md5$salt$0123456789abcdef0123456789abcdef'))
+        self.assertFalse(policy.needs_rehash('!'))
+
+    def test_should_rehash_after_request(self):
+        old_password = self.user.password
+        with self.settings(SKY_VISITOR_HASH_ITERATIONS=self.iterations + 1000, SKY_VISITOR_HASH_UPGRADE_ON_LOGIN=True):
+            hashing.start_request()
+            try:
+                self.assertTrue(hashing.check_password(self.user, 'asdf'))
+                self.assertEqual(AuthUser.objects.get(pk=self.user.pk).password, old_password)
+            finally:
+                hashing.finish_request()
+            new_password = AuthUser.objects.get(pk=self.user.pk).password
+            self.assertEqual(int(new_password.split('$')[1]), self.iterations + 1000)
+            self.assertTrue(AuthUser.objects.get(pk=self.user.pk).check_password('asdf'))
+
+    def test_should_not_rehash_wrong_password(self):
+        with self.settings(SKY_VISITOR_HASH_ITERATIONS=self.iterations + 1000, SKY_VISITOR_HASH_UPGRADE_ON_LOGIN=True):
+            self.assertFalse(hashing.check_password(self.user, 'wrong'))
+        self.assertEqual(AuthUser.objects.get(pk=self.user.pk).password, self.user.password)
+
+    def test_should_record_verification_times(self):
+        hashing.check_password(self.user, 'asdf')
+        histogram = policy.histograms()[policy.get_hasher().algorithm]
+        self.assertEqual(histogram['count'], 1)
+        self.assertEqual(sum(count for bound, count in histogram['buckets']), 1)
+
+    @override_settings(SKY_VISITOR_HASH_TARGET_SECONDS=0.001, SKY_VISITOR_HASH_ITERATIONS=None)
+    def test_should_only_calibrate_when_asked(self):
+        # Password checks never benchmark; before calibrate() the hasher's default is used
+        policy.choose_iterations = None
+        try:
+            self.assertEqual(policy.get_iterations(), self.iterations)
+        finally:
+            del policy.choose_iterations
+        try:
+            iterations = policy.calibrate()
+            self.assertIsNone(get_app_setting('SKY_VISITOR_HASH_ITERATIONS'))
+            self.assertEqual(policy.get_iterations(), max(iterations, self.iterations))
+            # A different target needs its own calibration
+            with self.settings(SKY_VISITOR_HASH_TARGET_SECONDS=0.002):
+                self.assertEqual(policy.get_iterations(), self.iterations)
+            with self.settings(SKY_VISITOR_HASH_ITERATIONS=self.iterations + 1000):
+                self.assertIsNone(policy.calibrate())
+        finally:
+            policy.reset_calibration()
+
+    def test_tune_command_should_print_iterations(self):
+        out = StringIO()
+        call_command('sky_visitor_tune_hasher', target=0.001, rounds=1, stdout=out)
+        self.assertIn('SKY_VISITOR_HASH_ITERATIONS = ', out.getvalue())
+
+
+@override_settings(SKY_VISITOR_DUMMY_HASH_ON_MISS=True)
+class DummyHashTest(BaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        hashing.dummy_hasher.reset_stats()
+        User.objects.create_user('knownuser', 'knownuser@example.com', 'asdf')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_should_hash_once_per_missing_identifier(self):
+        backend = EmailBackend()
+        self.assertIsNone(backend.authenticate(email='missing@example.com', password='asdf'))
+        self.assertIsNone(backend.authenticate(email='MISSING@example.com', password='asdf'))
+        self.assertIsNone(backend.authenticate(email='other@example.com', password='asdf'))
+        stats = hashing.dummy_hasher.stats()
+        self.assertEqual(stats['hashes'], 2)
+        self.assertEqual(stats['waits'], 1)
+        self.assertTrue(stats['cost'] > 0)
+
+    def test_should_not_hash_for_known_users(self):
+        backend = EmailBackend()
+        self.assertIsNone(backend.authenticate(email='knownuser@example.com', password='wrong'))
+        self.assertEqual(backend.authenticate(email='knownuser@example.com', password='asdf').email, 'knownuser@example.com')
+        self.assertEqual(hashing.dummy_hasher.stats()['hashes'], 0)
+
+    def test_dummy_hash_should_cost_as_much_as_a_real_one(self):
+        iterations = policy.get_hasher().iterations + 1000
+        with self.settings(SKY_VISITOR_HASH_ITERATIONS=iterations):
+            user = User.objects.get(email='knownuser@example.com')
+            hashing.set_password(user, 'asdf')
+            real_algorithm, real_iterations = user.password.split('$')[:2]
+            dummy_algorithm, dummy_iterations = hashing.dummy_hasher.get_encoded().split('$')[:2]
+        self.assertEqual((dummy_algorithm, dummy_iterations), (real_algorithm, real_iterations))
+        self.assertEqual(int(dummy_iterations), iterations)
+
+    @override_settings(SKY_VISITOR_DUMMY_HASH_ON_MISS=False)
+    def test_should_be_off_by_default(self):
+        EmailBackend().authenticate(email='missing@example.com', password='asdf')
+        self.assertEqual(hashing.dummy_hasher.stats()['hashes'], 0)
+
+
+class BenchmarkTest(BaseTestCase):
+
+    def test_should_report_every_flow(self):
+        results = Benchmark(iterations=2).run()
+        self.assertEqual(sorted(results['flows']), sorted(FLOWS))
+        for flow, result in results['flows'].items():
+            self.assertEqual(result['errors'], 0, flow)
+            self.assertEqual(result['requests'], 4 if flow == 'token_change' else 2)
+            self.assertTrue(result['latency']['p50'] <= result['latency']['p95'] <= result['latency']['p99'])
+            self.assertTrue(result['queries_per_request'] > 0)
+        self.assertTrue(results['flows']['login']['hash_seconds'] > 0)
+        self.assertEqual(results['flows']['logout']['hash_seconds'], 0)
+
+    def test_should_count_refused_steps_and_raise_bugs(self):
+        def refused(run, i):
+            raise FlowFailure("refused")
+
+        def broken(run, i):
+            raise KeyError('bug')
+        benchmark = Benchmark(iterations=2, flows=['logout'], prefix='refused')
+        benchmark.flow_logout = refused
+        result = benchmark.run()['flows']['logout']
+        self.assertEqual((result['errors'], result['requests']), (2, 0))
+        self.assertIn("p50        n/a", format_result('logout', result))
+        for concurrency in (1, 2):
+            benchmark = Benchmark(concurrency, 2, flows=['logout'], prefix='broken%d' % concurrency)
+            benchmark.flow_logout = broken
+            self.assertRaises(KeyError, benchmark.run)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertIsNone(percentile([], 50))
+
+    def test_compare_should_report_slower_flows(self):
+        previous = {'flows': {'login': {'latency': {'p95': 0.1}}, 'logout': {'latency': {'p95': 0.1}}}}
+        current = {'flows': {'login': {'latency': {'p95': 0.15}}, 'logout': {'latency': {'p95': 0.11}}}}
+        self.assertEqual(compare(previous, current, 0.2), ["login: p95 100.0 ms -> 150.0 ms (+50%)"])
+
+
+class QueryBudgetTest(QueryBudgetMixin, BaseTestCase):
+
+    def setUp(self):
+        handle, self.query_budget_file = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        with open(self.query_budget_file, 'w') as f:
+            json.dump({'lookup': ['SELECT 1']}, f)
+        # These tests check both modes themselves, whichever one the suite runs in
+        self.update_budgets = os.environ.pop(UPDATE_BUDGETS_ENV, None)
+
+    def tearDown(self):
+        os.remove(self.query_budget_file)
+        if self.update_budgets is not None:
+            os.environ[UPDATE_BUDGETS_ENV] = self.update_budgets
+
+    def lookup(self):
+        return list(User.objects.filter(pk=1))
+
+    def test_should_pass_within_budget(self):
+        with self.assertQueryBudget('lookup'):
+            self.lookup()
+
+    def test_should_fail_with_diff_over_budget(self):
+        with self.assertRaises(AssertionError) as context:
+            with self.assertQueryBudget('lookup'):
+                self.lookup()
+                self.lookup()
+        message = str(context.exception)
+        self.assertIn("ran 2 queries, over its budget of 1", message)
+        self.assertIn("+SELECT", message)
+        self.assertIn("WHERE", message)
+        self.assertNotIn("= 1", message)
+
+    def test_should_fail_without_budget(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget('missing'):
+                pass
+
+    def test_should_record_budget_when_updating(self):
+        os.environ[UPDATE_BUDGETS_ENV] = '1'
+        try:
+            with self.assertQueryBudget('lookup'):
+                self.lookup()
+                self.lookup()
+        finally:
+            del os.environ[UPDATE_BUDGETS_ENV]
+        with open(self.query_budget_file) as f:
+            self.assertEqual(len(json.load(f)['lookup']), 2)
+
+
+class MetricsTest(BaseTestCase):
+
+    def setUp(self):
+        User.objects.create_user('metricsuser', 'metricsuser@example.com', 'asdf')
+
+    def test_should_be_off_by_default(self):
+        self.assertFalse(metrics.get_sink().enabled)
+        with metrics.timer('anything'):
+            pass
+
+    @override_settings(SKY_VISITOR_METRICS_SINK='sky_visitor.metrics.MemorySink')
+    def test_should_count_logins_and_time_hot_paths(self):
+        backend = UsernameOrEmailBackend()
+        username = User.objects.get(email='metricsuser@example.com').username
+        self.assertIsNotNone(backend.authenticate(identifier=username, password='asdf'))
+        self.assertIsNone(backend.authenticate(identifier=username, password='wrong'))
+        self.assertIsNone(backend.authenticate(identifier='nobody@example.com', password='asdf'))
+        models.email_is_taken('metricsuser@example.com')
+        user = User.objects.get(email='metricsuser@example.com')
+        TokenTemplateEmail(user, email_template_name='sky_visitor/forgot_password_email.html',
+                           token_view_name='forgot_password_change').get_message()
+
+        stats = metrics.get_sink().stats()
+        self.assertEqual(stats['counters'], {
+            'backend.success': 1,
+            'backend.wrong_password': 1,
+            'backend.missing_user': 1,
+            'uniqueness.email_taken': 1,
+        })
+        self.assertEqual(stats['timings']['backend.lookup']['count'], 3)
+        self.assertEqual(stats['timings']['hashing.check']['count'], 2)
+        for name in ('uniqueness.email', 'tokens.make', 'email.render'):
+            self.assertEqual(stats['timings'][name]['count'], 1, name)
+
+    @override_settings(SKY_VISITOR_METRICS_SINK='sky_visitor.metrics.MemorySink')
+    def test_should_count_token_validation(self):
+        user = User.objects.get(email='metricsuser@example.com')
+        url = reverse('forgot_password_change', kwargs={'uidb36': int_to_base36(user.pk), 'token': default_token_generator.make_token(user)})
+        self.client.get(url)
+        self.client.get(reverse('forgot_password_change', kwargs={'uidb36': int_to_base36(user.pk), 'token': '1-abc'}))
+        stats = metrics.get_sink().stats()
+        self.assertEqual(stats['counters']['tokens.valid'], 1)
+        self.assertEqual(stats['counters']['tokens.rejected.implausible'], 1)
+        self.assertEqual(stats['timings']['tokens.validate']['count'], 2)
+
+    def test_statsd_sink_should_send_lines(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(2)
+        try:
+            with self.settings(SKY_VISITOR_METRICS_SINK='sky_visitor.metrics.StatsdSink',
+                               SKY_VISITOR_METRICS_STATSD_HOST='127.0.0.1',
+                               SKY_VISITOR_METRICS_STATSD_PORT=server.getsockname()[1]):
+                metrics.incr('backend.success')
+                metrics.timing('hashing.check', 0.0125)
+            self.assertEqual(server.recv(512), 'sky_visitor.backend.success:1|c')
+            self.assertEqual(server.recv(512), 'sky_visitor.hashing.check:12.500|ms')
+        finally:
+            server.close()
+
+    def test_statsd_sink_should_not_fail_without_daemon(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        sink = metrics.StatsdSink('127.0.0.1', port, prefix='')
+        sink.incr('backend.success')
+        sink.incr('backend.success')
+
+class ProfilingTest(BaseTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings_override = override_settings(SKY_VISITOR_PROFILE_DIR=self.directory)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.directory)
+
+    def get_login(self, **extra):
+        return self.client.get(reverse('login'), **extra)
+
+    def test_should_not_profile_by_default(self):
+        response = self.get_login()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header(PROFILE_FILE_HEADER))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_should_profile_triggered_request(self):
+        response = self.get_login(HTTP_X_SKY_VISITOR_PROFILE=request_profiler.make_trigger())
+        self.assertEqual(response.status_code, 200)
+        filename = response[PROFILE_FILE_HEADER]
+        self.assertEqual(os.listdir(self.directory), [filename])
+        self.assertTrue(filename.endswith('.prof'))
+        self.assertEqual(get_profile_name(filename), 'LoginView')
+
+    def test_should_ignore_bad_trigger(self):
+        self.get_login(HTTP_X_SKY_VISITOR_PROFILE='profile')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @override_settings(SKY_VISITOR_PROFILE_SAMPLE_RATE=1, SKY_VISITOR_PROFILE_MAX_FILES=2)
+    def test_should_keep_newest_sampled_profiles(self):
+        for i in range(3):
+            response = self.get_login()
+            # Sampled requests don't say where their profile went
+            self.assertFalse(response.has_header(PROFILE_FILE_HEADER))
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    @override_settings(SKY_VISITOR_PROFILE_MODE='sampler', SKY_VISITOR_PROFILE_SAMPLER_INTERVAL=0.001)
+    def test_sampler_should_write_collapsed_stacks(self):
+        response = self.get_login(HTTP_X_SKY_VISITOR_PROFILE=request_profiler.make_trigger())
+        self.assertTrue(response[PROFILE_FILE_HEADER].endswith('.samples'))
+
+    def test_summarize_samples(self):
+        path = os.path.join(self.directory, '1-LoginView-1-0000.samples')
+        with open(path, 'w') as f:
+            f.write('a;b;c 3\na;b 1\na;d;b 2\n')
+        samples, functions = summarize_samples([path])
+        self.assertEqual(samples, 6)
+        self.assertEqual(sorted(functions), [('a', 0, 6), ('b', 3, 6), ('c', 3, 3), ('d', 0, 2)])
+
+    def test_command_should_summarize_profiles(self):
+        self.get_login(HTTP_X_SKY_VISITOR_PROFILE=request_profiler.make_trigger())
+        stdout = StringIO()
+        call_command('sky_visitor_profile', stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn("1 cprofile profiles", output)
+        self.assertIn("LoginView 1", output)
+        self.assertIn("dispatch", output)
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, email_messages):
+        raise IOError("Relay unavailable")
+
+
+@override_settings(SKY_VISITOR_EMAIL_DELIVERY='queue')
+class EmailOutboxTest(BaseTestCase):
+
+    def send_reset_email(self):
+        user = User.objects.create_user('outboxuser', 'outboxuser@example.com', 'asdf')
+        return TokenTemplateEmail(user, email_template_name='sky_visitor/forgot_password_email.html',
+                                  token_view_name='forgot_password_change', subject="Reset").send_email()
+
+    def test_should_queue_instead_of_sending(self):
+        self.send_reset_email()
+        self.assertEqual(len(mail.outbox), 0)
+        queued_email = QueuedEmail.objects.get()
+        self.assertEqual(queued_email.get_recipients(), ['outboxuser@example.com'])
+        self.assertEqual(send_queued_email(), {'sent': 1, 'failed': 0, 'dead': 0})
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Reset")
+        self.assertEqual(QueuedEmail.objects.get().status, QueuedEmail.STATUS_SENT)
+        # Nothing left to send
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 0, 'dead': 0})
+
+    @override_settings(EMAIL_BACKEND='sky_visitor.tests.FailingEmailBackend', SKY_VISITOR_EMAIL_MAX_ATTEMPTS=2)
+    def test_should_back_off_then_dead_letter(self):
+        self.send_reset_email()
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 1, 'dead': 0})
+        queued_email = QueuedEmail.objects.get()
+        self.assertEqual(queued_email.status, QueuedEmail.STATUS_PENDING)
+        self.assertIn("Relay unavailable", queued_email.last_error)
+        # Not due again until the retry delay has passed
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 0, 'dead': 0})
+        QueuedEmail.objects.update(next_attempt_at=queued_email.created_at)
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 0, 'dead': 1})
+        self.assertEqual(QueuedEmail.objects.get().status, QueuedEmail.STATUS_DEAD)
+
+    def test_should_reclaim_message_of_dead_worker(self):
+        self.send_reset_email()
+        # A worker claimed it and died before sending
+        claimed_at = timezone.now()
+        QueuedEmail.objects.update(status=QueuedEmail.STATUS_SENDING, claimed_at=claimed_at, attempts=1)
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 0, 'dead': 0})
+        QueuedEmail.objects.update(claimed_at=claimed_at - datetime.timedelta(seconds=601))
+        self.assertEqual(send_queued_email(), {'sent': 1, 'failed': 0, 'dead': 0})
+        queued_email = QueuedEmail.objects.get()
+        self.assertEqual(queued_email.status, QueuedEmail.STATUS_SENT)
+        self.assertEqual(queued_email.attempts, 2)
+        self.assertIsNone(queued_email.claimed_at)
+
+    @override_settings(SKY_VISITOR_EMAIL_MAX_ATTEMPTS=2)
+    def test_should_dead_letter_message_that_keeps_killing_its_worker(self):
+        self.send_reset_email()
+        # Claimed for the last allowed attempt, and that worker died too
+        expired = timezone.now() - datetime.timedelta(seconds=601)
+        QueuedEmail.objects.update(status=QueuedEmail.STATUS_SENDING, claimed_at=expired, attempts=2)
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 0, 'dead': 1})
+        self.assertEqual(len(mail.outbox), 0)
+        queued_email = QueuedEmail.objects.get()
+        self.assertEqual((queued_email.status, queued_email.attempts), (QueuedEmail.STATUS_DEAD, 2))
+        self.assertIn("Claim expired", queued_email.last_error)
+        self.assertEqual(send_queued_email(), {'sent': 0, 'failed': 0, 'dead': 0})
+
+
+@override_settings(SKY_VISITOR_EMAIL_TEMPLATE_CACHE=True)
+class EmailCacheTest(BaseTestCase):
+
+    def setUp(self):
+        emails.clear_email_caches()
+
+    def test_should_reuse_compiled_template(self):
+        template = emails.get_email_template('sky_visitor/forgot_password_email.html')
+        self.assertIs(emails.get_email_template('sky_visitor/forgot_password_email.html'), template)
+        # Resetting the template loaders throws the cache away
+        from django.template import loader
+        loader.template_source_loaders = None
+        self.assertIsNot(emails.get_email_template('sky_visitor/forgot_password_email.html'), template)
+
+    def test_should_substitute_into_cached_token_url(self):
+        for uidb36, token in [('1', '35t-d4e092280eb134000672'), ('zz', 'abc-def')]:
+            expected = reverse('forgot_password_change', kwargs={'uidb36': uidb36, 'token': token})
+            self.assertEqual(emails.reverse_token_url('forgot_password_change', uidb36, token), expected)
+        self.assertEqual(len(emails._token_url_cache), 1)
+
+    def test_should_not_cache_when_disabled(self):
+        with self.settings(SKY_VISITOR_EMAIL_TEMPLATE_CACHE=False):
+            emails.get_email_template('sky_visitor/forgot_password_email.html')
+            emails.reverse_token_url('forgot_password_change', '1', 'abc-def')
+        self.assertEqual(emails._template_cache, {})
+        self.assertEqual(emails._token_url_cache, {})
+
+
+@override_settings(SKY_VISITOR_EMAIL_TEMPLATE_CACHE=True)
+class MultipartEmailTest(BaseTestCase):
+
+    def setUp(self):
+        emails.clear_email_caches()
+
+    def get_email(self, email):
+        user = User.objects.create_user(email.split('@')[0], email, 'asdf')
+        return TokenTemplateEmail(user, email_template_name='sky_visitor/forgot_password_email.html',
+                                  html_email_template_name='sky_visitor/forgot_password_email_html.html',
+                                  html_layout_template_name='sky_visitor/email_layout.html',
+                                  subject_template_name='sky_visitor/forgot_password_subject.txt',
+                                  token_view_name='forgot_password_change', domain='example.com')
+
+    def test_should_send_text_and_html(self):
+        template_email = self.get_email('multipart@example.com')
+        template_email.send_email()
+        message = mail.outbox[0]
+        self.assertEqual(message.subject, 'Password reset for example.com')
+        self.assertIn(template_email.get_context_data()['token_url'], message.body)
+        html, mimetype = message.alternatives[0]
+        self.assertEqual(mimetype, 'text/html')
+        self.assertIn('<h1><a href="http://example.com/">example.com</a></h1>', html)
+        self.assertIn('<a href="http://example.com/user/forgot_password/', html)
+        self.assertTrue(html.strip().endswith('</html>'))
+
+    def test_should_render_layout_once(self):
+        self.get_email('first@example.com').get_message()
+        self.assertEqual(len(emails._layout_cache), 1)
+        emails._layout_cache[emails._layout_cache.keys()[0]] = ('<cached>', '</cached>')
+        html = self.get_email('second@example.com').get_message().alternatives[0][0]
+        self.assertTrue(html.startswith('<cached>'))
+        self.assertTrue(html.endswith('</cached>'))
+        self.assertIn('Choose a new password', html)
+
+    @override_settings(SKY_VISITOR_EMAIL_DELIVERY='queue')
+    def test_should_queue_html_alternative(self):
+        self.get_email('queued@example.com').send_email()
+        send_queued_email()
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+@email_user_only_test
+@override_settings(EMAIL_BACKEND='sky_visitor.tests.CountingEmailBackend')
+class BulkInvitationTest(BaseTestCase):
+
+    def test_should_send_chunks_over_one_connection(self):
+        CountingEmailBackend.opened = 0
+        User.objects.create_user('taken@example.com', password='asdf')
+        emails = ['invite%d@example.com' % i for i in range(5)] + ['taken@example.com']
+        email_kwargs = {'email_template_name': 'sky_visitor/invitation_email.html', 'token_view_name': 'forgot_password_change', 'subject': "Join us"}
+        reports = list(send_invitations(emails, chunk_size=4, email_kwargs=email_kwargs))
+        self.assertEqual([(report.number, report.sent, report.failed) for report in reports], [(1, 4, 0), (2, 1, 1)])
+        self.assertEqual(reports[1].errors[0][0], 'taken@example.com')
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(User.objects.get(email='invite0@example.com').is_active)
+
+    def test_should_count_created_users_whose_email_failed(self):
+        email_kwargs = {'email_template_name': 'sky_visitor/invitation_email.html', 'token_view_name': 'no_such_view'}
+        report = list(send_invitations(['unsent@example.com'], email_kwargs=email_kwargs))[0]
+        self.assertEqual((report.created, report.sent, report.failed, report.email_failed), (1, 0, 0, 1))
+        self.assertIn('NoReverseMatch', report.errors[0][1])
+        self.assertEqual(len(mail.outbox), 0)
+
+    def write_csv(self, *emails):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write(''.join('%s\n' % email for email in emails))
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_command_should_check_token_view_before_creating_users(self):
+        path = self.write_csv('early@example.com')
+        # call_command() exits on CommandError in Django 1.4
+        with self.assertRaises(SystemExit):
+            call_command('sky_visitor_invite', path, stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(User.objects.filter(email='early@example.com').exists())
+
+    def test_command_should_report_totals(self):
+        User.objects.create_user('taken@example.com', password='asdf')
+        stdout = StringIO()
+        call_command('sky_visitor_invite', self.write_csv('new@example.com', 'taken@example.com'),
+                     token_view='forgot_password_change', stdout=stdout, stderr=StringIO())
+        self.assertIn("Done: 1 sent, 1 failed, 0 created but not emailed", stdout.getvalue())
@@ -0,0 +1,180 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import threading
+import time
+from django.core.cache.backends.dummy import DummyCache
+from sky_visitor.cache import get_cache_backend
+from sky_visitor.settings import get_app_setting
+
+
+class CacheCounterStore(object):
+    """
+    Keeps throttle counters in the cache framework, so that every process sees the same counts
+    """
+
+    def __init__(self, alias):
+        self.cache = get_cache_backend(alias)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def incr(self, key, timeout):
+        self.cache.add(key, 0, timeout)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            self.cache.set(key, 1, timeout)
+            return 1
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+
+class MemoryCounterStore(object):
+    """
+    Keeps throttle counters in this process. Used when the cache can't hold counters (DummyCache) or is unreachable.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        expires_at, count = self._counters.get(key, (0, 0))
+        if expires_at <= now:
+            self._counters.pop(key, None)
+            return 0
+        return count
+
+    def get_many(self, keys):
+        now = time.time()
+        with self._lock:
+            return dict((key, self._get(key, now)) for key in keys)
+
+    def incr(self, key, timeout):
+        now = time.time()
+        with self._lock:
+            if len(self._counters) > 10000:
+                for expired in [k for k, (expires_at, count) in self._counters.items() if expires_at <= now]:
+                    del self._counters[expired]
+            count = self._get(key, now) + 1
+            expires_at = self._counters.get(key, (now + timeout, 0))[0]
+            self._counters[key] = (expires_at, count)
+            return count
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._counters.pop(key, None)
+
+
+memory_store = MemoryCounterStore()
+
+
+class Throttle(object):
+    """
+    Limits how often an action (`name`) can be attempted, per client IP, per account identifier and per (IP, account)
+    pair. The limits for each action come from SKY_VISITOR_THROTTLE_RULES as (scope, limit, window in seconds) tuples.
+
+    Counts are kept in a sliding window, approximated from the counter of the current fixed window and a share of the
+    previous one, so a burst straddling a window boundary is still counted. Checking a throttle only reads counters;
+    callers decide which attempts to hit() (e.g. only failed logins).
+    """
+    scopes = ('ip', 'account', 'ip_account')
+
+    def __init__(self, name):
+        self.name = name
+
+    def is_enabled(self):
+        return get_app_setting('SKY_VISITOR_THROTTLE_ENABLED') and bool(self.get_rules())
+
+    def get_rules(self):
+        return get_app_setting('SKY_VISITOR_THROTTLE_RULES').get(self.name, [])
+
+    def get_store(self):
+        try:
+            store = CacheCounterStore(get_app_setting('SKY_VISITOR_THROTTLE_CACHE_ALIAS'))
+        except Exception:
+            return memory_store
+        if isinstance(store.cache, DummyCache):
+            return memory_store
+        return store
+
+    def get_client_ip(self, request):
+        """
+        Override this if the app runs behind a proxy that puts the client address somewhere else
+        """
+        return request.META.get('REMOTE_ADDR', '')
+
+    def get_scope_value(self, scope, ip, identifier):
+        identifier = (identifier or '').strip().lower()
+        if scope == 'ip':
+            return ip
+        elif scope == 'account':
+            return identifier
+        elif scope == 'ip_account':
+            return '%s|%s' % (ip, identifier)
+        raise ValueError("Unknown throttle scope %r" % scope)
+
+    def get_windows(self, ip, identifier, now=None):
+        """
+        Returns (current key, previous key, limit, window, elapsed fraction of the current window) for each rule that
+        applies. Rules involving the account are skipped when there is no identifier.
+        """
+        if now is None:
+            now = time.time()
+        windows = []
+        for scope, limit, window in self.get_rules():
+            if scope != 'ip' and not identifier:
+                continue
+            value = self.get_scope_value(scope, ip, identifier).encode('utf-8')
+            prefix = 'sky_visitor.throttle.%s.%s.%s' % (self.name, scope, hashlib.md5(value).hexdigest())
+            index = int(now // window)
+            windows.append(('%s.%d' % (prefix, index), '%s.%d' % (prefix, index - 1), limit, window,
+                            (now % window) / float(window)))
+        return windows
+
+    def _call(self, method, *args):
+        try:
+            return getattr(self.get_store(), method)(*args)
+        except Exception:
+            # Counting must not take the login page down with the cache
+            return getattr(memory_store, method)(*args)
+
+    def is_throttled(self, ip, identifier=None):
+        windows = self.get_windows(ip, identifier)
+        if not windows:
+            return False
+        counts = self._call('get_many', [key for w in windows for key in w[:2]])
+        for current_key, previous_key, limit, window, elapsed in windows:
+            estimate = counts.get(current_key, 0) + counts.get(previous_key, 0) * (1 - elapsed)
+            if estimate >= limit:
+                return True
+        return False
+
+    def hit(self, ip, identifier=None):
+        for current_key, previous_key, limit, window, elapsed in self.get_windows(ip, identifier):
+            # Kept for two windows, so it can serve as the previous window of the next one
+            self._call('incr', current_key, window * 2)
+
+    def reset(self, ip, identifier):
+        """
+        Forgets the account counters, e.g. after a successful login. The IP counters are kept.
+        """
+        keys = [key for w in self.get_windows(ip, identifier) for key in w[:2]]
+        ip_keys = [key for w in self.get_windows(ip, None) for key in w[:2]]
+        self._call('delete_many', [key for key in keys if key not in ip_keys])
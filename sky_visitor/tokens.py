@@ -0,0 +1,81 @@
+# Copyright 2012 Concentric Sky, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import int_to_base36, base36_to_int
+
+
+class SignedTokenGenerator(object):
+    """
+    Drop-in replacement for django.contrib.auth.tokens.default_token_generator. Tokens look like
+    "<expiry>-<fingerprint>-<signature>", where the signature is an HMAC of the user id, `purpose`, expiry and a
+    fingerprint of the user's password hash.
+
+    check_token_signature() verifies the signature and expiry without loading the user, so bad and expired tokens never
+    reach the database. check_token() also compares the fingerprint with the user's current password hash, which makes
+    the token single use: setting a password changes the fingerprint.
+
+    Use a different `purpose` for each kind of token so that, e.g., an invitation token can't be used to reset a password.
+    """
+
+    def __init__(self, purpose, timeout=None):
+        self.purpose = purpose
+        # Seconds a token stays valid. Defaults to PASSWORD_RESET_TIMEOUT_DAYS.
+        self.timeout = timeout
+
+    def get_timeout(self):
+        if self.timeout is None:
+            return settings.PASSWORD_RESET_TIMEOUT_DAYS * 24 * 60 * 60
+        return self.timeout
+
+    def make_token(self, user):
+        expiry_b36 = int_to_base36(int(self._now()) + self.get_timeout())
+        fingerprint = self.get_fingerprint(user)
+        return '%s-%s-%s' % (expiry_b36, fingerprint, self.get_signature(user.pk, expiry_b36, fingerprint))
+
+    def check_token_signature(self, user_id, token):
+        """
+        Returns whether `token` was made by this generator for the user with primary key `user_id` and hasn't expired
+        """
+        try:
+            expiry_b36, fingerprint, signature = token.split('-')
+            expiry = base36_to_int(expiry_b36)
+        except ValueError:
+            return False
+        if not constant_time_compare(self.get_signature(user_id, expiry_b36, fingerprint), signature):
+            return False
+        return expiry >= self._now()
+
+    def check_token(self, user, token):
+        if not self.check_token_signature(user.pk, token):
+            return False
+        return constant_time_compare(self.get_fingerprint(user), token.split('-')[1])
+
+    def get_fingerprint(self, user):
+        # Keyed so that the token doesn't reveal anything about the password hash
+        return salted_hmac('sky_visitor.tokens.fingerprint', user.password).hexdigest()[:12]
+
+    def get_signature(self, user_id, expiry_b36, fingerprint):
+        value = u'%s-%s-%s' % (user_id, expiry_b36, fingerprint)
+        return salted_hmac('sky_visitor.tokens.%s' % self.purpose, value).hexdigest()[::2]
+
+    def _now(self):
+        # Used for mocking in tests
+        return time.time()
+
+
+password_reset_token_generator = SignedTokenGenerator('password_reset')
+invitation_token_generator = SignedTokenGenerator('invitation')
@@ -16,7 +16,8 @@ from django.conf.urls import *
 from django.views.generic.base import TemplateView
 from sky_visitor.views import *
 
-TOKEN_REGEX = '(?P<uidb36>[0-9A-Za-z]{1,13})-(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20})'
+# The optional third part of the token is the signature of sky_visitor.tokens.SignedTokenGenerator tokens
+TOKEN_REGEX = '(?P<uidb36>[0-9A-Za-z]{1,13})-(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20}(?:-[0-9A-Za-z]{1,20})?)'
 
 urlpatterns = patterns('',
     url(r'^register/$', RegisterView.as_view(), name='register'),
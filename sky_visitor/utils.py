@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from django.test.signals import setting_changed
+from django.utils.functional import SimpleLazyObject, empty
 from django.utils.translation import ugettext_lazy as _
 from django.utils.unittest.case import skipUnless
 from sky_visitor.settings import get_app_setting
@@ -32,18 +34,76 @@ def get_user_model():
     module = __import__('.'.join(parts), fromlist=[''])
     return getattr(module, model_name)
 
-SubclassedUser = get_user_model()
+
+class LazyModel(SimpleLazyObject):
+    """
+    Stands in for a model class that is only imported the first time it is used, so that importing sky_visitor doesn't
+    import (and can't circularly import) the app that defines the user model. Attribute access, calling it to create an
+    instance, and isinstance() and issubclass() checks all go to the model.
+    """
+
+    def resolve(self):
+        """
+        Returns the model class itself, for code that needs a real class (e.g. admin.site.register())
+        """
+        if self._wrapped is empty:
+            self._setup()
+        return self._wrapped
+
+    def reset(self):
+        self._wrapped = empty
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self.resolve())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self.resolve())
+
+    def __repr__(self):
+        if self._wrapped is empty:
+            return '<LazyModel: unresolved>'
+        return '<LazyModel: %r>' % self._wrapped
+
+
+SubclassedUser = LazyModel(get_user_model)
+
+
+# What kind of user model SubclassedUser is. Filled in on first use.
+_user_model_flags = {}
+
+
+def get_user_model_flags():
+    if not _user_model_flags:
+        from django.contrib.auth.models import User as AuthUser
+        model = SubclassedUser.resolve()
+        _user_model_flags.update({
+            'subclassed': hasattr(model, '_is_email_only'),
+            'email_only': getattr(model, '_is_email_only', False),
+            'auth': isinstance(model, AuthUser),
+        })
+    return _user_model_flags
+
+
+def reset_user_model(**kwargs):
+    if kwargs.get('setting') in (None, 'SKY_VISITOR_USER_MODEL'):
+        SubclassedUser.reset()
+        _user_model_flags.clear()
+setting_changed.connect(reset_user_model, dispatch_uid='sky_visitor.utils.reset_user_model')
 
 
 def is_subclassed_user():
-    return hasattr(SubclassedUser, '_is_email_only')
+    return get_user_model_flags()['subclassed']
 
 def is_username_user():
-    return hasattr(SubclassedUser, '_is_email_only') and not SubclassedUser._is_email_only
+    flags = get_user_model_flags()
+    return flags['subclassed'] and not flags['email_only']
 
 def is_email_only():
-    return hasattr(SubclassedUser, '_is_email_only') and SubclassedUser._is_email_only
+    flags = get_user_model_flags()
+    return flags['subclassed'] and flags['email_only']
 
 def is_auth_user():
-    from django.contrib.auth.models import User as AuthUser
-    return isinstance(SubclassedUser, AuthUser)
+    return get_user_model_flags()['auth']
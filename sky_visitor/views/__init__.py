@@ -12,12 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import urlparse
 from sky_visitor.emails import TokenTemplateEmail
 from django.contrib import messages
 from django.contrib.auth import REDIRECT_FIELD_NAME, login, logout
-from django.contrib.auth.tokens import default_token_generator
+from django.contrib.auth.tokens import default_token_generator, PasswordResetTokenGenerator
+from django.core.mail import get_connection
 from django.core.urlresolvers import reverse
+from django.forms.forms import NON_FIELD_ERRORS
+from django.forms.util import ErrorDict, ErrorList
 from django.http import HttpResponseRedirect
 from django.utils.decorators import method_decorator
 from django.utils.http import base36_to_int
@@ -26,14 +30,19 @@ from django.views.decorators.csrf import csrf_protect
 from django.views.generic.base import RedirectView
 from django.views.generic.edit import FormView, UpdateView, CreateView
 from django.utils.translation import ugettext_lazy as _
+from sky_visitor import metrics
 from sky_visitor.backends import auto_login
+from sky_visitor.cache import token_user_cache
+from sky_visitor.settings import get_app_setting
+from sky_visitor.throttling import Throttle
 from sky_visitor.forms import *
 from sky_visitor.utils import SubclassedUser as User, is_email_only
+from sky_visitor.views.mixins import ProfilingMixin
 from django.contrib.auth.models import User as AuthUser
 from django.conf import settings
 
 
-class RegisterView(CreateView):
+class RegisterView(ProfilingMixin, CreateView):
     model = User
     template_name = 'sky_visitor/register.html'
     success_message = _("Successfully registered and signed in")
@@ -58,7 +67,47 @@ class RegisterView(CreateView):
 
 
 # Originally from: https://github.com/stefanfoulis/django-class-based-auth-views/blob/develop/class_based_auth_views/views.py
-class LoginView(FormView):
+class ThrottleMixin(object):
+    """
+    Checks `throttle_class(throttle_name)` before a POST is processed. Throttled requests are answered with the form and
+    throttled_message, with a 429 status, without validating the form.
+    """
+    throttle_class = Throttle
+    throttle_name = None
+    throttle_identifier_fields = ('email',)
+    throttled_message = _("Too many attempts. Please wait a few minutes and try again.")
+
+    def get_throttle(self):
+        throttle = self.throttle_class(self.throttle_name)
+        return throttle if throttle.is_enabled() else None
+
+    def get_throttle_identifier(self):
+        for field_name in self.throttle_identifier_fields:
+            value = self.request.POST.get(field_name)
+            if value:
+                return value
+        return None
+
+    def check_throttle(self):
+        """
+        Returns (throttle, ip, identifier), or None when throttling is off
+        """
+        throttle = self.get_throttle()
+        if throttle is None:
+            return None
+        return throttle, throttle.get_client_ip(self.request), self.get_throttle_identifier()
+
+    def is_throttled(self, throttle_args):
+        return throttle_args is not None and throttle_args[0].is_throttled(*throttle_args[1:])
+
+    def throttled(self, form):
+        form._errors = ErrorDict({NON_FIELD_ERRORS: ErrorList([self.throttled_message])})
+        response = self.render_to_response(self.get_context_data(form=form))
+        response.status_code = 429
+        return response
+
+
+class LoginView(ProfilingMixin, ThrottleMixin, FormView):
     """
     This is a class based version of django.contrib.auth.views.login.
 
@@ -74,6 +123,8 @@ class LoginView(FormView):
     redirect_field_name = REDIRECT_FIELD_NAME
     success_url_overrides_redirect_field = False
     template_name = 'sky_visitor/login.html'
+    throttle_name = 'login'
+    throttle_identifier_fields = ('username', 'email', 'identifier')
 
     @method_decorator(csrf_protect)
     @method_decorator(never_cache)
@@ -81,8 +132,11 @@ class LoginView(FormView):
         return super(LoginView, self).dispatch(*args, **kwargs)
 
     def get_form_class(self):
-        # TODO: Support email+username login when in username-mode
-        if is_email_only():
+        if self.form_class:
+            return self.form_class
+        if 'sky_visitor.backends.UsernameOrEmailBackend' in settings.AUTHENTICATION_BACKENDS:
+            return IdentifierLoginForm
+        elif is_email_only():
             return EmailLoginForm
         else:
             return LoginForm
@@ -133,25 +187,46 @@ class LoginView(FormView):
         """
         form_class = self.get_form_class()
         form = self.get_form(form_class)
+        throttle_args = self.check_throttle()
+        if self.is_throttled(throttle_args):
+            return self.throttled(form)
         if form.is_valid():
+            if throttle_args is not None:
+                throttle_args[0].reset(*throttle_args[1:])
             self.check_and_delete_test_cookie()
             return self.form_valid(form)
         else:
+            if throttle_args is not None:
+                throttle_args[0].hit(*throttle_args[1:])
             self.set_test_cookie()
             return self.form_invalid(form)
 
 
 class SendTokenEmailMixin(object):
     email_template_class = TokenTemplateEmail
+    # Must match the token_generator of the view the token URL points to
+    token_generator = default_token_generator
 
     def get_email_kwargs(self, user):
-        return {'user': user}
+        return {'user': user, 'token_generator': self.token_generator}
 
-    def send_email(self, user):
+    def send_email(self, user, connection=None):
         """
         """
         email_template = self.email_template_class(**self.get_email_kwargs(user))
-        return email_template.send_email()
+        return email_template.send_email(connection=connection)
+
+    def send_emails(self, users):
+        """
+        Sends an email to each of `users` over one connection rather than opening a new one per email
+        """
+        connection = get_connection()
+        opened = connection.open()
+        try:
+            return sum(self.send_email(user, connection=connection) or 0 for user in users)
+        finally:
+            if opened:
+                connection.close()
 
 
 class InvitationMixin(SendTokenEmailMixin):
@@ -193,17 +268,71 @@ class TokenValidateMixin(object):
         uidb36 = kwargs['uidb36']
         token = kwargs['token']
         assert uidb36 is not None and token is not None  # checked by URLconf
-        try:
-            uid_int = base36_to_int(uidb36)
-            # Get an AuthUser instance here since we don't need any of the extra aspects of the SubclassedUser
-            self._user = AuthUser.objects.get(id=uid_int)
-        except (ValueError, AuthUser.DoesNotExist):
-            self._user = None
-        self.is_token_valid = (self._user is not None and self.get_token_generator().check_token(self._user, token))
+        with metrics.timer('tokens.validate'):
+            self._user = self.get_valid_token_user(uidb36, token)
+        self.is_token_valid = self._user is not None
         if not self.is_token_valid:
             return self.token_invalid(request, *args, **kwargs)
         return super(TokenValidateMixin, self).dispatch(request, *args, **kwargs)
 
+    def get_valid_token_user(self, uidb36, token):
+        """
+        Returns the user `token` was issued to, or None if the token is not valid. The cheap checks come first: a token
+        that is malformed, expired or failed validation recently is rejected without touching the database.
+        """
+        try:
+            uid_int = base36_to_int(uidb36)
+        except ValueError:
+            uid_int = None
+        if uid_int is None or not self.is_token_plausible(uid_int, token):
+            metrics.incr('tokens.rejected.implausible')
+            return None
+        invalid_key = self.get_invalid_token_cache_key(uidb36, token)
+        invalid_timeout = get_app_setting('SKY_VISITOR_INVALID_TOKEN_CACHE_TIMEOUT')
+        cache = token_user_cache.get_cache()
+        if invalid_timeout and cache.get(invalid_key):
+            metrics.incr('tokens.rejected.cached')
+            return None
+        user = token_user_cache.get(uid_int, self.load_user)
+        if user is None or not self.get_token_generator().check_token(user, token):
+            metrics.incr('tokens.rejected.invalid')
+            if invalid_timeout:
+                cache.set(invalid_key, True, invalid_timeout)
+            return None
+        metrics.incr('tokens.valid')
+        return user
+
+    def load_user(self, uid_int):
+        try:
+            # Get an AuthUser instance here since we don't need any of the extra aspects of the SubclassedUser
+            return AuthUser.objects.get(id=uid_int)
+        except AuthUser.DoesNotExist:
+            return None
+
+    def is_token_plausible(self, uid_int, token):
+        """
+        Checks what can be checked without the user. Generators with a check_token_signature() method (like
+        sky_visitor.tokens.SignedTokenGenerator) verify the whole token except for the password fingerprint. For tokens
+        made by Django's PasswordResetTokenGenerator that is the "<timestamp>-<hash>" shape and the timestamp, which must
+        not be in the future or older than PASSWORD_RESET_TIMEOUT_DAYS. Tokens from other generators are passed on to
+        check_token() as they are.
+        """
+        token_generator = self.get_token_generator()
+        if hasattr(token_generator, 'check_token_signature'):
+            return token_generator.check_token_signature(uid_int, token)
+        if not isinstance(token_generator, PasswordResetTokenGenerator):
+            return True
+        try:
+            ts_b36, hash = token.split('-')
+            ts = base36_to_int(ts_b36)
+        except ValueError:
+            return False
+        age = token_generator._num_days(token_generator._today()) - ts
+        return 0 <= age <= settings.PASSWORD_RESET_TIMEOUT_DAYS
+
+    def get_invalid_token_cache_key(self, uidb36, token):
+        return 'sky_visitor.invalid_token.%s' % hashlib.md5('%s-%s' % (uidb36, token)).hexdigest()
+
     def token_invalid(self, request, *args, **kwargs):
         if self.display_message_on_invalid_token:
             messages.error(request, self.invalid_token_message, fail_silently=True)
@@ -213,7 +342,7 @@ class TokenValidateMixin(object):
         return self._user
 
 
-class InvitationCompleteView(TokenValidateMixin, UpdateView):
+class InvitationCompleteView(ProfilingMixin, TokenValidateMixin, UpdateView):
     form_class = InvitationCompleteForm
     form_class_set_password = SetPasswordForm
     context_object_name = 'invited_user'
@@ -283,9 +412,18 @@ class LogoutView(RedirectView):
         return reverse('login')
 
 
-class ForgotPasswordView(SendTokenEmailMixin, FormView):
+class ForgotPasswordView(ProfilingMixin, ThrottleMixin, SendTokenEmailMixin, FormView):
     form_class = PasswordResetForm
     template_name = 'sky_visitor/forgot_password_start.html'
+    throttle_name = 'forgot_password'
+
+    def post(self, request, *args, **kwargs):
+        throttle_args = self.check_throttle()
+        if throttle_args is not None:
+            if self.is_throttled(throttle_args):
+                return self.throttled(self.get_form(self.get_form_class()))
+            throttle_args[0].hit(*throttle_args[1:])
+        return super(ForgotPasswordView, self).post(request, *args, **kwargs)
 
     def form_valid(self, form):
         user = form.users_cache[0]
@@ -305,7 +443,7 @@ class ForgotPasswordView(SendTokenEmailMixin, FormView):
         return reverse('forgot_password_check_email')
 
 
-class ForgotPasswordChangeView(TokenValidateMixin, FormView):
+class ForgotPasswordChangeView(ProfilingMixin, TokenValidateMixin, FormView):
     form_class = SetPasswordForm
     template_name = 'sky_visitor/forgot_password_change.html'
     invalid_token_message = _("Invalid reset password link. Please reset your password again.")
@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
+from sky_visitor.profiling import request_profiler, PROFILE_FILE_HEADER
 
 
 class LoginRequiredMixin(object):
@@ -22,3 +24,26 @@ class LoginRequiredMixin(object):
     @method_decorator(login_required)
     def dispatch(self, *args, **kwargs):
         return super(LoginRequiredMixin, self).dispatch(*args, **kwargs)
+
+
+class ProfilingMixin(object):
+    u"""
+    Profiles the view (including template rendering) for a sample of requests and for requests with a valid
+    X-Sky-Visitor-Profile header. See sky_visitor.profiling.
+    """
+    profiler = request_profiler
+
+    def dispatch(self, request, *args, **kwargs):
+        triggered = self.profiler.is_triggered(request)
+        if not triggered and not self.profiler.is_sampled():
+            return super(ProfilingMixin, self).dispatch(request, *args, **kwargs)
+        response, path = self.profiler.run(self.__class__.__name__, self._dispatch_and_render, request, *args, **kwargs)
+        if triggered and path:
+            response[PROFILE_FILE_HEADER] = os.path.basename(path)
+        return response
+
+    def _dispatch_and_render(self, request, *args, **kwargs):
+        response = super(ProfilingMixin, self).dispatch(request, *args, **kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        return response